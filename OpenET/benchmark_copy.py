@@ -0,0 +1,128 @@
+import time
+import csv
+import datetime as dt
+from cStringIO import StringIO
+from sqlalchemy import create_engine
+
+import config
+from db_methods import pgcopy_Util, TIMESERIES_COPY_COLUMNS, TIMESERIES_COPY_TYPES, \
+    DATA_COPY_COLUMNS, DATA_COPY_TYPES
+
+
+def make_rows(num_features, year):
+    '''
+    Fake timeseries and data rows laid out like add_data_to_db writes them:
+    4 variables x (12 months + annual) per feature
+    :param num_features:
+    :param year:
+    :return: timeseries rows, data rows
+    '''
+    ts_rows = []
+    data_rows = []
+    last_timeseries_update = dt.datetime.today()
+    timeseries_id = 0
+    for feature_id in range(1, num_features + 1):
+        for var in ["et", "etf", "etr", "ndvi"]:
+            # period_id 1-12: months, 13: annual
+            for period_id in range(1, 14):
+                timeseries_id += 1
+                if period_id == 13:
+                    t_res = "annual"
+                else:
+                    t_res = "monthly"
+                ts_rows.append([timeseries_id, "ssebop", year, period_id, feature_id * 0.001 + period_id])
+                data_rows.append([feature_id, 0, timeseries_id, "ssebop", var, t_res, year,
+                                  "public", last_timeseries_update])
+    return ts_rows, data_rows
+
+
+def encode_csv(rows):
+    buf = StringIO()
+    writer = csv.writer(buf, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL)
+    for row in rows:
+        writer.writerow(row)
+    return buf
+
+
+def encode_binary(rows, col_types):
+    writer = pgcopy_Util(col_types)
+    for row in rows:
+        writer.writerow(row)
+    return writer
+
+
+def create_bench_tables(cursor):
+    cursor.execute("""
+        CREATE TEMP TABLE bench_timeseries (
+            timeseries_id integer, model_name varchar, year integer,
+            period_id integer, data_value real
+        )
+    """)
+    cursor.execute("""
+        CREATE TEMP TABLE bench_data (
+            feature_id integer, user_id integer, timeseries_id integer,
+            model_name varchar, variable_name varchar, temporal_resolution varchar, year integer,
+            permission varchar, last_timeseries_update timestamp
+        )
+    """)
+
+
+def run_benchmark(cursor, ts_rows, data_rows, copy_format):
+    cursor.execute("TRUNCATE bench_timeseries, bench_data")
+    start_time = time.time()
+    if copy_format == "binary":
+        ts_writer = encode_binary(ts_rows, TIMESERIES_COPY_TYPES)
+        data_writer = encode_binary(data_rows, DATA_COPY_TYPES)
+    else:
+        ts_buf = encode_csv(ts_rows)
+        data_buf = encode_csv(data_rows)
+    encode_secs = time.time() - start_time
+
+    start_time = time.time()
+    if copy_format == "binary":
+        ts_writer.copy_to_table(cursor, "bench_timeseries", TIMESERIES_COPY_COLUMNS)
+        data_writer.copy_to_table(cursor, "bench_data", DATA_COPY_COLUMNS)
+    else:
+        ts_buf.seek(0)
+        cursor.copy_from(ts_buf, "bench_timeseries", sep=",", columns=TIMESERIES_COPY_COLUMNS)
+        data_buf.seek(0)
+        cursor.copy_from(data_buf, "bench_data", sep=",", columns=DATA_COPY_COLUMNS)
+    copy_secs = time.time() - start_time
+    return encode_secs, copy_secs
+
+
+if __name__ == "__main__":
+    '''
+    Compare the csv and the binary (PGCOPY) COPY path used by
+    database_Util.add_data_to_db for the timeseries and data tables
+    Rows are copied into temporary tables, nothing is written to the schema
+    '''
+    DB_USER = config.OPENET_DB_USER
+    DB_PASSWORD = config.OPENET_DB_PASSWORD
+    DB_PORT = config.OPENET_DB_PORT
+    DB_HOST = config.OPENET_DB_HOST
+    DB_NAME = config.OPENET_DB_NAME
+
+    db_string = "postgresql+psycopg2://" + DB_USER + ":" + DB_PASSWORD
+    db_string += "@" + DB_HOST + ":" + str(DB_PORT) + '/' + DB_NAME
+    engine = create_engine(db_string)
+
+    num_features = config.statics["ingest_chunk_size"] * 10
+    year = 2017
+    num_runs = 3
+
+    ts_rows, data_rows = make_rows(num_features, year)
+    num_rows = len(ts_rows) + len(data_rows)
+    print("Benchmarking " + str(num_rows) + " rows for " + str(num_features) + " features")
+
+    dbapi_conn = engine.raw_connection()
+    cursor = dbapi_conn.cursor()
+    create_bench_tables(cursor)
+    for copy_format in ["csv", "binary"]:
+        for run in range(1, num_runs + 1):
+            encode_secs, copy_secs = run_benchmark(cursor, ts_rows, data_rows, copy_format)
+            total_secs = encode_secs + copy_secs
+            print("{0} run {1}: encode {2:.3f} s, copy {3:.3f} s, {4:.0f} rows/s".format(
+                copy_format, run, encode_secs, copy_secs, num_rows / total_secs))
+    dbapi_conn.rollback()
+    dbapi_conn.close()
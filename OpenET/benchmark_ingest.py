@@ -0,0 +1,302 @@
+import os
+import math
+import time
+import json
+import random
+import argparse
+import datetime as dt
+from sqlalchemy import create_engine
+from sqlalchemy.orm import session as session_module
+
+import config
+from db_methods import Base, FeatureCollection, database_Util
+
+'''
+Synthetic feature collections and an ingest benchmark
+
+The generator writes geojson featureCollections laid out like the
+collections in config.statics["feature_collections"]: field polygons
+(digitized quads, center pivots, a few multi polygons) with the
+metadata properties of the collection and one {var}_{data_var}
+property per model variable and period, e.g. et_m01, et_annual.
+
+The runner loads the collections through database_Util.add_data_to_db
+into the database set in config and records the throughput:
+per chunk records (see metrics_Util) go to <out_dir>/metrics.jsonl,
+one summary record per run to <out_dir>/results.jsonl
+
+--bulk-load loads through database_Util.bulk_load_data_to_db instead
+(indexes and foreign keys dropped and rebuilt), the record then has the
+timings of its steps; run the same sizes without it for the baseline
+
+Example, 1000 to ca_clu_public size:
+    python benchmark_ingest.py --num-features 1000 10000 268325
+    python benchmark_ingest.py --num-features 1000 10000 268325 --bulk-load
+'''
+
+# Default area: Central Valley, CA
+DEFAULT_BBOX = (-122.0, 35.0, -119.0, 39.5)
+# Field size in degrees (~200 m to ~900 m)
+FIELD_SIZE_RANGE = (0.002, 0.008)
+
+
+def make_field_polygon(rng, lon, lat, size):
+    '''
+    Quadrilateral field with extra, slightly jittered vertices along the edges,
+    similar to digitized CLU boundaries
+    :return: list of (lon, lat) ring coordinates, closed
+    '''
+    w = size * rng.uniform(0.6, 1.0)
+    h = size * rng.uniform(0.6, 1.0)
+    angle = rng.uniform(-0.2, 0.2)
+    corners = [(-w / 2, -h / 2), (w / 2, -h / 2), (w / 2, h / 2), (-w / 2, h / 2)]
+    ring = []
+    for c_idx, (x0, y0) in enumerate(corners):
+        x1, y1 = corners[(c_idx + 1) % 4]
+        num_edge_pts = rng.randint(1, 12)
+        for p_idx in range(num_edge_pts):
+            f = float(p_idx) / num_edge_pts
+            x = x0 + (x1 - x0) * f + rng.gauss(0, size * 0.005)
+            y = y0 + (y1 - y0) * f + rng.gauss(0, size * 0.005)
+            ring.append((
+                round(lon + x * math.cos(angle) - y * math.sin(angle), 6),
+                round(lat + x * math.sin(angle) + y * math.cos(angle), 6)
+            ))
+    ring.append(ring[0])
+    return ring
+
+
+def make_pivot_polygon(rng, lon, lat, size):
+    '''
+    Center pivot field, circle with 32 to 64 vertices
+    '''
+    r = size * rng.uniform(0.4, 0.5)
+    num_pts = rng.randint(32, 64)
+    ring = [
+        (round(lon + r * math.cos(2 * math.pi * i / num_pts), 6), round(lat + r * math.sin(2 * math.pi * i / num_pts), 6))
+        for i in range(num_pts)
+    ]
+    ring.append(ring[0])
+    return ring
+
+
+def make_geometry(rng, lon, lat, size):
+    '''
+    :return: geojson Polygon (~92% quads, ~5% pivots) or MultiPolygon (~3%)
+    '''
+    kind = rng.random()
+    if kind < 0.03:
+        half = size / 2
+        return {
+            "type": "MultiPolygon",
+            "coordinates": [
+                [make_field_polygon(rng, lon - half / 2, lat, half * 0.9)],
+                [make_field_polygon(rng, lon + half / 2, lat, half * 0.9)]
+            ]
+        }
+    if kind < 0.08:
+        return {"type": "Polygon", "coordinates": [make_pivot_polygon(rng, lon, lat, size)]}
+    return {"type": "Polygon", "coordinates": [make_field_polygon(rng, lon, lat, size)]}
+
+
+def make_data_properties(rng, model):
+    '''
+    Seasonal values for each model variable and period: et_m01 ... et_m12, et_annual, ...
+    et and etr are monthly sums (mm) and the annual value is the sum,
+    etf and ndvi are fractions and the annual value is the mean
+    '''
+    monthly_vars = config.statics["temporal_resolution"]["monthly"]["data_vars"]
+    crop = rng.uniform(0.3, 1.1)
+    peak = rng.randint(5, 8)
+    props = {}
+    etr = [max(20.0, 220.0 * math.exp(-((m - 6.5) / 3.0) ** 2) + rng.gauss(0, 5)) for m in range(1, 13)]
+    etf = [min(1.2, max(0.05, crop * math.exp(-((m - peak) / 2.5) ** 2) + rng.gauss(0, 0.03))) for m in range(1, 13)]
+    values = {
+        "etr": etr,
+        "etf": etf,
+        "et": [etr[i] * etf[i] for i in range(12)],
+        "ndvi": [min(0.95, 0.1 + 0.8 * f) for f in etf]
+    }
+    for var in config.statics["models"][model]["variables"]:
+        monthly = values.get(var, [rng.uniform(0, 1) for m in range(12)])
+        for m_idx, data_var in enumerate(monthly_vars):
+            props[var + "_" + data_var] = round(monthly[m_idx], 4)
+        if var in ["et", "etr"]:
+            props[var + "_annual"] = round(sum(monthly), 4)
+        else:
+            props[var + "_annual"] = round(sum(monthly) / 12.0, 4)
+    return props
+
+
+def make_feature(rng, feat_idx, lon, lat, size, model, metadata_keys):
+    '''
+    :param feat_idx: index of the feature in the collection, starting at 1
+    :param metadata_keys: metadata property names of the collection
+    :return: geojson feature
+    '''
+    props = {}
+    for key in metadata_keys:
+        if key in ["FID", "OBJECTID", "SimsID"]:
+            props[key] = feat_idx
+        elif key.startswith("Acres"):
+            props[key] = round(size * size * 111000 * 90000 / 4047.0, 2)
+        else:
+            props[key] = key.lower() + "_" + str(rng.randint(1, 50))
+    props.update(make_data_properties(rng, model))
+    return {
+        "type": "Feature",
+        "properties": props,
+        "geometry": make_geometry(rng, lon, lat, size)
+    }
+
+
+def write_collection(path, num_features, model="ssebop", metadata_keys=("FID",), bbox=DEFAULT_BBOX, seed=0):
+    '''
+    Write a synthetic featureCollection, one feature at a time so that
+    collections of any size can be written without holding them in memory
+    Fields are placed on a grid over bbox and don't overlap
+    :return: path
+    '''
+    rng = random.Random(seed)
+    num_cols = int(math.ceil(math.sqrt(num_features * (bbox[2] - bbox[0]) / (bbox[3] - bbox[1]))))
+    cell = (bbox[2] - bbox[0]) / num_cols
+    size = min(cell * 0.9, FIELD_SIZE_RANGE[1])
+    with open(path, "w") as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for feat_idx in range(1, num_features + 1):
+            row, col = divmod(feat_idx - 1, num_cols)
+            lon = bbox[0] + (col + 0.5) * cell
+            lat = bbox[1] + (row + 0.5) * cell
+            feat_size = rng.uniform(min(FIELD_SIZE_RANGE[0], size), size)
+            feature = make_feature(rng, feat_idx, lon, lat, feat_size, model, metadata_keys)
+            if feat_idx > 1:
+                f.write(",\n")
+            f.write(json.dumps(feature))
+        f.write("\n]}\n")
+    return path
+
+
+def register_collection(session, feature_collection_name, num_features, data_file_path, metadata_keys):
+    '''
+    Add the synthetic collection to config.statics and to the FeatureCollection table
+    '''
+    config.statics["feature_collections"][feature_collection_name] = {
+        "users": [0],
+        "permission": "public",
+        "metadata": list(metadata_keys),
+        "data_file_name": os.path.basename(data_file_path),
+        "num_features": num_features,
+        "feature_collection_permission": "public",
+        "url_path_to_shapefile": ""
+    }
+    q = session.query(FeatureCollection).filter(
+        FeatureCollection.feature_collection_name == feature_collection_name).first()
+    if q is None and session.query(FeatureCollection).first() is not None:
+        session.add(FeatureCollection(
+            feature_collection_name=feature_collection_name, user_id=0,
+            feature_collection_permission="public", url_path_to_shapefile=""
+        ))
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+
+def run_ingest_benchmark(engine, num_features, year, out_dir, model="ssebop", metadata_keys=("FID",),
+                         seed=0, bulk_load=False, **init_kwargs):
+    '''
+    Generate (or reuse) a synthetic collection of num_features features and load it
+    :param bulk_load: load with database_Util.bulk_load_data_to_db instead of add_data_to_db
+    :param init_kwargs: extra database_Util arguments, e.g. copy_format, storage_layout
+    :return: summary record
+    '''
+    data_file_path = os.path.join(out_dir, "synthetic_" + str(num_features) + "_" + str(seed) + ".geojson")
+    if not os.path.isfile(data_file_path):
+        start_time = time.time()
+        write_collection(data_file_path, num_features, model=model, metadata_keys=metadata_keys, seed=seed)
+        print("Wrote " + data_file_path + " in " + str(round(time.time() - start_time, 1)) + " s")
+
+    # New collection name per run, prepare_ingest exits if the collection is already loaded
+    feature_collection_name = "synthetic_" + str(num_features) + "_" + dt.datetime.today().strftime("%Y%m%d%H%M%S")
+    Session = session_module.sessionmaker(bind=engine)
+    session = Session()
+    register_collection(session, feature_collection_name, num_features, data_file_path, metadata_keys)
+
+    DU = database_Util(
+        model, year, config.statics["models"][model]["variables"], engine, 0, feature_collection_name,
+        data_file_path, "local", metrics_file=os.path.join(out_dir, "metrics.jsonl"), **init_kwargs
+    )
+    start_time = time.time()
+    bulk_load_timings = None
+    if bulk_load:
+        bulk_load_timings = DU.bulk_load_data_to_db(session)
+    else:
+        DU.add_data_to_db(session)
+    secs = time.time() - start_time
+    session.close()
+
+    record = {
+        "time": dt.datetime.today().isoformat(),
+        "feature_collection_name": feature_collection_name,
+        "num_features": num_features,
+        "year": year,
+        "secs": round(secs, 2),
+        "features_per_sec": round(num_features / secs, 1),
+        "file_size_mb": round(os.path.getsize(data_file_path) / (1024.0 * 1024.0), 1),
+        "bulk_load": bulk_load
+    }
+    if bulk_load_timings is not None:
+        record["bulk_load_timings"] = dict((step, round(t, 2)) for step, t in bulk_load_timings.items())
+    record.update(init_kwargs)
+    with open(os.path.join(out_dir, "results.jsonl"), "a") as results_file:
+        results_file.write(json.dumps(record) + "\n")
+    print("Loaded " + str(num_features) + " features in " + str(record["secs"]) + " s (" +
+          str(record["features_per_sec"]) + " features/s)")
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic collection ingest benchmark")
+    parser.add_argument("--num-features", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--year", type=int, default=2017)
+    parser.add_argument("--years", type=int, nargs="*", help="load several years in one pass, see database_Util")
+    parser.add_argument("--model", default="ssebop")
+    parser.add_argument("--metadata", nargs="*", default=["FID"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out-dir", default="benchmark_ingest")
+    parser.add_argument("--copy-format", default="csv", choices=["csv", "binary"])
+    parser.add_argument("--storage-layout", default="rows", choices=["rows", "arrays"])
+    parser.add_argument("--stream-features", action="store_true")
+    parser.add_argument("--adaptive-chunks", action="store_true")
+    parser.add_argument("--bulk-load", action="store_true", help="drop and rebuild the indexes around the load")
+    parser.add_argument("--generate-only", action="store_true", help="only write the geojson files")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    if args.generate_only:
+        for num_features in args.num_features:
+            path = os.path.join(args.out_dir, "synthetic_" + str(num_features) + "_" + str(args.seed) + ".geojson")
+            write_collection(path, num_features, model=args.model, metadata_keys=args.metadata, seed=args.seed)
+            print("Wrote " + path)
+    else:
+        DB_USER = config.OPENET_DB_USER
+        DB_PASSWORD = config.OPENET_DB_PASSWORD
+        DB_PORT = config.OPENET_DB_PORT
+        DB_HOST = config.OPENET_DB_HOST
+        DB_NAME = config.OPENET_DB_NAME
+
+        db_string = "postgresql+psycopg2://" + DB_USER + ":" + DB_PASSWORD
+        db_string += "@" + DB_HOST + ":" + str(DB_PORT) + '/' + DB_NAME
+        engine = create_engine(db_string)
+        Base.metadata.create_all(engine)
+
+        for num_features in args.num_features:
+            run_ingest_benchmark(
+                engine, num_features, args.year, args.out_dir, model=args.model, metadata_keys=args.metadata,
+                seed=args.seed, bulk_load=args.bulk_load, copy_format=args.copy_format,
+                storage_layout=args.storage_layout, stream_features=args.stream_features,
+                adaptive_chunks=args.adaptive_chunks, years=args.years
+            )
@@ -1,28 +1,56 @@
 import os, sys
+import re
+import time
 import datetime as dt
 import logging
 import json
 import urllib2
 import copy
+import hashlib
+import base64
+import binascii
+import shutil
+import tempfile
+import threading
+import Queue
+import socket
 import subprocess
+import multiprocessing
+from collections import deque, OrderedDict
 import csv
+import struct
+from decimal import Decimal
+from cStringIO import StringIO
 import geojson
 import numpy as np
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    from osgeo import ogr, osr
+except ImportError:
+    ogr = None
+    osr = None
 
 import sqlalchemy as db
+from sqlalchemy import create_engine
 from sqlalchemy.orm import session as session_module
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import inspect
-from shapely.geometry import asShape
 from shapely.geometry.multipolygon import MultiPolygon
 from geoalchemy2.shape import from_shape, to_shape
+from geoalchemy2.elements import WKBElement
 from geoalchemy2.types import Geometry
 import sqlalchemy.sql as sqa
 from sqlalchemy import event, DDL
+from sqlalchemy.dialects import postgresql
 
 import config
 SCHEMA = config.SCHEMA
+# Declarative partitioning of the data and timeseries tables by model and year
+PARTITION_TABLES = config.statics.get("partition_tables", False)
 
 #######################################
 # OpenET database tables
@@ -106,6 +134,8 @@ class FeatureCollection(Base):
     user_id =  db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "user.user_id"), nullable=False)
     feature_collection_permission = db.Column(db.String())
     url_path_to_shapefile = db.Column(db.String())
+    # Generation of the features served to the queries, see database_Util.reload_collection
+    generation = db.Column(db.Integer(), nullable=False, default=0, server_default="0")
 
     users = relationship(
         "User", back_populates="feature_collections",cascade="save-update, merge, delete",
@@ -116,15 +146,51 @@ class FeatureCollection(Base):
     )
 
 
+class FeatureGeometry(Base):
+    """
+    Geometries shared by features, keyed by a hash of the normalized geometry (see normalize_polygon_geometry)
+    so that unchanged polygons of collections that change by year are stored once
+    """
+    __tablename__ = "feature_geometry"
+    __table_args__ = {"schema": SCHEMA}
+    geometry_id = db.Column(db.Integer(), primary_key=True)
+    geometry_hash = db.Column(db.String(), unique=True, index=True, nullable=False)
+    geometry = db.Column(Geometry(geometry_type="MULTIPOLYGON"))
+
+    features = relationship(
+        "Feature", back_populates="feature_geometry", cascade="save-update, merge, delete"
+    )
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
 class Feature(Base):
     __tablename__ = "feature"
-    __table_args__ = {"schema": SCHEMA}
+    __table_args__ = (
+        db.UniqueConstraint("feature_collection_name", "feature_id_from_user", "year", "generation"),
+        db.Index("ix_feature_feature_properties", "feature_properties",
+                 postgresql_using="gin", postgresql_ops={"feature_properties": "jsonb_path_ops"}),
+        {"schema": SCHEMA}
+    )
     feature_id = db.Column(db.Integer(), primary_key=True)
     feature_collection_name = db.Column(db.String(), db.ForeignKey(SCHEMA + "." + "feature_collection.feature_collection_name"), index=True, nullable=False)
     feature_id_from_user = db.Column(db.String())
     type = db.Column(db.String())
     year = db.Column(db.Integer())
+    # Either geometry or geometry_id (FeatureGeometry) is set
     geometry = db.Column(Geometry(geometry_type="MULTIPOLYGON"))
+    geometry_id = db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "feature_geometry.geometry_id"), index=True)
+    # Derived from the geometry at ingest, see database_Util.set_geometry_columns
+    area = db.Column(db.Float())
+    # ST_Envelope of a degenerate geometry is a point or a line, not a polygon
+    bbox = db.Column(Geometry(geometry_type="GEOMETRY"))
+    centroid = db.Column(Geometry(geometry_type="POINT"))
+    geometry_simplified = db.Column(Geometry(geometry_type="MULTIPOLYGON"))
+    # Metadata as one document {feature_metadata_name: feature_metadata_properties}
+    feature_properties = db.Column(postgresql.JSONB())
+    # Features of a reload are written to a new generation, see database_Util.reload_collection
+    generation = db.Column(db.Integer(), nullable=False, default=0, server_default="0")
 
     feature_collections = relationship(
         "FeatureCollection", back_populates="features", cascade="save-update, merge, delete",
@@ -136,13 +202,27 @@ class Feature(Base):
     feature_metadata = relationship(
         "FeatureMetadata", back_populates="feature", cascade="save-update, merge, delete"
     )
+    timeseries_arrays = relationship(
+        "TimeseriesArray", back_populates="feature", cascade="save-update, merge, delete"
+    )
+    feature_geometry = relationship(
+        "FeatureGeometry", back_populates="features", cascade="save-update, merge",
+        foreign_keys="Feature.geometry_id"
+    )
 
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
 class FeatureMetadata(Base):
+    """
+    Note: no longer written by the ingest, metadata is stored in Feature.feature_properties,
+    see database_Util.migrate_metadata_to_properties
+    """
     __tablename__ = "feature_metadata"
-    __table_args__ = {"schema": SCHEMA}
+    __table_args__ = (
+        db.UniqueConstraint("feature_id", "feature_metadata_name"),
+        {"schema": SCHEMA}
+    )
     feature_metadata_id = db.Column(db.Integer(), primary_key=True)
     feature_id = db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "feature.feature_id"), nullable=False)
     feature_metadata_name = db.Column(db.String())
@@ -172,17 +252,35 @@ class Variable(Base):
         self.__dict__.update(kwargs)
 
 
+if PARTITION_TABLES:
+    # The partition keys have to be part of the primary key of timeseries,
+    # so data references timeseries by (timeseries_id, model_name, year)
+    DATA_TIMESERIES_FK_COLUMNS = ["timeseries_id", "model_name", "year"]
+    PARTITION_TABLE_ARGS = {"schema": SCHEMA, "postgresql_partition_by": "LIST (model_name)"}
+else:
+    DATA_TIMESERIES_FK_COLUMNS = ["timeseries_id"]
+    PARTITION_TABLE_ARGS = {"schema": SCHEMA}
+
+
 class Data(Base):
     __tablename__ = "data"
-    __table_args__ = {"schema": SCHEMA}
-    data_id = db.Column(db.Integer(), primary_key=True)
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            DATA_TIMESERIES_FK_COLUMNS,
+            [SCHEMA + "." + "timeseries." + col for col in DATA_TIMESERIES_FK_COLUMNS]
+        ),
+        PARTITION_TABLE_ARGS
+    )
+    data_id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
     feature_id = db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "feature.feature_id"), nullable=False)
     user_id =  db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "user.user_id"), nullable=False)
-    timeseries_id = db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "timeseries.timeseries_id"), nullable=False)
+    timeseries_id = db.Column(db.Integer(), nullable=False)
     # report_id  = db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "report.report_id"))
-    model_name =  db.Column(db.String(), db.ForeignKey(SCHEMA + "." + "model.model_name"), index=True, nullable=False)
+    model_name =  db.Column(db.String(), db.ForeignKey(SCHEMA + "." + "model.model_name"), index=True, nullable=False,
+                            primary_key=PARTITION_TABLES)
     variable_name =  db.Column(db.String(), db.ForeignKey(SCHEMA + "." + "variable.variable_name"), index=True, nullable=False)
     temporal_resolution = db.Column(db.String())
+    year = db.Column(db.Integer(), primary_key=PARTITION_TABLES)
     permission = db.Column(db.String())
     last_timeseries_update = db.Column(db.DateTime())
 
@@ -193,7 +291,8 @@ class Data(Base):
         "User", back_populates="data", cascade="save-update, merge, delete", foreign_keys="Data.user_id"
     )
     timeseries = relationship(
-        "Timeseries", back_populates="data", cascade="save-update, merge, delete", foreign_keys="Data.timeseries_id"
+        "Timeseries", back_populates="data", cascade="save-update, merge, delete",
+        foreign_keys="[" + ", ".join("Data." + col for col in DATA_TIMESERIES_FK_COLUMNS) + "]"
     )
     # report = relationship(
     # "Report", back_populates="data", cascade="save-update, merge, delete", foreign_keys="Data.report_id"
@@ -208,17 +307,183 @@ class Data(Base):
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
+class Period(Base):
+    """
+    Period dimension, one row per year/temporal_resolution/data_var
+    Timeseries rows reference their period instead of storing the start and end dates
+    """
+    __tablename__ = "period"
+    __table_args__ = (
+        db.UniqueConstraint("year", "temporal_resolution", "data_var"),
+        {"schema": SCHEMA}
+    )
+    period_id = db.Column(db.Integer(), primary_key=True)
+    year = db.Column(db.Integer(), nullable=False)
+    temporal_resolution = db.Column(db.String(), nullable=False)
+    data_var = db.Column(db.String(), nullable=False)
+    month = db.Column(db.Integer())
+    start_date = db.Column(db.DateTime(), index=True)
+    end_date = db.Column(db.DateTime())
+
+    timeseries = relationship(
+        "Timeseries", back_populates="period"
+    )
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
 class Timeseries(Base):
     __tablename__ = "timeseries"
-    __table_args__ = {"schema": SCHEMA}
-    timeseries_id = db.Column(db.Integer(), primary_key=True)
-    start_date = db.Column(db.DateTime())
-    end_date = db.Column(db.DateTime())
+    __table_args__ = PARTITION_TABLE_ARGS
+    timeseries_id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
+    model_name = db.Column(db.String(), primary_key=PARTITION_TABLES)
+    year = db.Column(db.Integer(), primary_key=PARTITION_TABLES)
+    period_id = db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "period.period_id"), index=True)
     data_value = db.Column(db.Float(precision=4))
 
     data = relationship(
         "Data", back_populates="timeseries", cascade="save-update, merge, delete"
     )
+    period = relationship(
+        "Period", back_populates="timeseries", foreign_keys="Timeseries.period_id"
+    )
+
+class TimeseriesArray(Base):
+    """
+    Compact alternative to the Data/Timeseries tables:
+    one row per feature/model/variable/temporal_resolution/year, the period values are
+    stored in data_values (monthly: index 1 = January, annual: single value)
+    """
+    __tablename__ = "timeseries_array"
+    __table_args__ = (
+        db.UniqueConstraint("feature_id", "model_name", "variable_name", "temporal_resolution", "year", "user_id"),
+        {"schema": SCHEMA}
+    )
+    timeseries_array_id = db.Column(db.Integer(), primary_key=True)
+    feature_id = db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "feature.feature_id"), nullable=False)
+    user_id =  db.Column(db.Integer(), db.ForeignKey(SCHEMA + "." + "user.user_id"), nullable=False)
+    model_name =  db.Column(db.String(), db.ForeignKey(SCHEMA + "." + "model.model_name"), index=True, nullable=False)
+    variable_name =  db.Column(db.String(), db.ForeignKey(SCHEMA + "." + "variable.variable_name"), index=True, nullable=False)
+    temporal_resolution = db.Column(db.String())
+    year = db.Column(db.Integer(), index=True)
+    permission = db.Column(db.String())
+    last_timeseries_update = db.Column(db.DateTime())
+    data_values = db.Column(postgresql.ARRAY(db.Float(precision=4)))
+
+    feature = relationship(
+        "Feature", back_populates="timeseries_arrays", cascade="save-update, merge, delete",
+        foreign_keys="TimeseriesArray.feature_id"
+    )
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class IngestCheckpoint(Base):
+    """
+    Manifest of the ingest chunks committed to the database, one row per chunk
+    Used to resume an ingest that died partway through
+    Note: timeseries rows counts the TimeseriesArray rows for the array storage layout
+    """
+    __tablename__ = "ingest_checkpoint"
+    __table_args__ = (
+        db.UniqueConstraint("feature_collection_name", "generation", "model_name", "year", "chunk_start", "chunk_end"),
+        {"schema": SCHEMA}
+    )
+    ingest_checkpoint_id = db.Column(db.Integer(), primary_key=True)
+    feature_collection_name = db.Column(db.String(), index=True, nullable=False)
+    generation = db.Column(db.Integer(), nullable=False, default=0, server_default="0")
+    model_name = db.Column(db.String(), nullable=False)
+    year = db.Column(db.Integer(), nullable=False)
+    chunk_start = db.Column(db.Integer(), nullable=False)
+    chunk_end = db.Column(db.Integer(), nullable=False)
+    num_features = db.Column(db.Integer())
+    num_timeseries_rows = db.Column(db.Integer())
+    num_data_rows = db.Column(db.Integer())
+    num_metadata_rows = db.Column(db.Integer())
+    status = db.Column(db.String())
+    last_update = db.Column(db.DateTime())
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class IngestJob(Base):
+    """
+    Queue of collection/model/year ingests, see queue_Util
+    status: queued, running, done or failed
+    worker: host:pid of the process running the job
+    """
+    __tablename__ = "ingest_job"
+    __table_args__ = (
+        db.UniqueConstraint("feature_collection_name", "model_name", "year"),
+        {"schema": SCHEMA}
+    )
+    ingest_job_id = db.Column(db.Integer(), primary_key=True)
+    feature_collection_name = db.Column(db.String(), nullable=False)
+    model_name = db.Column(db.String(), nullable=False)
+    year = db.Column(db.Integer(), nullable=False)
+    data_file_path = db.Column(db.String())
+    status = db.Column(db.String(), index=True, nullable=False)
+    attempts = db.Column(db.Integer(), default=0)
+    worker = db.Column(db.String())
+    error = db.Column(db.String())
+    queued = db.Column(db.DateTime())
+    started = db.Column(db.DateTime())
+    finished = db.Column(db.DateTime())
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def get_partition_name(table_name, model_name, year=None):
+    """
+    Name of the partition of table_name holding model_name (and year)
+    """
+    name = table_name + "_" + "".join(c if c.isalnum() else "_" for c in model_name.lower())
+    if year is not None:
+        name += "_" + str(year)
+    return name
+
+
+def create_partitions_ddl(table_name, model_name, years):
+    """
+    DDL statements creating the model partition of table_name,
+    sub-partitioned by year, with a default partition for years not listed
+    """
+    model_partition = get_partition_name(table_name, model_name)
+    stmts = [
+        "CREATE TABLE IF NOT EXISTS %s.%s PARTITION OF %s.%s FOR VALUES IN ('%s') PARTITION BY RANGE (year)"
+        % (SCHEMA, model_partition, SCHEMA, table_name, model_name),
+        "CREATE TABLE IF NOT EXISTS %s.%s_default PARTITION OF %s.%s DEFAULT"
+        % (SCHEMA, model_partition, SCHEMA, model_partition)
+    ]
+    for year in years:
+        stmts.append(
+            "CREATE TABLE IF NOT EXISTS %s.%s PARTITION OF %s.%s FOR VALUES FROM (%s) TO (%s)"
+            % (SCHEMA, get_partition_name(table_name, model_name, year), SCHEMA, model_partition,
+               int(year), int(year) + 1)
+        )
+    return stmts
+
+
+def create_partitions(target, connection, **kw):
+    """
+    Called after the data and timeseries tables are created:
+    one partition per model in config.statics["models"],
+    sub-partitioned by the years in valid_year_range of the model
+    """
+    for model_name in config.statics["models"].keys():
+        year_range = config.statics["models"][model_name]["valid_year_range"]
+        years = range(int(year_range[0]), int(year_range[1]) + 1)
+        for stmt in create_partitions_ddl(target.name, model_name, years):
+            connection.execute(stmt)
+    connection.execute("CREATE TABLE IF NOT EXISTS %s.%s_default PARTITION OF %s.%s DEFAULT"
+                       % (SCHEMA, target.name, SCHEMA, target.name))
+
+
+if PARTITION_TABLES:
+    event.listen(Data.__table__, "after_create", create_partitions)
+    event.listen(Timeseries.__table__, "after_create", create_partitions)
 
 """
 class Parameters(Base):
@@ -247,6 +512,154 @@ class Report(Base):
     report_id = db.Column(db.Integer(), primary_key=True)
 """
 
+# Columns and PGCOPY types of the bulk ingested tables
+TIMESERIES_COPY_COLUMNS = ("timeseries_id", "model_name", "year", "period_id", "data_value")
+TIMESERIES_COPY_TYPES = ("int4", "text", "int4", "int4", "float4")
+DATA_COPY_COLUMNS = ("feature_id", "user_id", "timeseries_id",
+                     "model_name", "variable_name", "temporal_resolution", "year",
+                     "permission", "last_timeseries_update")
+DATA_COPY_TYPES = ("int4", "int4", "int4", "text", "text", "text", "int4", "text", "timestamp")
+# WKB headers (little endian) of the geometries written by geojson_to_multipolygon_wkb
+WKB_MULTIPOLYGON = struct.pack("<BI", 1, 6)
+WKB_POLYGON = struct.pack("<BI", 1, 3)
+
+
+def geojson_to_multipolygon_wkb(geometries):
+    """
+    Convert the geojson geometries of a chunk to MultiPolygon WKB in one pass,
+    without shapely objects: the coordinates of all geometries go into one numpy
+    array that is packed to doubles at once, the WKB is assembled from slices of it
+    Polygons are promoted to multi polygons, z values are dropped
+    Geometries that already carry their WKB (see database_Util.read_features_from_ogr) are passed through
+    :param geometries: list of geojson geometries
+    :return: list of WKB strings, None for geometries that are not (multi) polygons
+    """
+    coords = []
+    layouts = []
+    for geometry in geometries:
+        if "wkb" in geometry:
+            layouts.append([geometry["wkb"]])
+            continue
+        if geometry["type"] == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            layouts.append(None)
+            continue
+        # header bytes and (start, end) coordinate index ranges
+        layout = [WKB_MULTIPOLYGON + struct.pack("<I", len(polygons))]
+        for polygon in polygons:
+            layout.append(WKB_POLYGON + struct.pack("<I", len(polygon)))
+            for ring in polygon:
+                layout.append(struct.pack("<I", len(ring)))
+                start = len(coords)
+                # z values can be given for some points only
+                coords.extend(pt[:2] for pt in ring)
+                layout.append((start, len(coords)))
+        layouts.append(layout)
+    coord_bytes = np.asarray(coords, dtype="<f8").reshape(-1, 2).tostring()
+    wkbs = []
+    for layout in layouts:
+        if layout is None:
+            wkbs.append(None)
+            continue
+        wkbs.append("".join(
+            part if isinstance(part, str) else coord_bytes[part[0] * 16:part[1] * 16] for part in layout
+        ))
+    return wkbs
+
+
+def multipolygon_wkb_coordinates(wkb):
+    """
+    Coordinates of a little endian 2D MultiPolygon WKB, as written by geojson_to_multipolygon_wkb
+    :param wkb: WKB string
+    :return: geojson MultiPolygon coordinates (list of polygons, lists of rings, lists of [x, y])
+    """
+    num_polygons = struct.unpack_from("<I", wkb, 5)[0]
+    offset = 9
+    polygons = []
+    for p in range(num_polygons):
+        num_rings = struct.unpack_from("<I", wkb, offset + 5)[0]
+        offset += 9
+        rings = []
+        for r in range(num_rings):
+            num_points = struct.unpack_from("<I", wkb, offset)[0]
+            offset += 4
+            rings.append(np.frombuffer(wkb, dtype="<f8", count=num_points * 2, offset=offset).reshape(-1, 2).tolist())
+            offset += num_points * 16
+        polygons.append(rings)
+    return polygons
+
+
+def normalize_polygon_geometry(geometry, precision=9):
+    """
+    Canonical geojson MultiPolygon of a (multi) polygon, two geometries covering
+    the same area the same way get the same coordinates: z values are dropped and
+    coordinates rounded, exterior rings are counterclockwise and holes clockwise,
+    every ring starts at its smallest point, holes and polygons are sorted
+    :param geometry: geojson geometry
+    :param precision: number of decimals the coordinates are rounded to
+    :return: geojson MultiPolygon, the geometry itself if it is not a (multi) polygon
+    """
+    if "wkb" in geometry:
+        polygons = multipolygon_wkb_coordinates(geometry["wkb"])
+    elif geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return geometry
+
+    def normalize_ring(ring, clockwise):
+        points = [(round(pt[0], precision), round(pt[1], precision)) for pt in ring]
+        if len(points) > 1 and points[0] == points[-1]:
+            points = points[:-1]
+        if not points:
+            return []
+        # shoelace formula, positive for counterclockwise rings
+        area = sum(
+            points[i - 1][0] * points[i][1] - points[i][0] * points[i - 1][1] for i in range(len(points))
+        )
+        if (area < 0) != clockwise:
+            points.reverse()
+        start = points.index(min(points))
+        points = points[start:] + points[:start]
+        return [list(pt) for pt in points + points[:1]]
+
+    normalized = []
+    for polygon in polygons:
+        if not polygon:
+            continue
+        rings = [normalize_ring(polygon[0], False)]
+        rings.extend(sorted(normalize_ring(ring, True) for ring in polygon[1:]))
+        normalized.append(rings)
+    normalized.sort()
+    return {"type": "MultiPolygon", "coordinates": normalized}
+
+
+def decimals_to_floats(value):
+    """
+    Copy of a parsed json value with the Decimal numbers converted to float,
+    streamed features then look the same as the ones read with geojson.load
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, list):
+        return [decimals_to_floats(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, decimals_to_floats(v)) for k, v in value.items())
+    return value
+
+
+# Tables written by add_data_to_db, their secondary indexes and foreign keys
+# are dropped during a bulk load (see database_Util.bulk_load_data_to_db)
+# Note: the feature table is read during ingest and keeps its indexes
+BULK_LOAD_TABLES = ["timeseries", "data", "timeseries_array"]
+TIMESERIES_ARRAY_COPY_COLUMNS = ("feature_id", "user_id", "model_name", "variable_name",
+                                 "temporal_resolution", "year", "permission",
+                                 "last_timeseries_update", "data_values")
+
 #######################################
 # END OpenET database Utility class
 #######################################
@@ -261,7 +674,10 @@ class database_Util(object):
         -
     """
     def __init__(self, model, year, variables, engine, user_id, feature_collection_name,
-                 data_file_path, download_method, features_change_by_year = False):
+                 data_file_path, download_method, features_change_by_year = False,
+                 stream_features = False, copy_format = "csv", storage_layout = "rows",
+                 dedupe_geometries = False, adaptive_chunks = False, metrics_file = None,
+                 bucket_cache_dir = None, years = None, generation = None):
         '''
 
         :param model: ET Model name
@@ -274,6 +690,21 @@ class database_Util(object):
         :param zonal_stats_file: file name of the file that contains the precomputed zonal stats
         :param bucket_path: path to bucket where data_file is stored
         :param features_yange_by_year: True if the feature geometries in the collection change by year
+        :param stream_features: True if features are parsed incrementally from the data file
+               instead of loading the whole featureCollection into memory (needs ijson)
+        :param copy_format: "csv" or "binary", format used to COPY timeseries and data rows
+        :param storage_layout: "rows" (Data/Timeseries tables) or "arrays" (TimeseriesArray table)
+        :param dedupe_geometries: True if identical geometries are stored once in the FeatureGeometry table,
+               saves storage for collections that change by year
+        :param adaptive_chunks: True if add_data_to_db grows or shrinks the chunk size while it runs,
+               based on memory use (RSS) and throughput, see chunk_Util
+        :param metrics_file: path of the file the per chunk stage timings of add_data_to_db
+               are appended to as JSON lines, see metrics_Util
+        :param bucket_cache_dir: directory of the local copies of the bucket files, see bucket_Util
+        :param years: years add_data_to_db loads in a single pass over the features, default: [year]
+               the data values are read from {var}_{YYYY}_{MM} and {var}_{YYYY} properties (see etdata2shape)
+        :param generation: generation of the collection's features that is read and written,
+               default: the generation served to the queries, see reload_collection
         '''
         self.model = model
         self.year = int(year)
@@ -285,7 +716,17 @@ class database_Util(object):
         self.data_file_path = data_file_path
         self.download_method = download_method
         self.features_change_by_year = features_change_by_year
-
+        self.stream_features = stream_features
+        self.copy_format = copy_format
+        self.storage_layout = storage_layout
+        self.dedupe_geometries = dedupe_geometries
+        self.adaptive_chunks = adaptive_chunks
+        self.metrics_file = metrics_file
+        self.bucket_cache_dir = bucket_cache_dir
+        if years is None:
+            years = [self.year]
+        self.years = [int(y) for y in years]
+        self.generation = generation
 
     def object_as_dict(self, obj):
         """
@@ -368,15 +809,216 @@ class database_Util(object):
     def read_data_from_bucket(self, url):
         """
         All geometry data are stored in cloud buckets
+        The file is downloaded to the local cache first, see bucket_Util
         :return:
         """
+        bucket = bucket_Util(self.bucket_cache_dir)
         try:
-            d = geojson.load(urllib2.urlopen(url))
-        except Exception as e:
-            logging.error(e)
-            raise Exception(e)
-        return d
+            return self.read_data_from_local(bucket.fetch(url))
+        finally:
+            bucket.cleanup()
 
+    def stream_features_from_local(self, data_file_path):
+        '''
+        Parse the features of a geojson featureCollection one at a time
+        so that the whole collection is never held in memory
+        :param data_file_path:
+        :return: generator of geojson features
+        '''
+        if ijson is None:
+            raise Exception("ijson is needed to stream features, run pip install ijson")
+        with open(data_file_path, 'rb') as f:
+            # ijson 2.x (python 2) parses non integer numbers as Decimal
+            for feature in ijson.items(f, 'features.item'):
+                yield decimals_to_floats(feature)
+
+    def stream_features_from_bucket(self, url):
+        '''
+        Parse the features of a geojson featureCollection stored in a cloud bucket
+        one at a time from the local copy of the file, see bucket_Util
+        :param url:
+        :return: generator of geojson features
+        '''
+        bucket = bucket_Util(self.bucket_cache_dir)
+        try:
+            for feature in self.stream_features_from_local(bucket.fetch(url)):
+                yield feature
+        finally:
+            bucket.cleanup()
+
+    def get_ogr_field_map(self, layer_defn):
+        '''
+        Map the shapefile/GeoPackage fields to the geojson property names used by the ingest
+        ET fields written by etdata2shape.write_shapefile (et_YYYY_MM, et_YYYY) keep their names
+        if more than one year is loaded (see get_data_value), for a single year they are renamed:
+        et_YYYY_MM -> et_mMM, et_YYYY -> et_annual
+        ET fields of years that are not loaded are left out
+        :param layer_defn: ogr layer definition
+        :return: list of (field index, property name)
+        '''
+        field_map = []
+        for i in range(layer_defn.GetFieldCount()):
+            field_name = layer_defn.GetFieldDefn(i).GetName()
+            match = re.match(r"^([A-Za-z]+)_(\d{4})(?:_(\d{2}))?$", field_name)
+            if match is None:
+                field_map.append((i, field_name))
+                continue
+            var, year, month = match.groups()
+            if int(year) not in self.years:
+                continue
+            if len(self.years) > 1:
+                field_map.append((i, field_name))
+            elif month is None:
+                field_map.append((i, var + "_annual"))
+            else:
+                field_map.append((i, var + "_m" + month))
+        return field_map
+
+    def read_features_from_ogr(self, data_file_path):
+        '''
+        Read the features of a shapefile or GeoPackage, see read_features_from_ogr_file
+        :param data_file_path: .shp or .gpkg file
+               Note: a shapefile from a bucket must be a zip file (.shp.zip) with its .dbf/.shx/.prj
+        :return: generator of geojson features
+        '''
+        if self.download_method != 'from_bucket':
+            for feature in self.read_features_from_ogr_file(data_file_path):
+                yield feature
+            return
+        bucket = bucket_Util(self.bucket_cache_dir)
+        try:
+            local_path = bucket.fetch(data_file_path)
+            if data_file_path.lower().endswith('.zip'):
+                local_path = '/vsizip/' + local_path
+            for feature in self.read_features_from_ogr_file(local_path):
+                yield feature
+        finally:
+            bucket.cleanup()
+
+    def read_features_from_ogr_file(self, data_file_path):
+        '''
+        Read the features of a shapefile or GeoPackage one at a time, no geojson file needed
+        Geometries are transformed to EPSG:4326 if the layer has another projection
+        Note: shapefile field names are cut at 10 characters, use GeoPackages for ndvi_YYYY_MM fields
+        :param data_file_path: local .shp or .gpkg file, or /vsizip/ path of a zipped shapefile
+        :return: generator of geojson features, the geometries of (multi) polygons are
+                 {"type": "Polygon" or "MultiPolygon", "wkb": 2D MultiPolygon WKB} instead of coordinates,
+                 see geojson_to_multipolygon_wkb
+        '''
+        if ogr is None:
+            raise Exception("GDAL/OGR is needed to read shapefiles and GeoPackages")
+        data_source = ogr.Open(data_file_path, 0)
+        if data_source is None:
+            raise Exception("Could not open " + data_file_path)
+        layer = data_source.GetLayer(0)
+        field_map = self.get_ogr_field_map(layer.GetLayerDefn())
+        # Don't read the fields we don't need
+        needed = set(i for i, prop in field_map)
+        layer_defn = layer.GetLayerDefn()
+        ignored = [
+            layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount()) if i not in needed
+        ]
+        if ignored:
+            layer.SetIgnoredFields(ignored)
+
+        transform = None
+        source_srs = layer.GetSpatialRef()
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromEPSG(4326)
+        if hasattr(target_srs, "SetAxisMappingStrategy"):
+            target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if source_srs is not None and not source_srs.IsSame(target_srs):
+            transform = osr.CoordinateTransformation(source_srs, target_srs)
+
+        geometry_types = {ogr.wkbPolygon: "Polygon", ogr.wkbMultiPolygon: "MultiPolygon"}
+        for ogr_feature in layer:
+            geom = ogr_feature.GetGeometryRef()
+            if transform is not None:
+                geom.Transform(transform)
+            geometry_type = geometry_types.get(ogr.GT_Flatten(geom.GetGeometryType()))
+            if geometry_type is None:
+                # Rejected by the ingest like other geojson geometries that are not (multi) polygons
+                geometry = json.loads(geom.ExportToJson())
+            else:
+                # WKB goes to the database as is, no geojson coordinates are built
+                geom = ogr.ForceToMultiPolygon(geom)
+                geom.FlattenTo2D()
+                geometry = {"type": geometry_type, "wkb": str(geom.ExportToWkb(ogr.wkbNDR))}
+            yield {
+                "type": "Feature",
+                "properties": dict((prop, ogr_feature.GetField(i)) for i, prop in field_map),
+                "geometry": geometry
+            }
+        data_source = None
+
+    def get_features(self, geojson_data=None):
+        '''
+        Get the features to be ingested
+        :param geojson_data: geojson featureCollection, if None, data is read
+               from self.data_file_path, shapefiles (.shp) and GeoPackages (.gpkg) are read directly
+        :return: list or generator of geojson features
+        '''
+        if geojson_data is not None:
+            return geojson_data["features"]
+        if self.data_file_path.lower().endswith((".shp", ".shp.zip", ".gpkg")):
+            return self.read_features_from_ogr(self.data_file_path)
+        # FIXME eventually we should be able to just read from one location
+        if self.stream_features:
+            if self.download_method == 'from_bucket':
+                return self.stream_features_from_bucket(self.data_file_path)
+            return self.stream_features_from_local(self.data_file_path)
+        if self.download_method == 'from_bucket':
+            geojson_data = self.read_data_from_bucket(self.data_file_path)
+        else:
+            geojson_data = self.read_data_from_local(self.data_file_path)
+        return geojson_data["features"]
+
+    def get_feature_chunks(self, features, chunk_size):
+        '''
+        Group features into lists of at most chunk_size features
+        :param features: list or generator of geojson features
+        :param chunk_size: int or chunk_Util, the size of a chunk_Util is read at the start of each chunk
+        :return: generator of feature lists
+        '''
+        chunk_features = []
+        for feature in features:
+            chunk_features.append(feature)
+            if isinstance(chunk_size, chunk_Util):
+                size = chunk_size.chunk_size
+            else:
+                size = chunk_size
+            if len(chunk_features) >= size:
+                yield chunk_features
+                chunk_features = []
+        if chunk_features:
+            yield chunk_features
+
+    def get_numbered_chunks(self, features, chunk_size):
+        '''
+        Group features into chunks, see get_feature_chunks
+        :param features: list or generator of geojson features
+        :param chunk_size: int or chunk_Util
+        :return: generator of (chunk number starting at 1, index of the first feature, feature list)
+        '''
+        idx_start = 0
+        for chunk, chunk_features in enumerate(self.get_feature_chunks(features, chunk_size), start=1):
+            yield chunk, idx_start, chunk_features
+            idx_start += len(chunk_features)
+
+    def put_chunk(self, chunk_queue, numbered_chunk, workers):
+        '''
+        Put a chunk on the queue of add_data_to_db_parallel, waits while the queue is full
+        :param chunk_queue: multiprocessing.Queue read by the workers
+        :param numbered_chunk: (chunk, idx_start, chunk_features) or None to stop a worker
+        :param workers: worker processes, raises if none of them is left to read the queue
+        '''
+        while True:
+            try:
+                chunk_queue.put(numbered_chunk, timeout=1)
+                return
+            except Queue.Full:
+                if not any(worker.is_alive() for worker in workers):
+                    raise Exception("All ingest workers exited, chunks are left")
 
     def add_in_chunks(self, entity_list, session):
         ent_len = len(entity_list)
@@ -414,10 +1056,27 @@ class database_Util(object):
         print("Table {} exists: {}".format(table_name, ret))
         return ret
 
+    def get_generation(self):
+        """
+        Generation of the collection's features this instance reads and writes,
+        the active generation in FeatureCollection unless set at init (0 before the first reload)
+        """
+        if self.generation is None:
+            self.generation = 0
+            if self.engine.dialect.has_table(self.conn, "feature_collection", schema=SCHEMA):
+                sql = sqa.text(
+                    "SELECT generation FROM %s.feature_collection WHERE feature_collection_name = :feature_collection_name"
+                    % SCHEMA)
+                generation = self.conn.execute(sql, feature_collection_name=self.feature_collection_name).scalar()
+                if generation is not None:
+                    self.generation = generation
+        return self.generation
+
     def check_if_features_in_db(self, year, session):
         num_features = config.statics["feature_collections"][self.feature_collection_name]["num_features"]
         feature_query = session.query(Feature).filter(
             Feature.feature_collection_name == self.feature_collection_name,
+            Feature.generation == self.get_generation(),
             Feature.year == year
         )
         cnt = feature_query.count()
@@ -452,10 +1111,35 @@ class database_Util(object):
             in_db = False
         return in_db
 
+    def check_if_model_data_in_db(self, session):
+        """
+        True if the features of the collection have data of self.model for self.year
+        """
+        if self.storage_layout == "arrays":
+            data_table = "timeseries_array"
+        else:
+            data_table = "data"
+        sql = sqa.text("""
+            SELECT EXISTS (
+                SELECT 1 FROM %s.%s AS data
+                JOIN %s.feature AS feature ON feature.feature_id = data.feature_id
+                WHERE feature.feature_collection_name = :feature_collection_name
+                AND feature.generation = :generation
+                AND data.model_name = :model_name
+                AND data.year = :year
+            )
+        """ % (SCHEMA, data_table, SCHEMA))
+        return session.execute(sql, {
+            "feature_collection_name": self.feature_collection_name,
+            "generation": self.get_generation(),
+            "model_name": self.model,
+            "year": self.year
+        }).scalar()
 
     def check_if_feature_in_db(self, feature_collection_name, feature_id_from_user, feature_year, session):
         feature_query = session.query(Feature).filter(
             Feature.feature_collection_name == feature_collection_name,
+            Feature.generation == self.get_generation(),
             Feature.feature_id_from_user == feature_id_from_user,
             Feature.year == feature_year
         )
@@ -470,6 +1154,152 @@ class database_Util(object):
         feature_id = feature.feature_id
         return feature_id
 
+    def get_committed_chunks(self, session):
+        """
+        Feature index ranges of the chunks of this collection/model/year already committed
+        :return: set of (chunk_start, chunk_end) feature indices, chunk_end exclusive
+        """
+        checkpoint_query = session.query(IngestCheckpoint.chunk_start, IngestCheckpoint.chunk_end).filter(
+            IngestCheckpoint.feature_collection_name == self.feature_collection_name,
+            IngestCheckpoint.generation == self.get_generation(),
+            IngestCheckpoint.model_name == self.model,
+            IngestCheckpoint.year == self.year,
+            IngestCheckpoint.status == "committed"
+        )
+        return set((chunk_start, chunk_end) for chunk_start, chunk_end in checkpoint_query)
+
+    def get_num_committed_features(self, committed_chunks):
+        """
+        Number of features covered by the committed chunks, overlapping chunks are counted once
+        :param committed_chunks: see get_committed_chunks
+        """
+        num_features = 0
+        covered_end = 0
+        for chunk_start, chunk_end in sorted(committed_chunks):
+            chunk_start = max(chunk_start, covered_end)
+            if chunk_end > chunk_start:
+                num_features += chunk_end - chunk_start
+                covered_end = chunk_end
+        return num_features
+
+    def chunk_is_committed(self, chunk_range, committed_chunks):
+        """
+        True if the chunk lies inside a committed chunk
+        Chunk boundaries differ between runs with adaptive chunk sizes, partly committed chunks
+        are ingested again and the features that already have data are skipped
+        :param chunk_range: (chunk_start, chunk_end)
+        :param committed_chunks: see get_committed_chunks
+        """
+        for chunk_start, chunk_end in committed_chunks:
+            if chunk_start <= chunk_range[0] and chunk_range[1] <= chunk_end:
+                return True
+        return False
+
+    def add_checkpoint(self, session, chunk_start, chunk_end, row_counts):
+        """
+        Record a chunk as committed, must be called in the transaction that commits the chunk
+        :param chunk_start: index of first feature in chunk
+        :param chunk_end: index of last feature in chunk + 1
+        :param row_counts: dict with num_features, num_timeseries_rows, num_data_rows, num_metadata_rows
+        """
+        checkpoint = dict(row_counts)
+        checkpoint.update({
+            "feature_collection_name": self.feature_collection_name,
+            "generation": self.get_generation(),
+            "model_name": self.model,
+            "year": self.year,
+            "chunk_start": chunk_start,
+            "chunk_end": chunk_end,
+            "status": "committed",
+            "last_update": dt.datetime.today()
+        })
+        session.execute(IngestCheckpoint.__table__.insert().values(checkpoint))
+
+    def clear_checkpoints(self, session):
+        """
+        Forget the committed chunks of this collection/model/year,
+        needed before reloading data that was deleted from the database
+        """
+        session.query(IngestCheckpoint).filter(
+            IngestCheckpoint.feature_collection_name == self.feature_collection_name,
+            IngestCheckpoint.generation == self.get_generation(),
+            IngestCheckpoint.model_name == self.model,
+            IngestCheckpoint.year == self.year
+        ).delete(synchronize_session=False)
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+    def get_feature_id_from_user(self, g_data, feat_idx):
+        """
+        feature_id_from user is set to feature_index in featCollection if user didn"t give it
+        :param g_data: geojson feature
+        :param feat_idx: index of feature in featCollection, starting at 1
+        :return:
+        """
+        if "feature_id_from_user" in g_data["properties"].keys():
+            return str(g_data["properties"]["feature_id_from_user"])
+        return str(feat_idx)
+
+    def get_feature_ids_in_db(self, feature_ids_from_user, feature_year, session):
+        """
+        Bulk version of check_if_feature_in_db for all features of an ingest chunk
+        :param feature_ids_from_user: list of feature_id_from_user
+        :param feature_year:
+        :param session:
+        :return: dict {feature_id_from_user: feature_id}
+        """
+        if not feature_ids_from_user:
+            return {}
+        feature_query = session.query(Feature.feature_id_from_user, Feature.feature_id).filter(
+            Feature.feature_collection_name == self.feature_collection_name,
+            Feature.generation == self.get_generation(),
+            Feature.year == feature_year,
+            Feature.feature_id_from_user.in_(feature_ids_from_user)
+        )
+        feature_ids = {}
+        duplicates = set()
+        for feature_id_from_user, feature_id in feature_query:
+            if feature_id_from_user in feature_ids:
+                duplicates.add(feature_id_from_user)
+            feature_ids[feature_id_from_user] = feature_id
+        for feature_id_from_user in duplicates:
+            msg = "Multiple geometries for " + self.feature_collection_name + "/" +\
+                  str(feature_id_from_user)
+            logging.error(msg)
+            del feature_ids[feature_id_from_user]
+        return feature_ids
+
+    def get_feature_ids_with_data_in_db(self, feature_ids, session):
+        """
+        Bulk version of check_if_data_in_db for all features of an ingest chunk
+        Only data for self.year is considered
+        :param feature_ids: list of Feature.feature_id primary keys
+        :param session:
+        :return: set of feature_ids that have data in db
+        """
+        if not feature_ids:
+            return set()
+        if self.storage_layout == "arrays":
+            data_query = session.query(TimeseriesArray.feature_id).filter(
+                TimeseriesArray.feature_id.in_(feature_ids),
+                TimeseriesArray.user_id == self.user_id,
+                TimeseriesArray.model_name == self.model,
+                TimeseriesArray.year == self.year
+            ).distinct()
+            return set(row[0] for row in data_query)
+        data_query = session.query(Data.feature_id, db.func.count(Data.data_id)).join(
+            Timeseries, Timeseries.timeseries_id == Data.timeseries_id
+        ).filter(
+            Data.feature_id.in_(feature_ids),
+            Data.user_id == self.user_id,
+            Data.model_name == self.model,
+            Timeseries.year == self.year
+        ).group_by(Data.feature_id)
+        return set(feature_id for feature_id, cnt in data_query if cnt > 1)
+
     def get_last_timeseries_id(self, session):
         try:
             ts_id = session.query(Timeseries).order_by(Timeseries.timeseries_id.desc()).first().timeseries_id
@@ -487,6 +1317,20 @@ class database_Util(object):
             postgis_geom = from_shape(shapely_geom)
         return postgis_geom
 
+    def get_postgis_geometries(self, geometries):
+        """
+        Batch version of set_postgis_geometry for the geojson geometries of a chunk,
+        see geojson_to_multipolygon_wkb
+        :param geometries: list of geojson geometries
+        :return: list of WKBElements (multi polygons)
+        """
+        postgis_geoms = []
+        for wkb in geojson_to_multipolygon_wkb(geometries):
+            if wkb is None:
+                raise Exception("Not a valid geometry, must be polygon or multi polygon!")
+            postgis_geoms.append(WKBElement(buffer(wkb)))
+        return postgis_geoms
+
     def set_feature_entity(self, feature_id_from_user, geom_type, postgis_geometry, year):
         """
         Adds the geometry row to database and retrieves the automatically
@@ -499,10 +1343,162 @@ class database_Util(object):
             feature_id_from_user = feature_id_from_user,
             type = geom_type,
             year = int(year),
-            geometry = postgis_geometry
+            geometry = postgis_geometry,
+            generation = self.get_generation()
         )
         return feature
 
+    def get_geometry_hashes(self, geojson_geometries):
+        """
+        Content hashes of geojson geometries: md5 of the WKB of the normalized
+        geometry (see normalize_polygon_geometry), so float formatting, ring start
+        point and orientation do not defeat the dedupe; no shapely conversion needed
+        :param geojson_geometries: list of geojson geometries
+        :return: list of hex digests
+        """
+        normalized = [normalize_polygon_geometry(geometry) for geometry in geojson_geometries]
+        hashes = []
+        for geometry, wkb in zip(normalized, geojson_to_multipolygon_wkb(normalized)):
+            if wkb is None:
+                # Not a (multi) polygon
+                wkb = json.dumps(geometry, sort_keys=True)
+            hashes.append(hashlib.md5(wkb).hexdigest())
+        return hashes
+
+    def get_geometry_ids(self, session, geometry_hashes):
+        """
+        :param geometry_hashes: list of geometry hashes
+        :return: dict {geometry_hash: geometry_id} of the hashes found in FeatureGeometry
+        """
+        if not geometry_hashes:
+            return {}
+        geometry_query = session.query(FeatureGeometry.geometry_hash, FeatureGeometry.geometry_id).filter(
+            FeatureGeometry.geometry_hash.in_(list(geometry_hashes))
+        )
+        return dict((geometry_hash, geometry_id) for geometry_hash, geometry_id in geometry_query)
+
+    def add_geometries_to_db(self, session, geometries):
+        """
+        Add the geometries that are not in the FeatureGeometry table yet,
+        only those are converted to postgis geometries
+        :param session:
+        :param geometries: dict {geometry_hash: geojson geometry}
+        :return: dict {geometry_hash: geometry_id}
+        """
+        geometry_ids = self.get_geometry_ids(session, geometries.keys())
+        new_hashes = [geometry_hash for geometry_hash in geometries.keys() if geometry_hash not in geometry_ids]
+        postgis_geoms = self.get_postgis_geometries([geometries[geometry_hash] for geometry_hash in new_hashes])
+        geometry_rows = [
+            {"geometry_hash": geometry_hash, "geometry": postgis_geom}
+            for geometry_hash, postgis_geom in zip(new_hashes, postgis_geoms)
+        ]
+        if geometry_rows:
+            geometry_table = FeatureGeometry.__table__
+            stmt = postgresql.insert(geometry_table).values(geometry_rows).on_conflict_do_nothing(
+                index_elements=["geometry_hash"]
+            ).returning(geometry_table.c.geometry_hash, geometry_table.c.geometry_id)
+            geometry_ids.update(dict((h, g_id) for h, g_id in session.execute(stmt)))
+            # Geometries added by another loader in the meantime are not returned
+            missing = [h for h in geometries.keys() if h not in geometry_ids]
+            geometry_ids.update(self.get_geometry_ids(session, missing))
+        return geometry_ids
+
+    def set_feature_row(self, feature_id_from_user, geom_type, postgis_geometry, year, feature_properties=None):
+        """
+        Same as set_feature_entity but returns the column values
+        for a bulk insert of many features (see add_features_to_db)
+        """
+        return {
+            "feature_collection_name": self.feature_collection_name,
+            "feature_id_from_user": feature_id_from_user,
+            "type": geom_type,
+            "year": int(year),
+            "geometry": postgis_geometry,
+            "feature_properties": feature_properties,
+            "generation": self.get_generation()
+        }
+
+    def add_features_to_db(self, session, feature_rows, user_ids):
+        """
+        Insert many features with a single INSERT ... RETURNING statement
+        and add the many-to-many relationship between users and the new features
+        Features inserted by another loader in the meantime (e.g. the shared year 9999
+        features of a collection loaded for two years at once) are left alone and looked up
+        Note: nothing is committed, the features are committed with the chunk data
+        :param session:
+        :param feature_rows: list of feature column dicts of one year, see set_feature_row
+        :param user_ids: user ids associated with the feature_collection
+        :return: dict {feature_id_from_user: feature_id}
+        """
+        if not feature_rows:
+            return {}
+        feature_table = Feature.__table__
+        stmt = postgresql.insert(feature_table).values(feature_rows).on_conflict_do_nothing(
+            index_elements=["feature_collection_name", "feature_id_from_user", "year", "generation"]
+        ).returning(
+            feature_table.c.feature_id_from_user, feature_table.c.feature_id
+        )
+        feature_ids = dict((fid_from_user, feature_id) for fid_from_user, feature_id in session.execute(stmt))
+        # (user_id, feature_id pairs)
+        uid_feat_pairs = [(user_id, feature_id) for feature_id in feature_ids.values() for user_id in user_ids]
+        if uid_feat_pairs:
+            session.execute(FeatureUserLink.insert().values(uid_feat_pairs))
+        self.set_geometry_columns(session, feature_ids.values())
+        missing = [row["feature_id_from_user"] for row in feature_rows if row["feature_id_from_user"] not in feature_ids]
+        if missing:
+            feature_ids.update(self.get_feature_ids_in_db(missing, feature_rows[0]["year"], session))
+        return feature_ids
+
+    def set_geometry_columns(self, session, feature_ids=None, all_collections=False):
+        """
+        Compute the columns derived from the feature geometry once at ingest:
+        geodesic area in square meters, bounding box, centroid and the geometry
+        simplified with config.statics["simplify_tolerance"] (degrees)
+        Note: nothing is committed
+        :param session:
+        :param feature_ids: list of feature ids,
+               if None, all features of the collection and year without an area are updated
+        :param all_collections: update the features without an area of all collections, see migrate_geometry_columns
+        """
+        sql_params = {
+            "tolerance": config.statics.get("simplify_tolerance", 0.0001)
+        }
+        if all_collections:
+            feature_filter = "feature.area IS NULL"
+        elif feature_ids is None:
+            sql_params.update({
+                "feature_collection_name": self.feature_collection_name,
+                "feature_year": self.get_feature_year(),
+                "generation": self.get_generation()
+            })
+            feature_filter = """
+                feature.feature_collection_name = :feature_collection_name
+                AND feature.generation = :generation
+                AND feature.year = :feature_year
+                AND feature.area IS NULL
+            """
+        else:
+            feature_ids = list(feature_ids)
+            if not feature_ids:
+                return
+            feature_filter = "feature.feature_id = ANY(CAST(:feature_ids AS integer[]))"
+            sql_params["feature_ids"] = feature_ids
+        sql = sqa.text("""
+            UPDATE %s.feature AS f SET
+            area = ST_Area(geography(g.geom)),
+            bbox = ST_Envelope(g.geom),
+            centroid = ST_Centroid(g.geom),
+            geometry_simplified = ST_Multi(ST_SimplifyPreserveTopology(g.geom, :tolerance))
+            FROM (
+                SELECT feature.feature_id, COALESCE(feature.geometry, feature_geometry.geometry) AS geom
+                FROM %s.feature AS feature
+                LEFT JOIN %s.feature_geometry AS feature_geometry ON feature_geometry.geometry_id = feature.geometry_id
+                WHERE %s
+            ) AS g
+            WHERE f.feature_id = g.feature_id
+        """ % (SCHEMA, SCHEMA, SCHEMA, feature_filter))
+        session.execute(sql, sql_params)
+
     def add_entity_to_db(self, session, entity):
         """
         Add single entity to db
@@ -532,6 +1528,275 @@ class database_Util(object):
             raise
 
 
+    def copy_from_buffer(self, cursor, buf, table_name, cols, sep=","):
+        """
+        Bulk copy the rows written to an in-memory csv buffer into a table
+        :param cursor: DBAPI cursor
+        :param buf: StringIO buffer holding comma separated rows
+        :param table_name:
+        :param cols: table columns in the order they appear in the rows
+        :param sep: column separator
+        :return: True if rows were copied, False if the buffer is empty
+        """
+        if buf.tell() == 0:
+            return False
+        buf.seek(0)
+        cursor.copy_from(buf, table_name, sep=sep, columns=cols)
+        return True
+
+    def add_partitions(self, session, years=None):
+        """
+        Make sure the data and timeseries partitions for self.model and years exist
+        Years outside of the model's valid_year_range are not created with the schema,
+        their rows may already sit in a default partition: postgres refuses to create
+        a partition while the default partition holds rows for it, so they are moved
+        out first and copied back into the new partitions, all in one transaction
+        Called once by the parent process, not by the add_data_to_db_parallel workers
+        :param years: default: self.years
+        """
+        if years is None:
+            years = self.years
+        # Ingests of other collections may create the same partitions
+        session.execute(sqa.text("SELECT pg_advisory_xact_lock(hashtext('openet_add_partitions'))"))
+        regclass_sql = sqa.text("SELECT to_regclass(:table_name)")
+        missing = {}
+        for table_name in ["timeseries", "data"]:
+            model_partition = get_partition_name(table_name, self.model)
+            if session.execute(regclass_sql, {"table_name": SCHEMA + "." + model_partition}).scalar() is None:
+                # All rows of the model are in the default partition of the table
+                missing[table_name] = (table_name + "_default", "model_name = :model_name")
+                continue
+            missing_years = [
+                int(year) for year in years if session.execute(regclass_sql, {
+                    "table_name": SCHEMA + "." + get_partition_name(table_name, self.model, year)
+                }).scalar() is None
+            ]
+            if missing_years:
+                missing[table_name] = (model_partition + "_default", "year = ANY(CAST(:years AS integer[]))")
+        if not missing:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            return
+        sql_params = {"model_name": self.model, "years": [int(year) for year in years]}
+        # data references timeseries: move data out first and back in last
+        for table_name in ["data", "timeseries"]:
+            if table_name not in missing:
+                continue
+            default_partition, row_filter = missing[table_name]
+            if session.execute(regclass_sql, {"table_name": SCHEMA + "." + default_partition}).scalar() is None:
+                continue
+            session.execute(sqa.text(
+                "CREATE TEMP TABLE moved_%s (LIKE %s.%s) ON COMMIT DROP" % (table_name, SCHEMA, table_name)))
+            result = session.execute(sqa.text("""
+                WITH moved AS (
+                    DELETE FROM %s.%s WHERE %s RETURNING *
+                )
+                INSERT INTO moved_%s SELECT * FROM moved
+            """ % (SCHEMA, default_partition, row_filter, table_name)), sql_params)
+            print("Moved " + str(result.rowcount) + " rows out of " + default_partition)
+        for table_name in ["timeseries", "data"]:
+            for stmt in create_partitions_ddl(table_name, self.model, years):
+                session.execute(stmt)
+        for table_name in ["timeseries", "data"]:
+            if session.execute(regclass_sql, {"table_name": "pg_temp.moved_" + table_name}).scalar() is not None:
+                session.execute(sqa.text(
+                    "INSERT INTO %s.%s SELECT * FROM moved_%s" % (SCHEMA, table_name, table_name)))
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+    def get_feature_properties(self, g_data):
+        """
+        :param g_data: geojson feature
+        :return: dict {metadata key: metadata value as string}, "Not Found" if missing
+        """
+        feature_properties = {}
+        for key in config.statics["feature_collections"][self.feature_collection_name]["metadata"]:
+            try:
+                value = str(g_data["properties"][key])
+            except:
+                value = "Not Found"
+            # Commas are removed as in the FeatureMetadata rows, see migrate_metadata_to_properties
+            feature_properties[key] = " ".join(value.replace(", ", ",").split(","))
+        return feature_properties
+
+    def get_feature_properties_copy_value(self, feature_properties):
+        """
+        feature_properties as json for a tab separated COPY
+        Pipes would be quoted by the csv writer and backslashes are COPY escapes
+        """
+        value = json.dumps(feature_properties, sort_keys=True).replace("|", "\\u007c")
+        return value.replace("\\", "\\\\")
+
+    def migrate_metadata_to_properties(self, session, feature_collection_name=None):
+        """
+        Fill Feature.feature_properties from existing FeatureMetadata rows,
+        the values are normalized like the ones of get_feature_properties
+        Note: nothing is committed, run by migrate_schema
+        :param session:
+        :param feature_collection_name: if None, the features of all collections are migrated
+        :return:
+        """
+        if not self.get_table_columns(session, "feature_metadata"):
+            return
+        collection_filter = ""
+        if feature_collection_name is not None:
+            collection_filter = "AND feature.feature_collection_name = :feature_collection_name"
+        sql = sqa.text("""
+            UPDATE %s.feature AS feature
+            SET feature_properties = m.feature_properties
+            FROM (
+                SELECT feature_id, jsonb_object_agg(
+                    feature_metadata_name,
+                    replace(replace(feature_metadata_properties, ', ', ','), ',', ' ')
+                ) AS feature_properties
+                FROM %s.feature_metadata
+                GROUP BY feature_id
+            ) AS m
+            WHERE feature.feature_id = m.feature_id
+            AND feature.feature_properties IS NULL
+            %s
+        """ % (SCHEMA, SCHEMA, collection_filter))
+        result = session.execute(sql, {"feature_collection_name": feature_collection_name})
+        if result.rowcount:
+            print("Set feature_properties of " + str(result.rowcount) + " features")
+
+    def migrate_feature_properties(self, session):
+        """
+        Add the feature.feature_properties column and its GIN index
+        and fill it from the FeatureMetadata rows of all collections
+        """
+        if self.add_missing_columns(session, "feature", [("feature_properties", "jsonb")]):
+            session.execute(sqa.text("""
+                CREATE INDEX IF NOT EXISTS ix_feature_feature_properties
+                ON %s.feature USING gin (feature_properties jsonb_path_ops)
+            """ % SCHEMA))
+        if self.get_table_columns(session, "feature"):
+            self.migrate_metadata_to_properties(session)
+
+    def get_data_value(self, f_data, var, data_var):
+        """
+        :param f_data: geojson feature
+        :param var: variable name, e.g. et
+        :param data_var: data variable found in data files: for monthly m01, m02, ect.
+        :return: data value, -9999 if missing
+        Note: properties with the year in their name (et_2017_01, et_2017) are used if
+              there is no et_m01/et_annual property
+        """
+        properties = f_data["properties"]
+        key = var + "_" + data_var
+        if key not in properties:
+            if data_var == "annual":
+                key = var + "_" + str(self.year)
+            else:
+                key = var + "_" + str(self.year) + "_" + data_var[1:]
+        try:
+            return float(properties[key])
+        except:
+            return -9999
+
+    def migrate_timeseries_to_arrays(self, session, feature_collection_name=None):
+        """
+        Copy the Data/Timeseries rows of self.model into the TimeseriesArray table,
+        one array row per feature/variable/temporal_resolution/year
+        Note: rows already in TimeseriesArray are left alone, the old rows are not deleted
+        :param session: database session
+        :param feature_collection_name: restrict the migration to this collection
+        :return: number of TimeseriesArray rows added
+        """
+        sql = """
+            INSERT INTO %s.timeseries_array (%s)
+            SELECT
+            data.feature_id,
+            data.user_id,
+            data.model_name,
+            data.variable_name,
+            data.temporal_resolution,
+            timeseries.year,
+            MAX(data.permission),
+            MAX(data.last_timeseries_update),
+            array_agg(timeseries.data_value ORDER BY period.start_date)
+            FROM
+            %s.data AS data
+            JOIN %s.timeseries AS timeseries ON timeseries.timeseries_id = data.timeseries_id
+            JOIN %s.period AS period ON period.period_id = timeseries.period_id
+            WHERE
+            data.model_name = :model_name
+        """ % (SCHEMA, ", ".join(TIMESERIES_ARRAY_COPY_COLUMNS), SCHEMA, SCHEMA, SCHEMA)
+        sql_params = {"model_name": self.model}
+        if feature_collection_name is not None:
+            sql += """
+            AND data.feature_id IN (
+                SELECT feature_id FROM %s.feature WHERE feature_collection_name = :feature_collection_name
+            )
+            """ % SCHEMA
+            sql_params["feature_collection_name"] = feature_collection_name
+        sql += """
+            GROUP BY data.feature_id, data.user_id, data.model_name, data.variable_name,
+            data.temporal_resolution, timeseries.year
+            ON CONFLICT DO NOTHING
+        """
+        result = session.execute(sqa.text(sql), sql_params)
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        return result.rowcount
+
+
+    def add_periods_to_db(self, session, years):
+        """
+        Add the periods of years to the Period table if needed
+        Note: nothing is committed
+        :param session:
+        :param years: list of years
+        """
+        DU = date_Util()
+        period_rows = []
+        for year in years:
+            for t_res in config.statics["temporal_resolution"].keys():
+                for data_var in config.statics["temporal_resolution"][t_res]["data_vars"]:
+                    start_date_dt, end_date_dt = DU.get_dbtable_start_end_dates(year, t_res, data_var)
+                    period_rows.append({
+                        "year": int(year),
+                        "temporal_resolution": t_res,
+                        "data_var": data_var,
+                        "month": start_date_dt.month,
+                        "start_date": start_date_dt,
+                        "end_date": end_date_dt
+                    })
+        if not period_rows:
+            return
+        stmt = postgresql.insert(Period.__table__).values(period_rows).on_conflict_do_nothing(
+            index_elements=["year", "temporal_resolution", "data_var"]
+        )
+        session.execute(stmt)
+
+    def get_period_ids(self, session, year):
+        """
+        Add the periods of year to the Period table if needed
+        :param session:
+        :param year:
+        :return: dict {(temporal_resolution, data_var): period_id}
+        """
+        self.add_periods_to_db(session, [year])
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        period_query = session.query(Period.temporal_resolution, Period.data_var, Period.period_id).filter(
+            Period.year == int(year)
+        )
+        return dict(((t_res, data_var), period_id) for t_res, data_var, period_id in period_query)
+
+
     def set_user_dict(self, user_id):
         """
         set the dictonary used to populate db User table  for a single user
@@ -606,62 +1871,1156 @@ class database_Util(object):
         print("Added FeatureCollection table")
 
         """
-        # Parameters (depends on model AND variable)
-        entities = []
-        for model_name in config.statics["parameters"].keys():
-            for var_name in config.statics["parameters"][model_name].keys():
-                init_dict = copy.deepcopy(config.statics["parameters"][model_name][var_name])
-                entities.append(Parameters(**init_dict))
-        self.add_entities_to_db(session, entities)
-        print("Added Parameter rows")
+        # Parameters (depends on model AND variable)
+        entities = []
+        for model_name in config.statics["parameters"].keys():
+            for var_name in config.statics["parameters"][model_name].keys():
+                init_dict = copy.deepcopy(config.statics["parameters"][model_name][var_name])
+                entities.append(Parameters(**init_dict))
+        self.add_entities_to_db(session, entities)
+        print("Added Parameter rows")
+        """
+        # NOTE: Feature, FeatureMetdata tables are set later
+
+    def get_feature_year(self):
+        """
+        Features that don't change by year are stored once under year 9999
+        """
+        if self.features_change_by_year:
+            return self.year
+        return 9999
+
+    def get_table_columns(self, session, table_name):
+        """
+        Column names of a table in SCHEMA, empty if the table does not exist
+        """
+        sql = sqa.text("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = :schema AND table_name = :table_name
+        """)
+        return set(row[0] for row in session.execute(sql, {"schema": SCHEMA, "table_name": table_name}))
+
+    def add_missing_columns(self, session, table_name, columns):
+        """
+        Add columns a table created by an earlier version of the models does not have
+        :param table_name: table in SCHEMA
+        :param columns: list of (column name, column definition)
+        :return: list of the names of the columns that were added, empty if the table does not exist
+        """
+        table_columns = self.get_table_columns(session, table_name)
+        if not table_columns:
+            return []
+        added = []
+        for column_name, definition in columns:
+            if column_name in table_columns:
+                continue
+            print("Adding column " + table_name + "." + column_name)
+            session.execute(sqa.text(
+                "ALTER TABLE %s.%s ADD COLUMN IF NOT EXISTS %s %s" % (SCHEMA, table_name, column_name, definition)))
+            added.append(column_name)
+        return added
+
+    def migrate_feature_geometry_id(self, session):
+        """
+        Add the feature.geometry_id column (geometries shared through FeatureGeometry, see dedupe_geometries)
+        Existing features keep their own geometry
+        """
+        if self.add_missing_columns(session, "feature", [
+                ("geometry_id", "integer REFERENCES %s.feature_geometry (geometry_id)" % SCHEMA)]):
+            session.execute(sqa.text(
+                "CREATE INDEX IF NOT EXISTS ix_%s_feature_geometry_id ON %s.feature (geometry_id)" % (SCHEMA, SCHEMA)))
+
+    def migrate_geometry_columns(self, session):
+        """
+        Add the columns derived from the feature geometry (area, bbox, centroid, geometry_simplified)
+        and compute them for the features loaded before them, see set_geometry_columns
+        The area weighted averages and the bbox selection filter of query_Util read these columns
+        """
+        added = self.add_missing_columns(session, "feature", [
+            ("area", "double precision"),
+            ("bbox", "geometry(GEOMETRY)"),
+            ("centroid", "geometry(POINT)"),
+            ("geometry_simplified", "geometry(MULTIPOLYGON)")
+        ])
+        for column_name in added:
+            if column_name != "area":
+                session.execute(sqa.text("CREATE INDEX IF NOT EXISTS idx_feature_%s ON %s.feature USING gist (%s)" % (
+                    column_name, SCHEMA, column_name)))
+        if not self.get_table_columns(session, "feature"):
+            return
+        # bbox was a polygon column, the envelopes of degenerate geometries could not be stored
+        sql = sqa.text("""
+            SELECT type FROM geometry_columns
+            WHERE f_table_schema = :schema AND f_table_name = 'feature' AND f_geometry_column = 'bbox'
+        """)
+        bbox_type = session.execute(sql, {"schema": SCHEMA}).scalar()
+        if bbox_type is not None and bbox_type.upper() != "GEOMETRY":
+            session.execute(sqa.text("ALTER TABLE %s.feature ALTER COLUMN bbox TYPE geometry(GEOMETRY)" % SCHEMA))
+        self.set_geometry_columns(session, all_collections=True)
+
+    def migrate_generation_columns(self, session):
+        """
+        Add the generation columns of the blue/green reload (see reload_collection),
+        existing features, collections and checkpoints are generation 0
+        Note: the feature and ingest_checkpoint unique constraints include the generation,
+              they are widened by migrate_db.py --unique-constraints (see migrate_unique_constraints)
+        """
+        for table_name in ["feature", "feature_collection", "ingest_checkpoint"]:
+            self.add_missing_columns(session, table_name, [("generation", "integer NOT NULL DEFAULT 0")])
+
+    def migrate_partition_columns(self, session):
+        """
+        Add the data.year, timeseries.model_name and timeseries.year columns
+        (partition keys, see PARTITION_TABLES) to a database created before them
+        and fill them from the data -> timeseries join
+        Note: existing tables are not converted to partitioned tables,
+              they have to be reloaded to use partition_tables
+        """
+        timeseries_columns = self.get_table_columns(session, "timeseries")
+        data_columns = self.get_table_columns(session, "data")
+        if not timeseries_columns or not data_columns:
+            return
+        if "year" in data_columns and "model_name" in timeseries_columns and "year" in timeseries_columns:
+            return
+        if PARTITION_TABLES and not self.table_is_partitioned(session, "data"):
+            raise Exception("partition_tables is set but the data and timeseries tables are not partitioned, "
+                            "they have to be created again")
+        print("Adding the data.year, timeseries.model_name and timeseries.year columns")
+        for table_name, column in [("timeseries", "model_name varchar"), ("timeseries", "year integer"),
+                                   ("data", "year integer")]:
+            session.execute(sqa.text(
+                "ALTER TABLE %s.%s ADD COLUMN IF NOT EXISTS %s" % (SCHEMA, table_name, column)))
+        if "start_date" in timeseries_columns:
+            session.execute(sqa.text("""
+                UPDATE %s.timeseries SET year = CAST(EXTRACT(YEAR FROM start_date) AS integer)
+                WHERE year IS NULL AND start_date IS NOT NULL
+            """ % SCHEMA))
+        session.execute(sqa.text("""
+            UPDATE %s.timeseries AS timeseries SET model_name = data.model_name
+            FROM %s.data AS data
+            WHERE data.timeseries_id = timeseries.timeseries_id
+            AND timeseries.model_name IS NULL
+        """ % (SCHEMA, SCHEMA)))
+        session.execute(sqa.text("""
+            UPDATE %s.data AS data SET year = timeseries.year
+            FROM %s.timeseries AS timeseries
+            WHERE timeseries.timeseries_id = data.timeseries_id
+            AND data.year IS NULL
+        """ % (SCHEMA, SCHEMA)))
+
+    def migrate_timeseries_periods(self, session):
+        """
+        Fill timeseries.period_id (see Period) of a timeseries table that still has start_date/end_date:
+        the periods of the years in the table are added, every timeseries row gets the period
+        with its start date and the temporal resolution of its data row
+        The rows without a period are found with a partial index, a migrated table is not scanned again
+        Note: run after migrate_partition_columns, which sets timeseries.year,
+              the date columns are dropped by migrate_db.py --drop-timeseries-dates (see drop_timeseries_dates)
+        """
+        timeseries_columns = self.get_table_columns(session, "timeseries")
+        if "start_date" not in timeseries_columns:
+            return
+        if self.add_missing_columns(session, "timeseries", [
+                ("period_id", "integer REFERENCES %s.period (period_id)" % SCHEMA)]):
+            session.execute(sqa.text(
+                "CREATE INDEX IF NOT EXISTS ix_%s_timeseries_period_id ON %s.timeseries (period_id)" % (SCHEMA, SCHEMA)))
+        session.execute(sqa.text("""
+            CREATE INDEX IF NOT EXISTS ix_timeseries_without_period ON %s.timeseries (timeseries_id)
+            WHERE period_id IS NULL
+        """ % SCHEMA))
+        years = [row[0] for row in session.execute(sqa.text(
+            "SELECT DISTINCT year FROM %s.timeseries WHERE period_id IS NULL AND year IS NOT NULL" % SCHEMA))]
+        if not years:
+            return
+        self.add_periods_to_db(session, years)
+        result = session.execute(sqa.text("""
+            UPDATE %s.timeseries AS timeseries SET period_id = period.period_id
+            FROM %s.data AS data, %s.period AS period
+            WHERE data.timeseries_id = timeseries.timeseries_id
+            AND period.year = timeseries.year
+            AND period.temporal_resolution = data.temporal_resolution
+            AND period.start_date = timeseries.start_date
+            AND timeseries.period_id IS NULL
+        """ % (SCHEMA, SCHEMA, SCHEMA)))
+        if result.rowcount:
+            print("Set the period of " + str(result.rowcount) + " timeseries rows")
+
+    def drop_timeseries_dates(self, session):
+        """
+        Drop timeseries.start_date/end_date once every row has its period (see migrate_timeseries_periods)
+        Note: can't be undone, not run by the ingest, see migrate_db.py
+        :return: number of rows with a start date but no period, nothing is dropped if there are any
+        """
+        if "start_date" not in self.get_table_columns(session, "timeseries"):
+            return 0
+        self.migrate_timeseries_periods(session)
+        num_unmatched = session.execute(sqa.text(
+            "SELECT count(*) FROM %s.timeseries WHERE period_id IS NULL AND start_date IS NOT NULL" % SCHEMA
+        )).scalar()
+        if num_unmatched:
+            print("No period found for " + str(num_unmatched) + " timeseries rows, keeping start_date/end_date")
+            return num_unmatched
+        print("Dropping timeseries.start_date and timeseries.end_date")
+        session.execute(sqa.text("DROP INDEX IF EXISTS %s.ix_timeseries_without_period" % SCHEMA))
+        for column in ["start_date", "end_date"]:
+            session.execute(sqa.text("ALTER TABLE %s.timeseries DROP COLUMN IF EXISTS %s" % (SCHEMA, column)))
+        return 0
+
+    def get_unique_constraints(self, session, table_name):
+        """
+        :return: dict {constraint name: frozenset of column names} of the unique constraints of a table in SCHEMA
+        """
+        sql = sqa.text("""
+            SELECT c.conname, a.attname
+            FROM pg_constraint AS c
+            JOIN pg_attribute AS a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+            WHERE c.contype = 'u' AND c.conrelid = CAST(:table_name AS regclass)
+        """)
+        constraints = {}
+        for conname, attname in session.execute(sql, {"table_name": SCHEMA + "." + table_name}):
+            constraints.setdefault(conname, set()).add(attname)
+        return dict((conname, frozenset(columns)) for conname, columns in constraints.items())
+
+    def get_missing_unique_constraints(self, session):
+        """
+        Unique constraints of the feature, feature_metadata and ingest_checkpoint models
+        (the ON CONFLICT targets of the ingest) the tables don't have
+        :return: list of (model, list of column names)
+        """
+        missing = []
+        for model in [Feature, FeatureMetadata, IngestCheckpoint]:
+            table = model.__table__
+            if not self.get_table_columns(session, table.name):
+                continue
+            existing = self.get_unique_constraints(session, table.name).values()
+            for constraint in table.constraints:
+                if not isinstance(constraint, db.UniqueConstraint):
+                    continue
+                columns = [column.name for column in constraint.columns]
+                if frozenset(columns) not in existing:
+                    missing.append((model, columns))
+        return missing
+
+    def migrate_unique_constraints(self, session, delete_duplicates=False):
+        """
+        Add the unique constraints of the feature, feature_metadata and ingest_checkpoint models
+        to tables created without them, the unique constraints of these tables that are not
+        in the models (older, narrower keys) are dropped
+        Rows that violate a constraint are reported, they are only deleted if delete_duplicates is set
+        (the row with the lowest primary key is kept, duplicate features are deleted with their data),
+        otherwise the constraints of that table are left as they are
+        Note: changes the tables and may delete data, not run by the ingest, see migrate_db.py
+        :param session: database session
+        :param delete_duplicates: True if duplicate rows are deleted
+        :return: dict {table name: number of duplicate rows left}
+        """
+        duplicates_left = {}
+        for model in [Feature, FeatureMetadata, IngestCheckpoint]:
+            table = model.__table__
+            if not self.get_table_columns(session, table.name):
+                continue
+            pk_column = list(table.primary_key.columns)[0].name
+            model_constraints = [
+                [column.name for column in constraint.columns]
+                for constraint in table.constraints if isinstance(constraint, db.UniqueConstraint)
+            ]
+            existing = self.get_unique_constraints(session, table.name)
+            missing = [columns for columns in model_constraints if frozenset(columns) not in existing.values()]
+            duplicate_ids = {}
+            for columns in missing:
+                duplicates_sql = sqa.text("""
+                    SELECT b.%s
+                    FROM %s.%s AS a JOIN %s.%s AS b ON %s
+                    WHERE a.%s < b.%s
+                """ % (pk_column, SCHEMA, table.name, SCHEMA, table.name,
+                       " AND ".join("a.%s = b.%s" % (col, col) for col in columns), pk_column, pk_column))
+                ids = sorted(set(row[0] for row in session.execute(duplicates_sql)))
+                if ids:
+                    print("Found " + str(len(ids)) + " " + table.name + " rows that duplicate (" +
+                          ", ".join(columns) + "), " + pk_column + ": " +
+                          ", ".join(str(i) for i in ids[:20]) + (" ..." if len(ids) > 20 else ""))
+                    duplicate_ids[tuple(columns)] = ids
+            if duplicate_ids and not delete_duplicates:
+                duplicates_left[table.name] = len(set(i for ids in duplicate_ids.values() for i in ids))
+                print("Leaving the unique constraints of " + table.name + " unchanged")
+                continue
+            for conname, columns in existing.items():
+                if columns not in [frozenset(cols) for cols in model_constraints]:
+                    print("Dropping unique constraint " + conname)
+                    session.execute(sqa.text('ALTER TABLE %s.%s DROP CONSTRAINT "%s"' % (SCHEMA, table.name, conname)))
+            for columns in missing:
+                ids = duplicate_ids.get(tuple(columns))
+                if ids:
+                    # Rows deleted for an earlier constraint of the table are gone already
+                    print("Deleting " + str(len(ids)) + " duplicate " + table.name + " rows")
+                    if model is Feature:
+                        self.delete_features(session, ids)
+                    else:
+                        session.execute(sqa.text("DELETE FROM %s.%s WHERE %s = ANY(CAST(:ids AS integer[]))" % (
+                            SCHEMA, table.name, pk_column)), {"ids": ids})
+                print("Adding unique constraint (" + ", ".join(columns) + ") to " + table.name)
+                session.execute(sqa.text(
+                    "ALTER TABLE %s.%s ADD UNIQUE (%s)" % (SCHEMA, table.name, ", ".join(columns))))
+        return duplicates_left
+
+    def migrate_schema(self, session, check_constraints=True):
+        """
+        Bring a database created by an earlier version of this module up to the current models,
+        every step checks what is missing and can be run again, only columns are added and filled
+        Run before anything is read, the models select columns older databases don't have
+        Note: the steps that drop constraints or columns or delete rows are run by migrate_db.py,
+              the ingest stops if the unique constraints it needs are missing
+        :param session: database session
+        :param check_constraints: False if missing unique constraints are not an error
+        """
+        self.migrate_partition_columns(session)
+        self.migrate_timeseries_periods(session)
+        self.migrate_feature_geometry_id(session)
+        self.migrate_geometry_columns(session)
+        self.migrate_feature_properties(session)
+        self.migrate_generation_columns(session)
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        if not check_constraints:
+            return
+        missing = self.get_missing_unique_constraints(session)
+        if missing:
+            raise Exception("Missing unique constraints " + ", ".join(
+                model.__tablename__ + " (" + ", ".join(columns) + ")" for model, columns in missing) +
+                ", run python migrate_db.py --unique-constraints")
+
+    def set_base_tables_if_empty(self, session):
+        """
+        Sets up the feature_collection, model, parameter and variable tables if the database is empty
+        and migrates the tables of an existing database, see migrate_schema
+        :param session: database session
+        :return:
+        """
+        self.migrate_schema(session)
+        #1.  Check if database is empty
+        # If not empty, we need to check if entries are already in db
+        db_empty = False
+        try:
+            q = session.query(Data).first()
+            if q is None:
+                db_empty = True
+        except:
+            db_empty = True
+            # db_empty = self.database_is_empty()
+
+        if db_empty:
+            # Set up feature_collection, model, parameter and variable tables
+            print("Database empty, setting up basic data tables")
+            self.set_base_database_tables(session)
+
+    def prepare_ingest(self, session):
+        """
+        Sanity checks before data is added to the database:
+        sets up the base tables if the database is empty, drops the years of self.years whose
+        features are already in the database and whose chunks are all committed,
+        and exits if that leaves no year to load
+        Note: features that don't change by year are shared by all years,
+              the data of the other years is loaded if their chunks are not committed
+        :param session: database session
+        :return:
+        """
+        self.set_base_tables_if_empty(session)
+
+        # 2. check if the features and data of each year are already in there
+        num_features = config.statics["feature_collections"][self.feature_collection_name]["num_features"]
+        done_years = []
+        first_year = self.year
+        try:
+            for year in self.years:
+                self.year = year
+                if not self.check_if_features_in_db(self.get_feature_year(), session):
+                    continue
+                committed_chunks = self.get_committed_chunks(session)
+                # Shared features (year 9999) are in the database after the first year was loaded,
+                # the features of a year are in the database after the first model was loaded
+                if (committed_chunks or not self.features_change_by_year or
+                        not self.check_if_model_data_in_db(session)) and \
+                        self.get_num_committed_features(committed_chunks) < num_features:
+                    print("Resuming ingest of " + self.feature_collection_name + "/" + str(year))
+                    continue
+                done_years.append(year)
+        finally:
+            self.year = first_year
+        if not done_years:
+            return
+        msg = 'Data for feature_collection/year ' + self.feature_collection_name + '/' +\
+              ", ".join(str(year) for year in done_years) + ' already in database.'
+        self.years = [year for year in self.years if year not in done_years]
+        if not self.years:
+            print(msg + ' Exciting')
+            sys.exit(0)
+        print(msg + ' Skipping')
+        self.year = self.years[0]
+
+    def get_table_indexes(self, session, table_name):
+        """
+        Secondary (non unique) indexes of a table
+        :return: list of (index_name, index definition)
+        """
+        sql = sqa.text("""
+            SELECT i.relname, pg_get_indexdef(i.oid)
+            FROM pg_index AS x
+            JOIN pg_class AS i ON i.oid = x.indexrelid
+            WHERE x.indrelid = CAST(:table_name AS regclass)
+            AND NOT x.indisprimary AND NOT x.indisunique
+        """)
+        return [tuple(row) for row in session.execute(sql, {"table_name": SCHEMA + "." + table_name})]
+
+    def get_table_foreign_keys(self, session, table_name):
+        """
+        Foreign key constraints of a table
+        :return: list of (constraint_name, constraint definition)
+        """
+        sql = sqa.text("""
+            SELECT conname, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE conrelid = CAST(:table_name AS regclass) AND contype = 'f'
+            AND conparentid = 0
+        """)
+        return [tuple(row) for row in session.execute(sql, {"table_name": SCHEMA + "." + table_name})]
+
+    def table_is_partitioned(self, session, table_name):
+        sql = sqa.text("SELECT relkind FROM pg_class WHERE oid = CAST(:table_name AS regclass)")
+        return session.execute(sql, {"table_name": SCHEMA + "." + table_name}).scalar() == "p"
+
+    def drop_indexes_and_foreign_keys(self, session, table_names):
+        """
+        Drop the secondary indexes and foreign keys of the tables before a bulk load
+        The definitions are logged so they can be restored by hand if the load dies
+        :param session:
+        :param table_names:
+        :return: dict {table_name: {"indexes": [...], "foreign_keys": [...]}}, see restore_indexes_and_foreign_keys
+        """
+        dropped = {}
+        for table_name in table_names:
+            exists = session.execute(
+                sqa.text("SELECT to_regclass(:table_name)"), {"table_name": SCHEMA + "." + table_name}).scalar()
+            if exists is None:
+                continue
+            dropped[table_name] = {
+                "indexes": self.get_table_indexes(session, table_name),
+                "foreign_keys": self.get_table_foreign_keys(session, table_name),
+                "partitioned": self.table_is_partitioned(session, table_name)
+            }
+            for con_name, con_def in dropped[table_name]["foreign_keys"]:
+                logging.warning("Dropping " + table_name + "." + con_name + ": " + con_def)
+                session.execute('ALTER TABLE %s.%s DROP CONSTRAINT "%s"' % (SCHEMA, table_name, con_name))
+            for index_name, index_def in dropped[table_name]["indexes"]:
+                logging.warning("Dropping index: " + index_def)
+                session.execute('DROP INDEX %s."%s"' % (SCHEMA, index_name))
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        return dropped
+
+    def restore_indexes_and_foreign_keys(self, dropped):
+        """
+        Rebuild the indexes and foreign keys dropped by drop_indexes_and_foreign_keys
+        Indexes are built concurrently and foreign keys are added NOT VALID and validated
+        afterwards where postgres allows it (not for partitioned tables)
+        Runs in autocommit mode, CREATE INDEX CONCURRENTLY can't run in a transaction
+        :param dropped: see drop_indexes_and_foreign_keys
+        :return:
+        """
+        conn = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            for table_name, table_dropped in dropped.items():
+                for index_name, index_def in table_dropped["indexes"]:
+                    if not table_dropped["partitioned"]:
+                        index_def = index_def.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+                    conn.execute(index_def)
+                for con_name, con_def in table_dropped["foreign_keys"]:
+                    sql = 'ALTER TABLE %s.%s ADD CONSTRAINT "%s" %s' % (SCHEMA, table_name, con_name, con_def)
+                    if table_dropped["partitioned"]:
+                        conn.execute(sql)
+                    else:
+                        conn.execute(sql + " NOT VALID")
+                        conn.execute('ALTER TABLE %s.%s VALIDATE CONSTRAINT "%s"' % (SCHEMA, table_name, con_name))
+        finally:
+            conn.close()
+
+    def analyze_tables(self, table_names):
+        conn = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            for table_name in table_names:
+                conn.execute("ANALYZE %s.%s" % (SCHEMA, table_name))
+        finally:
+            conn.close()
+
+    def bulk_load_data_to_db(self, session, user_id=0, geojson_data=None):
+        """
+        Full collection load without index and foreign key maintenance:
+        drops the secondary indexes and foreign keys of BULK_LOAD_TABLES, runs add_data_to_db,
+        rebuilds them and runs ANALYZE
+        Note: other loaders writing to the same tables at the same time are not checked against the foreign keys
+        :params: see add_data_to_db
+        :return: dict of timings in seconds for each step
+        """
+        timings = {}
+        start_time = time.time()
+        dropped = self.drop_indexes_and_foreign_keys(session, BULK_LOAD_TABLES)
+        timings["drop_indexes"] = time.time() - start_time
+        try:
+            start_time = time.time()
+            self.add_data_to_db(session, user_id=user_id, geojson_data=geojson_data)
+            timings["load"] = time.time() - start_time
+        finally:
+            start_time = time.time()
+            self.restore_indexes_and_foreign_keys(dropped)
+            timings["rebuild_indexes"] = time.time() - start_time
+        start_time = time.time()
+        self.analyze_tables(dropped.keys())
+        timings["analyze"] = time.time() - start_time
+        timings["total"] = sum(timings.values())
+        print("Bulk load timings (seconds): " + json.dumps(timings, sort_keys=True))
+        logging.info("Bulk load timings (seconds): " + json.dumps(timings, sort_keys=True))
+        return timings
+
+    def get_num_timeseries_per_feature(self):
+        num_periods = 0
+        for t_res in config.statics["temporal_resolution"].keys():
+            num_periods += len(config.statics["temporal_resolution"][t_res]["data_vars"])
+        return len(config.statics["models"][self.model]["variables"]) * num_periods
+
+    def get_init_kwargs(self):
+        """
+        Arguments needed to set up the same database_Util in another process
+        The engine can't be shared between processes and is not included
+        """
+        return {
+            "model": self.model,
+            "year": self.year,
+            "variables": self.variables,
+            "user_id": self.user_id,
+            "feature_collection_name": self.feature_collection_name,
+            "data_file_path": self.data_file_path,
+            "download_method": self.download_method,
+            "features_change_by_year": self.features_change_by_year,
+            "stream_features": self.stream_features,
+            "copy_format": self.copy_format,
+            "storage_layout": self.storage_layout,
+            "dedupe_geometries": self.dedupe_geometries,
+            "adaptive_chunks": self.adaptive_chunks,
+            "metrics_file": self.metrics_file,
+            "bucket_cache_dir": self.bucket_cache_dir,
+            "years": self.years,
+            "generation": self.get_generation()
+        }
+
+    def merge_staged_chunk(self, session, staging, feature_year, user_id, user_ids, permission,
+                           last_timeseries_update, ts_sequence_name):
+        """
+        Merge the staging tables of one chunk into feature, feature_user_link,
+        timeseries and data, one statement per target table
+        Rows already in the database are left alone, so a chunk can be merged more than once
+        Note: data has no natural key, new values are found with an anti join. Merges into the
+              same collection/model are serialized with a transaction level advisory lock, so
+              concurrent loaders can't both insert a value the other one has not committed yet
+        """
+        session.execute(sqa.text("SELECT pg_advisory_xact_lock(hashtext(:lock_key))"), {
+            "lock_key": "merge_staged_chunk/" + self.feature_collection_name + "/" + self.model
+        })
+        sql_params = {
+            "feature_collection_name": self.feature_collection_name,
+            "generation": self.get_generation(),
+            "feature_year": feature_year,
+            "user_id": user_id,
+            "user_ids": list(user_ids),
+            "model_name": self.model,
+            "year": self.year,
+            "permission": permission,
+            "last_timeseries_update": last_timeseries_update
+        }
+        # New features and their users
+        if self.dedupe_geometries:
+            sql = sqa.text("""
+                INSERT INTO %s.feature_geometry (geometry_hash, geometry)
+                SELECT DISTINCT ON (geometry_hash) geometry_hash, geometry
+                FROM %s.%s
+                WHERE geometry IS NOT NULL
+                ON CONFLICT (geometry_hash) DO NOTHING
+            """ % (SCHEMA, SCHEMA, staging["feature"][0]))
+            session.execute(sql)
+            feature_source = """
+                SELECT :feature_collection_name, s.feature_id_from_user, s.type, :feature_year, NULL, feature_geometry.geometry_id,
+                s.feature_properties, :generation
+                FROM %s.%s AS s
+                JOIN %s.feature_geometry AS feature_geometry ON feature_geometry.geometry_hash = s.geometry_hash
+            """ % (SCHEMA, staging["feature"][0], SCHEMA)
+        else:
+            feature_source = """
+                SELECT :feature_collection_name, s.feature_id_from_user, s.type, :feature_year, s.geometry, NULL,
+                s.feature_properties, :generation
+                FROM %s.%s AS s
+            """ % (SCHEMA, staging["feature"][0])
+        sql = sqa.text("""
+            WITH new_feature AS (
+                INSERT INTO %s.feature (feature_collection_name, feature_id_from_user, type, year, geometry, geometry_id,
+                                        feature_properties, generation)
+                %s
+                ON CONFLICT (feature_collection_name, feature_id_from_user, year, generation) DO NOTHING
+                RETURNING feature_id
+            )
+            , new_link AS (
+                INSERT INTO %s.feature_user_link (user_id, feature_id)
+                SELECT u.user_id, new_feature.feature_id
+                FROM new_feature CROSS JOIN unnest(CAST(:user_ids AS integer[])) AS u(user_id)
+            )
+            SELECT feature_id FROM new_feature
+        """ % (SCHEMA, feature_source, SCHEMA))
+        new_feature_ids = [row[0] for row in session.execute(sql, sql_params)]
+        # Only the features of this chunk, not a scan of the collection
+        self.set_geometry_columns(session, new_feature_ids)
+
+        # Timeseries and data rows that are not in the database yet
+        # data has no natural key to conflict on, new rows are found with an anti join
+        sql = sqa.text("""
+            WITH new_value AS (
+                SELECT
+                nextval('%s') AS timeseries_id,
+                feature.feature_id,
+                s.variable_name,
+                s.temporal_resolution,
+                s.period_id,
+                s.data_value
+                FROM %s.%s AS s
+                JOIN %s.feature AS feature ON feature.feature_id_from_user = s.feature_id_from_user
+                AND feature.feature_collection_name = :feature_collection_name
+                AND feature.generation = :generation
+                AND feature.year = :feature_year
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM %s.data AS data
+                    JOIN %s.timeseries AS timeseries ON timeseries.timeseries_id = data.timeseries_id
+                    WHERE data.feature_id = feature.feature_id
+                    AND data.user_id = :user_id
+                    AND data.model_name = :model_name
+                    AND data.variable_name = s.variable_name
+                    AND data.temporal_resolution = s.temporal_resolution
+                    AND timeseries.period_id = s.period_id
+                )
+            ), new_timeseries AS (
+                INSERT INTO %s.timeseries (%s)
+                SELECT timeseries_id, :model_name, :year, period_id, data_value
+                FROM new_value
+            )
+            INSERT INTO %s.data (%s)
+            SELECT feature_id, :user_id, timeseries_id, :model_name, variable_name, temporal_resolution,
+            :year, :permission, :last_timeseries_update
+            FROM new_value
+        """ % (ts_sequence_name, SCHEMA, staging["values"][0], SCHEMA, SCHEMA, SCHEMA,
+               SCHEMA, ", ".join(TIMESERIES_COPY_COLUMNS), SCHEMA, ", ".join(DATA_COPY_COLUMNS)))
+        result = session.execute(sql, sql_params)
+        return result.rowcount
+
+    def update_staged_chunk(self, session, staging, feature_year, user_id, last_timeseries_update):
+        """
+        Update the stored timeseries values that differ from the staged values of one chunk
+        and set last_timeseries_update of their data rows, in one statement,
+        and the feature_properties that differ from the staged ones
+        Unchanged rows are not written
+        :return: number of updated values
+        """
+        sql_params = {
+            "feature_collection_name": self.feature_collection_name,
+            "generation": self.get_generation(),
+            "feature_year": feature_year,
+            "user_id": user_id,
+            "model_name": self.model,
+            "last_timeseries_update": last_timeseries_update
+        }
+        sql = sqa.text("""
+            WITH changed AS (
+                UPDATE %s.timeseries AS timeseries
+                SET data_value = s.data_value
+                FROM %s.%s AS s
+                JOIN %s.feature AS feature ON feature.feature_id_from_user = s.feature_id_from_user
+                AND feature.feature_collection_name = :feature_collection_name
+                AND feature.generation = :generation
+                AND feature.year = :feature_year
+                JOIN %s.data AS data ON data.feature_id = feature.feature_id
+                AND data.user_id = :user_id
+                AND data.model_name = :model_name
+                AND data.variable_name = s.variable_name
+                AND data.temporal_resolution = s.temporal_resolution
+                WHERE timeseries.timeseries_id = data.timeseries_id
+                AND timeseries.period_id = s.period_id
+                AND timeseries.data_value IS DISTINCT FROM s.data_value
+                RETURNING timeseries.timeseries_id
+            )
+            UPDATE %s.data AS data
+            SET last_timeseries_update = :last_timeseries_update
+            FROM changed
+            WHERE data.timeseries_id = changed.timeseries_id
+        """ % (SCHEMA, SCHEMA, staging["values"][0], SCHEMA, SCHEMA, SCHEMA))
+        result = session.execute(sql, sql_params)
+
+        sql = sqa.text("""
+            UPDATE %s.feature AS feature
+            SET feature_properties = s.feature_properties
+            FROM %s.%s AS s
+            WHERE feature.feature_id_from_user = s.feature_id_from_user
+            AND feature.feature_collection_name = :feature_collection_name
+            AND feature.generation = :generation
+            AND feature.year = :feature_year
+            AND feature.feature_properties IS DISTINCT FROM s.feature_properties
+        """ % (SCHEMA, SCHEMA, staging["feature"][0]))
+        num_properties = session.execute(sql, sql_params).rowcount
+        if num_properties:
+            print("Updated feature_properties of " + str(num_properties) + " features")
+        return result.rowcount
+
+    def update_data_in_db(self, session, user_id=0, geojson_data=None):
+        """
+        Delta ingest for re-run model outputs: only values that changed are written
+        see add_data_to_db_staged
+        """
+        self.add_data_to_db_staged(session, user_id=user_id, geojson_data=geojson_data, update_changed=True)
+
+    def add_data_to_db_staged(self, session, user_id=0, geojson_data=None, update_changed=False):
+        """
+        Idempotent version of add_data_to_db:
+        each chunk is copied into UNLOGGED staging tables and merged into the
+        feature, timeseries and data tables with a few set based statements.
+        Features and values already in the database are skipped, so a full or partial
+        reload can simply be run again.
+        Note: only for the rows storage layout
+        :params: see add_data_to_db
+            update_changed: if True, stored values that differ from the incoming values are updated
+                and chunks recorded as committed are processed again
+        :return:
+        """
+        if len(self.years) > 1:
+            raise Exception("add_data_to_db_staged loads a single year, use one loader per year of " +
+                            ", ".join(str(year) for year in self.years))
+        self.set_base_tables_if_empty(session)
+        if PARTITION_TABLES:
+            self.add_partitions(session, [self.year])
+        feature_year = self.get_feature_year()
+        features = self.get_features(geojson_data)
+        user_ids_for_featColl = config.statics["feature_collections"][self.feature_collection_name]["users"]
+        permission = config.statics['feature_collections'][self.feature_collection_name]['permission']
+        chunk_size = config.statics["ingest_chunk_size"]
+        last_timeseries_update = dt.datetime.today()
+
+        ts_ids = sequence_Util(session, "timeseries", "timeseries_id", 1)
+        ts_ids.sync_with_table()
+        staging = get_staging_tables(str(os.getpid()))
+        for table_name, col_defs in staging.values():
+            session.execute("CREATE UNLOGGED TABLE IF NOT EXISTS %s.%s (%s)" % (SCHEMA, table_name, col_defs))
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+        conn = session.connection()
+        cursor = conn.connection.cursor()
+        cursor.execute("SET search_path TO " + SCHEMA + ", public")
+        period_ids = self.get_period_ids(session, self.year)
+        try:
+            committed_chunks = self.get_committed_chunks(session)
+            for chunk, chunk_features in enumerate(self.get_feature_chunks(features, chunk_size), start=1):
+                idx_start = (chunk - 1) * chunk_size
+                chunk_range = (idx_start, idx_start + len(chunk_features))
+                if self.chunk_is_committed(chunk_range, committed_chunks) and not update_changed:
+                    print("Chunk " + str(chunk) + " already committed. Skipping...")
+                    continue
+                chunk_feature_ids_from_user = [
+                    self.get_feature_id_from_user(g_data, idx_start + c_idx + 1)
+                    for c_idx, g_data in enumerate(chunk_features)
+                ]
+                # Only convert the geometries of features that are not in the database
+                feature_ids_in_db = self.get_feature_ids_in_db(chunk_feature_ids_from_user, feature_year, session)
+
+                new_c_idxs = [
+                    c_idx for c_idx in range(len(chunk_features))
+                    if chunk_feature_ids_from_user[c_idx] not in feature_ids_in_db
+                ]
+                geometry_hashes = dict((c_idx, "\\N") for c_idx in new_c_idxs)
+                geometry_ids_in_db = {}
+                if self.dedupe_geometries:
+                    geometry_hashes = dict(zip(new_c_idxs, self.get_geometry_hashes(
+                        [chunk_features[c_idx]["geometry"] for c_idx in new_c_idxs])))
+                    geometry_ids_in_db = self.get_geometry_ids(session, set(geometry_hashes.values()))
+
+                buffers = dict((name, StringIO()) for name in staging.keys())
+                writers = dict(
+                    (name, csv.writer(buf, delimiter="\t", quotechar="|", quoting=csv.QUOTE_MINIMAL))
+                    for name, buf in buffers.items()
+                )
+                # Convert the geometries of the new features in one batch, hex WKB for COPY
+                to_convert = [c_idx for c_idx in new_c_idxs if geometry_hashes[c_idx] not in geometry_ids_in_db]
+                hex_geoms = dict(
+                    (c_idx, binascii.hexlify(postgis_geom.data))
+                    for c_idx, postgis_geom in zip(to_convert, self.get_postgis_geometries(
+                        [chunk_features[c_idx]["geometry"] for c_idx in to_convert]))
+                )
+                for c_idx, g_data in enumerate(chunk_features):
+                    feature_id_from_user = chunk_feature_ids_from_user[c_idx]
+                    if feature_id_from_user not in feature_ids_in_db:
+                        feature_properties = self.get_feature_properties_copy_value(self.get_feature_properties(g_data))
+                        # No geometry if it is shared with a feature already in the database
+                        writers["feature"].writerow(
+                            [feature_id_from_user, g_data["geometry"]["type"], hex_geoms.get(c_idx, "\\N"),
+                             geometry_hashes[c_idx], feature_properties])
+                    elif update_changed:
+                        # Only the properties are compared, see update_staged_chunk
+                        feature_properties = self.get_feature_properties_copy_value(self.get_feature_properties(g_data))
+                        writers["feature"].writerow(
+                            [feature_id_from_user, g_data["geometry"]["type"], "\\N", "\\N", feature_properties])
+                    for var in config.statics["models"][self.model]["variables"]:
+                        for t_res in config.statics["temporal_resolution"].keys():
+                            for data_var in config.statics["temporal_resolution"][t_res]["data_vars"]:
+                                writers["values"].writerow([
+                                    feature_id_from_user, var, t_res, period_ids[(t_res, data_var)],
+                                    self.get_data_value(g_data, var, data_var)
+                                ])
+
+                for name, (table_name, col_defs) in staging.items():
+                    cursor.execute("TRUNCATE " + table_name)
+                    self.copy_from_buffer(cursor, buffers[name], table_name, None, sep="\t")
+                    buffers[name].close()
+                num_added = self.merge_staged_chunk(
+                    session, staging, feature_year, user_id, user_ids_for_featColl, permission,
+                    last_timeseries_update, ts_ids.sequence_name
+                )
+                num_updated = 0
+                if update_changed:
+                    num_updated = self.update_staged_chunk(
+                        session, staging, feature_year, user_id, last_timeseries_update)
+                if not self.chunk_is_committed(chunk_range, committed_chunks):
+                    row_counts = {
+                        "num_features": len(chunk_features),
+                        "num_timeseries_rows": num_added,
+                        "num_data_rows": num_added,
+                        "num_metadata_rows": len(chunk_features) - len(feature_ids_in_db)
+                    }
+                    self.add_checkpoint(session, chunk_range[0], chunk_range[1], row_counts)
+                try:
+                    session.commit()
+                except:
+                    session.rollback()
+                    raise
+                print("Merged chunk " + str(chunk) + ", added " + str(num_added) + " data rows, updated " +
+                      str(num_updated) + " values")
+        finally:
+            for table_name, col_defs in staging.values():
+                session.execute("DROP TABLE IF EXISTS %s.%s" % (SCHEMA, table_name))
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+    def add_data_to_db_parallel(self, session, db_string, num_workers, user_id=0):
+        """
+        Add data to database with several worker processes, each with its own
+        database connection. The features are read and parsed once, here, and
+        the chunks are handed to the workers through a bounded queue, so at most
+        2 * num_workers chunks are in flight besides the features being read.
+        Timeseries ids are reserved in blocks from the timeseries_id sequence
+        so the workers never collide.
+        :params:
+            session: database session, used for the sanity checks only
+            db_string: database url used by the workers to create their own engine
+            num_workers: number of worker processes
+            user_id
+        :return:
+        """
+        self.prepare_ingest(session)
+        # The workers copy straight into the partitions, they are created here once
+        if PARTITION_TABLES and self.storage_layout == "rows":
+            self.add_partitions(session)
+        # Make sure the sequence is ahead of ids assigned before it was used
+        sequence_Util(session, "timeseries", "timeseries_id", 1).sync_with_table()
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+        chunk_queue = multiprocessing.Queue(maxsize=2 * num_workers)
+        workers = []
+        for worker_idx in range(num_workers):
+            worker = multiprocessing.Process(
+                target=run_ingest_worker,
+                args=(self.get_init_kwargs(), db_string, user_id, worker_idx, num_workers, chunk_queue)
+            )
+            worker.start()
+            workers.append(worker)
+        try:
+            features = self.get_features()
+            chunk_size = config.statics["ingest_chunk_size"]
+            for numbered_chunk in self.get_numbered_chunks(features, chunk_size):
+                self.put_chunk(chunk_queue, numbered_chunk, workers)
+            # One end marker per worker
+            for worker in workers:
+                self.put_chunk(chunk_queue, None, workers)
+        except:
+            for worker in workers:
+                worker.terminate()
+            raise
+        failed = []
+        for worker_idx, worker in enumerate(workers):
+            worker.join()
+            if worker.exitcode != 0:
+                failed.append(str(worker_idx))
+        if failed:
+            raise Exception("Ingest failed for worker(s) " + ", ".join(failed))
+
+    def get_loaded_model_years(self, session, generation):
+        """
+        (model_name, year) of the chunks committed for a generation of the collection
+        """
+        checkpoint_query = session.query(IngestCheckpoint.model_name, IngestCheckpoint.year).filter(
+            IngestCheckpoint.feature_collection_name == self.feature_collection_name,
+            IngestCheckpoint.generation == generation,
+            IngestCheckpoint.status == "committed"
+        ).distinct()
+        return set((model_name, year) for model_name, year in checkpoint_query)
+
+    def get_incomplete_years(self, session):
+        """
+        Years of self.years whose committed chunks don't cover all features of the collection
+        :return: dict {year: number of committed features}
+        """
+        num_features = config.statics["feature_collections"][self.feature_collection_name]["num_features"]
+        incomplete_years = {}
+        first_year = self.year
+        try:
+            for year in self.years:
+                self.year = year
+                num_committed = self.get_num_committed_features(self.get_committed_chunks(session))
+                if num_committed < num_features:
+                    incomplete_years[year] = num_committed
+        finally:
+            self.year = first_year
+        return incomplete_years
+
+    def swap_generation(self, session, old_generation, new_generation):
+        """
+        Serve the features of new_generation to the queries, a single row update
+        Fails if another reload swapped the collection in the meantime
+        """
+        sql = sqa.text("""
+            UPDATE %s.feature_collection SET generation = :new_generation
+            WHERE feature_collection_name = :feature_collection_name
+            AND generation = :old_generation
+        """ % SCHEMA)
+        result = session.execute(sql, {
+            "feature_collection_name": self.feature_collection_name,
+            "old_generation": old_generation,
+            "new_generation": new_generation
+        })
+        if result.rowcount != 1:
+            session.rollback()
+            raise Exception("Generation of " + self.feature_collection_name + " is no longer " + str(old_generation))
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+    def delete_features(self, session, feature_ids):
+        """
+        Delete features with their data, metadata and user links,
+        and the shared geometries (see dedupe_geometries) no other feature references
+        Note: nothing is committed
+        :param feature_ids: list of Feature.feature_id primary keys
+        """
+        geometry_ids = [row[0] for row in session.execute(sqa.text("""
+            SELECT DISTINCT geometry_id FROM %s.feature
+            WHERE feature_id = ANY(CAST(:feature_ids AS integer[])) AND geometry_id IS NOT NULL
+        """ % SCHEMA), {"feature_ids": feature_ids})]
+        # data references timeseries, both are deleted in one statement
+        session.execute(sqa.text("""
+            WITH deleted_data AS (
+                DELETE FROM %s.data WHERE feature_id = ANY(CAST(:feature_ids AS integer[]))
+                RETURNING timeseries_id, model_name, year
+            )
+            DELETE FROM %s.timeseries AS timeseries
+            USING deleted_data
+            WHERE timeseries.timeseries_id = deleted_data.timeseries_id
+            AND timeseries.model_name = deleted_data.model_name
+            AND timeseries.year = deleted_data.year
+        """ % (SCHEMA, SCHEMA)), {"feature_ids": feature_ids})
+        for table_name in ["timeseries_array", "feature_metadata", "feature_user_link", "feature"]:
+            session.execute(sqa.text(
+                "DELETE FROM %s.%s WHERE feature_id = ANY(CAST(:feature_ids AS integer[]))" % (SCHEMA, table_name)),
+                {"feature_ids": feature_ids})
+        if geometry_ids:
+            session.execute(sqa.text("""
+                DELETE FROM %s.feature_geometry AS feature_geometry
+                WHERE geometry_id = ANY(CAST(:geometry_ids AS integer[]))
+                AND NOT EXISTS (
+                    SELECT 1 FROM %s.feature AS feature WHERE feature.geometry_id = feature_geometry.geometry_id
+                )
+            """ % (SCHEMA, SCHEMA)), {"geometry_ids": geometry_ids})
+
+    def delete_generation(self, session, generation, batch_size=None):
+        """
+        Delete the features of a generation of the collection and their data,
+        in batches of features with a commit after each batch so that no long running
+        transaction holds locks on the data and timeseries tables
+        :param batch_size: features per batch, default: config.statics["reload_delete_batch_size"] or 1000
+        :return: number of deleted features
+        """
+        if batch_size is None:
+            batch_size = config.statics.get("reload_delete_batch_size", 1000)
+        sql_params = {
+            "feature_collection_name": self.feature_collection_name,
+            "generation": generation,
+            "batch_size": int(batch_size)
+        }
+        id_sql = sqa.text("""
+            SELECT feature_id FROM %s.feature
+            WHERE feature_collection_name = :feature_collection_name
+            AND generation = :generation
+            ORDER BY feature_id
+            LIMIT :batch_size
+        """ % SCHEMA)
+        num_deleted = 0
+        while True:
+            feature_ids = [row[0] for row in session.execute(id_sql, sql_params)]
+            if not feature_ids:
+                break
+            self.delete_features(session, feature_ids)
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            num_deleted += len(feature_ids)
+            print("Deleted " + str(num_deleted) + " features of generation " + str(generation))
+        session.query(IngestCheckpoint).filter(
+            IngestCheckpoint.feature_collection_name == self.feature_collection_name,
+            IngestCheckpoint.generation == generation
+        ).delete(synchronize_session=False)
+        try:
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        return num_deleted
+
+    def reload_collection(self, session, db_string=None, num_workers=1, user_id=0, models=None,
+                          data_file_paths=None):
+        """
+        Blue/green reload of the collection: the features and data of every model are loaded
+        into a new generation while the queries keep reading the active one, then the collection
+        is switched to the new generation in one single row update (see swap_generation)
+        and the old generation is deleted in small batches
+        An interrupted reload resumes from the checkpoints of the new generation
+        Note: the swap replaces all data of the collection, the reload must cover every
+              model/year loaded into the active generation (models, self.years)
+        :param session: database session
+        :param db_string: database url, needed for num_workers > 1 (see add_data_to_db_parallel)
+        :param num_workers: number of worker processes
+        :param user_id:
+        :param models: list of the model names to load, default: [self.model]
+        :param data_file_paths: dict {model name: data file path}, one file per model,
+               needed if more than one model is loaded, default: {self.model: self.data_file_path}
+        :return: new generation
         """
-        # NOTE: Feature, FeatureMetdata tables are set later
-
-    def add_data_to_db(self, session, user_id=0, geojson_data=None):
+        if models is None:
+            models = [self.model]
+        if data_file_paths is None:
+            if len(models) > 1:
+                raise Exception("Reload of " + self.feature_collection_name + " for " + ", ".join(models) +
+                                " needs the data file path of each model (data_file_paths)")
+            data_file_paths = {models[0]: self.data_file_path}
+        missing_paths = [model_name for model_name in models if not data_file_paths.get(model_name)]
+        if missing_paths:
+            raise Exception("No data file path for " + ", ".join(missing_paths))
+        if len(set(data_file_paths[model_name] for model_name in models)) != len(models):
+            raise Exception("Models of a reload must be loaded from different data files: " + ", ".join(
+                model_name + ": " + data_file_paths[model_name] for model_name in models))
+        self.set_base_tables_if_empty(session)
+        self.generation = None
+        old_generation = self.get_generation()
+        new_generation = old_generation + 1
+        # Left over by a reload that died while deleting
+        stale_generations = session.query(Feature.generation).filter(
+            Feature.feature_collection_name == self.feature_collection_name,
+            Feature.generation < old_generation
+        ).distinct().all()
+        for generation, in stale_generations:
+            self.delete_generation(session, generation)
+        missing = self.get_loaded_model_years(session, old_generation) - set(
+            (model_name, year) for model_name in models for year in self.years)
+        if missing:
+            raise Exception("Reload of " + self.feature_collection_name + " does not cover " +
+                            ", ".join(model_name + "/" + str(year) for model_name, year in sorted(missing)))
+
+        loaders = []
+        for model_name in models:
+            init_kwargs = self.get_init_kwargs()
+            init_kwargs.update({
+                "model": model_name,
+                "data_file_path": data_file_paths[model_name],
+                "generation": new_generation
+            })
+            DU = database_Util(engine=self.engine, **init_kwargs)
+            loaders.append(DU)
+            # Models loaded completely by an earlier attempt are skipped
+            if DU.get_incomplete_years(session):
+                if num_workers > 1:
+                    DU.add_data_to_db_parallel(session, db_string, num_workers, user_id=user_id)
+                else:
+                    DU.add_data_to_db(session, user_id=user_id)
+
+        # Only swap in a complete generation
+        incomplete = []
+        for DU in loaders:
+            # prepare_ingest drops the years it finds loaded, check them all
+            DU.years = list(self.years)
+            incomplete.extend(
+                DU.model + "/" + str(year) + " (" + str(num_committed) + " features committed)"
+                for year, num_committed in sorted(DU.get_incomplete_years(session).items()))
+        if incomplete:
+            raise Exception("Reload of " + self.feature_collection_name + " is incomplete: " + ", ".join(incomplete))
+
+        self.swap_generation(session, old_generation, new_generation)
+        self.generation = new_generation
+        print("Collection " + self.feature_collection_name + " switched to generation " + str(new_generation))
+        self.delete_generation(session, old_generation)
+        return new_generation
+
+    def add_data_to_db(self, session, user_id=0, geojson_data=None, worker_idx=0, num_workers=1, chunk_queue=None):
         """
         Add data to database
         :params:
             session: database session
             user_id
             geojson_data: contains the geometry information as geojson, if None, data is read from bucket
+            worker_idx: index of this worker, see add_data_to_db_parallel
+            num_workers: number of workers ingesting the collection
+            chunk_queue: multiprocessing.Queue of (chunk, idx_start, chunk_features) read by a worker
+                         instead of the data file, ends with None
+        All years in self.years are loaded in one pass over the features
         :return:
         """
-        # Sanity checks
-
-        #1.  Check if database is empty
-        # If not empty, we need to check if entries are already in db
-        db_empty = False
-        try:
-            q = session.query(Data).first()
-            if q is None:
-                db_empty = True
-        except:
-            db_empty = True
-            # db_empty = self.database_is_empty()
-
-        if db_empty:
-            # Set up feature_collection, model, parameter and variable tables
-            print("Database empty, setting up basic data tables")
-            self.set_base_database_tables(session)
+        # Sanity checks, done once by the parent if we are one of many workers
+        if num_workers == 1:
+            self.prepare_ingest(session)
+            if PARTITION_TABLES and self.storage_layout == "rows":
+                self.add_partitions(session)
 
-        # 2. check if the features are already in there
-        if self.features_change_by_year:
-            feature_year = self.year
-        else:
-            feature_year = 9999
-        features_in_db = self.check_if_features_in_db(feature_year, session)
-        if features_in_db:
-            msg = 'Data for feature_collection/year ' + self.feature_collection_name + '/' +\
-                  str(feature_year) + ' already in database. Exciting'
-            print(msg)
-            sys.exit(0)
-
-        # Read etdata
-        # FIXME eventually we should be able to just read from one location
-        if self.download_method == 'from_bucket':
-            geojson_data = self.read_data_from_bucket(self.data_file_path)
-        else:
-            geojson_data = self.read_data_from_local(self.data_file_path)
+        # Read etdata, the parent of the workers reads it for them
+        features = None
+        if chunk_queue is None:
+            features = self.get_features(geojson_data)
 
         # Set the user ids associated with this feature_collection
         user_ids_for_featColl = config.statics["feature_collections"][self.feature_collection_name]["users"]
@@ -669,15 +3028,26 @@ class database_Util(object):
         # Loop over features in bucket file, do in chunks
         # Oherwise we get a kill9 error
         chunk_size = config.statics["ingest_chunk_size"]
-        if chunk_size <= len(geojson_data["features"]):
-            num_chunks = len(geojson_data["features"]) / chunk_size
+        # Chunks are dealt out to the workers by number, their size must not change
+        chunk_sizer = None
+        if self.adaptive_chunks and num_workers == 1:
+            chunk_sizer = chunk_Util(chunk_size)
+        if chunk_queue is not None:
+            # Chunk sizes are set by the parent
+            num_features = None
+        elif isinstance(features, list):
+            num_features = len(features)
         else:
-            num_chunks = 1
-
-        if len(geojson_data["features"]) / chunk_size:
-            num_chunks += 1
-        chunk = 1
-        print("Adding data in " + str(num_chunks) + " chunk(s) to database.")
+            # Streamed features, we don't know the length until we are done
+            num_features = config.statics["feature_collections"][self.feature_collection_name]["num_features"]
+        if chunk_queue is not None:
+            print("Worker " + str(worker_idx) + " adding chunks to database.")
+        elif chunk_sizer is not None:
+            print("Adding data in chunks of " + str(chunk_sizer.min_size) + " to " + str(chunk_sizer.max_size) +
+                  " features to database, starting with " + str(chunk_size))
+        else:
+            num_chunks = max(1, (num_features + chunk_size - 1) / chunk_size)
+            print("Adding data in " + str(num_chunks) + " chunk(s) to database.")
         # Open db connection
         # Needed to bulk copy from csv
         conn = session.connection()  # SQLAlchemy Connection
@@ -687,149 +3057,1100 @@ class database_Util(object):
 
         permission = config.statics['feature_collections'][self.feature_collection_name]['permission']
         last_timeseries_update = dt.datetime.today()
-        timeseries_id = self.get_last_timeseries_id(session)
-
-        while chunk <= num_chunks:
-            csv_metadata = open("metadata.csv", "wb+")
-            csv_data = open("data.csv", "wb+")
-            csv_timeseries = open("timeseries.csv", "wb+")
-            csv_meta_writer = csv.writer(csv_metadata, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL)
-            csv_data_writer = csv.writer(csv_data, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL)
-            csv_ts_writer = csv.writer(csv_timeseries, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL)
-
-            idx_start = (chunk - 1) * chunk_size
-            idx_end = chunk * chunk_size
-            if idx_end > len(geojson_data["features"]):
-                idx_end = len(geojson_data["features"])
-
-            # loop over features in chunk
-            for f_idx in range(idx_start, idx_end):
-                feat_idx = f_idx +1
-                # Feature table
-                # check if the feature is already in the database
-                g_data = geojson_data["features"][f_idx]
-                # Set the feature_id_from_user
-                if "feature_id_from_user" in g_data["properties"].keys():
-                    feature_id_from_user = str(g_data["properties"]["feature_id_from_user"])
-                else:
-                    feature_id_from_user = str(feat_idx)
+        first_year = self.year
+        try:
+            # Per year: tables the rows are copied to, committed chunks, period ids
+            year_tables = {}
+            year_committed_chunks = {}
+            year_period_ids = {}
+            for year in self.years:
+                self.year = year
+                # Copy straight into the model/year partitions
+                year_tables[year] = ("timeseries", "data")
+                if PARTITION_TABLES and self.storage_layout == "rows":
+                    year_tables[year] = (get_partition_name("timeseries", self.model, year),
+                                         get_partition_name("data", self.model, year))
+                # Chunks committed by an earlier run of this ingest
+                year_committed_chunks[year] = self.get_committed_chunks(session)
+                if self.storage_layout == "rows":
+                    year_period_ids[year] = self.get_period_ids(session, year)
+
+            # Timeseries ids come from the database sequence, one block per chunk
+            if self.storage_layout == "rows":
+                ts_ids = sequence_Util(session, "timeseries", "timeseries_id",
+                                       chunk_size * self.get_num_timeseries_per_feature())
+                if num_workers == 1:
+                    ts_ids.sync_with_table()
+
+            metrics = metrics_Util(
+                self.metrics_file, feature_collection_name=self.feature_collection_name,
+                model_name=self.model, years=self.years, worker_idx=worker_idx
+            )
+            if chunk_queue is not None:
+                numbered_chunks = iter(chunk_queue.get, None)
+            else:
+                numbered_chunks = self.get_numbered_chunks(features, chunk_sizer or chunk_size)
+            for chunk, idx_start, chunk_features in numbered_chunks:
+                chunk_range = (idx_start, idx_start + len(chunk_features))
+                chunk_years = [
+                    year for year in self.years if not self.chunk_is_committed(chunk_range, year_committed_chunks[year])
+                ]
+                if not chunk_years:
+                    print("Chunk " + str(chunk) + " already committed. Skipping...")
+                    continue
+                if chunk_sizer is not None:
+                    chunk_sizer.start_chunk()
+                # Time since the last chunk was spent reading and parsing features
+                metrics.start_chunk(chunk, len(chunk_features))
+                chunk_feature_ids_from_user = [
+                    self.get_feature_id_from_user(g_data, idx_start + c_idx + 1)
+                    for c_idx, g_data in enumerate(chunk_features)
+                ]
+                for year in chunk_years:
+                    self.year = year
+                    feature_year = self.get_feature_year()
+                    ts_table, data_table = year_tables[year]
+                    period_ids = year_period_ids.get(year)
+                    row_counts = {
+                        "num_features": len(chunk_features),
+                        "num_timeseries_rows": 0,
+                        "num_data_rows": 0,
+                        "num_metadata_rows": 0
+                    }
+                    # Rows are collected in memory and streamed to COPY,
+                    # no temporary files so that several ingests can run in the same directory
+                    csv_data = StringIO()
+                    csv_timeseries = StringIO()
+                    csv_array = StringIO()
+                    # Tab separated, the array values are comma separated
+                    csv_array_writer = csv.writer(csv_array, delimiter="\t", quotechar="|", quoting=csv.QUOTE_MINIMAL)
+                    if self.copy_format == "binary":
+                        csv_data_writer = pgcopy_Util(DATA_COPY_TYPES, csv_data)
+                        csv_ts_writer = pgcopy_Util(TIMESERIES_COPY_TYPES, csv_timeseries)
+                    else:
+                        csv_data_writer = csv.writer(csv_data, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL)
+                        csv_ts_writer = csv.writer(csv_timeseries, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL)
+
+                    # Look up the features and data of this chunk that are already in the database
+                    # with one query each instead of two queries per feature
+                    feature_ids_in_db = self.get_feature_ids_in_db(chunk_feature_ids_from_user, feature_year, session)
+                    feature_ids_with_data = self.get_feature_ids_with_data_in_db(feature_ids_in_db.values(), session)
+                    metrics.lap("lookup", len(chunk_features))
+
+                    # Add the new features of this chunk to the feature table in one statement
+                    new_feature_rows = []
+                    new_features = []
+                    new_feature_ids_from_user = set()
+                    new_geometries = {}
+                    for c_idx, g_data in enumerate(chunk_features):
+                        feature_id_from_user = chunk_feature_ids_from_user[c_idx]
+                        if feature_id_from_user in feature_ids_in_db or feature_id_from_user in new_feature_ids_from_user:
+                            continue
+                        new_feature_ids_from_user.add(feature_id_from_user)
+                        new_features.append(g_data)
+                        feature_row = self.set_feature_row(
+                            feature_id_from_user, g_data["geometry"]["type"], None, feature_year,
+                            self.get_feature_properties(g_data))
+                        new_feature_rows.append(feature_row)
+                    if new_feature_rows and self.dedupe_geometries:
+                        # The geometries go into FeatureGeometry, see below
+                        geometry_hashes = self.get_geometry_hashes([g_data["geometry"] for g_data in new_features])
+                        for feature_row, geometry_hash, g_data in zip(new_feature_rows, geometry_hashes, new_features):
+                            new_geometries[geometry_hash] = g_data["geometry"]
+                            feature_row["geometry_id"] = geometry_hash
+                    if new_feature_rows and not self.dedupe_geometries:
+                        # Convert the geojson geometries of all new features to postgis multi polygons at once
+                        postgis_geoms = self.get_postgis_geometries([g_data["geometry"] for g_data in new_features])
+                        for feature_row, postgis_geom in zip(new_feature_rows, postgis_geoms):
+                            feature_row["geometry"] = postgis_geom
+                    metrics.lap("geometry_conversion", len(new_feature_rows))
+                    if new_geometries:
+                        # Only geometries that are not shared with features of other years are added
+                        geometry_ids = self.add_geometries_to_db(session, new_geometries)
+                        for feature_row in new_feature_rows:
+                            feature_row["geometry_id"] = geometry_ids[feature_row["geometry_id"]]
+                    if new_feature_rows:
+                        # Get the feature primary keys from db
+                        new_feature_ids = self.add_features_to_db(session, new_feature_rows, user_ids_for_featColl)
+                        feature_ids_in_db.update(new_feature_ids)
+                        row_counts["num_metadata_rows"] += len(new_feature_ids)
+                        print("Added " + str(len(new_feature_ids)) + " Features and FeatureUserLink rows")
+                    metrics.lap("geometry_insert", len(new_feature_rows))
+
+                    # loop over features in chunk
+                    for c_idx, g_data in enumerate(chunk_features):
+                        # Feature table
+                        # check if the feature is already in the database
+                        feature_id_from_user = chunk_feature_ids_from_user[c_idx]
+                        feature_id = feature_ids_in_db.get(feature_id_from_user)
+
+                        # Check if  data is in db
+                        data_in_db = feature_id in feature_ids_with_data
+
+                        if feature_id and data_in_db:
+                            print("Data for feature_id/year " + str(feature_id) + "/" + str(feature_year) +
+                                  " found in db. Skipping...")
+                            continue
+
+                        f_data = g_data
+                        # Variable loop
+                        for var in config.statics["models"][self.model]["variables"]:
+                            for t_res in config.statics["temporal_resolution"].keys():
+                                if self.storage_layout == "arrays":
+                                    # One row with all period values
+                                    data_values = [
+                                        self.get_data_value(f_data, var, data_var)
+                                        for data_var in config.statics["temporal_resolution"][t_res]["data_vars"]
+                                    ]
+                                    row = [feature_id, user_id, self.model, var, t_res, self.year,
+                                           permission, last_timeseries_update,
+                                           "{" + ",".join(str(v) for v in data_values) + "}"]
+                                    csv_array_writer.writerow(row)
+                                    row_counts["num_timeseries_rows"] += 1
+                                    continue
+                                for data_var in config.statics["temporal_resolution"][t_res]["data_vars"]:
+                                    timeseries_id = ts_ids.next_id()
+                                    # Set data value
+                                    data_value = self.get_data_value(f_data, var, data_var)
+
+                                    row = [timeseries_id, self.model, self.year, period_ids[(t_res, data_var)], data_value]
+                                    csv_ts_writer.writerow(row)
+                                    row = [feature_id, user_id, timeseries_id, self.model, var, t_res, self.year,
+                                           permission, last_timeseries_update]
+                                    csv_data_writer.writerow(row)
+                                    row_counts["num_timeseries_rows"] += 1
+                                    row_counts["num_data_rows"] += 1
+                    metrics.lap("encode", row_counts["num_timeseries_rows"])
+
+                    # Commit the data for all features
+                    if self.copy_format == "binary":
+                        ts_copied = csv_ts_writer.copy_to_table(cursor, ts_table, TIMESERIES_COPY_COLUMNS)
+                    else:
+                        ts_copied = self.copy_from_buffer(cursor, csv_timeseries, ts_table, TIMESERIES_COPY_COLUMNS)
+                    if ts_copied:
+                        print("Added timeseries table rows for features")
+                        metrics.lap("copy_timeseries", row_counts["num_timeseries_rows"])
+
+                    if self.copy_format == "binary":
+                        data_copied = csv_data_writer.copy_to_table(cursor, data_table, DATA_COPY_COLUMNS)
+                    else:
+                        data_copied = self.copy_from_buffer(cursor, csv_data, data_table, DATA_COPY_COLUMNS)
+                    if data_copied:
+                        print("Added Data tables for features")
+                        metrics.lap("copy_data", row_counts["num_data_rows"])
+
+                    if self.copy_from_buffer(cursor, csv_array, "timeseries_array", TIMESERIES_ARRAY_COPY_COLUMNS, sep="\t"):
+                        print("Added TimeseriesArray table rows for features")
+                        metrics.lap("copy_timeseries_array", row_counts["num_timeseries_rows"])
+
+                    csv_array.close()
+                    csv_timeseries.close()
+                    csv_data.close()
+
+                    self.add_checkpoint(session, chunk_range[0], chunk_range[1], row_counts)
+                    try:
+                        session.commit()
+                    except:
+                        session.rollback()
+                        raise
+                    metrics.lap("commit", row_counts["num_timeseries_rows"])
+                metrics.end_chunk()
+                if chunk_sizer is not None:
+                    chunk_sizer.end_chunk(len(chunk_features))
+        finally:
+            self.year = first_year
+        metrics.end_ingest()
+        # Close the connection
+        conn.close()
+
+
+def get_staging_tables(suffix):
+    """
+    UNLOGGED staging tables used by database_Util.add_data_to_db_staged
+    The suffix keeps concurrent loaders apart
+    :return: dict {name: (table name, column definitions)}
+    """
+    return {
+        "feature": (
+            "staging_feature_" + suffix,
+            "feature_id_from_user varchar, type varchar, geometry geometry(MULTIPOLYGON), geometry_hash varchar, "
+            "feature_properties jsonb"
+        ),
+        "values": (
+            "staging_values_" + suffix,
+            "feature_id_from_user varchar, variable_name varchar, temporal_resolution varchar, "
+            "period_id integer, data_value real"
+        )
+    }
+
+
+def run_ingest_worker(init_kwargs, db_string, user_id, worker_idx, num_workers, chunk_queue):
+    """
+    Entry point of an add_data_to_db_parallel worker process, adds the chunks read from chunk_queue
+    """
+    engine = create_engine(db_string, connect_args={'options': '-csearch_path={}'.format(SCHEMA + ',public')})
+    Session = session_module.sessionmaker()
+    Session.configure(bind=engine)
+    session = Session()
+    try:
+        DU = database_Util(engine=engine, **init_kwargs)
+        DU.add_data_to_db(session, user_id=user_id, worker_idx=worker_idx, num_workers=num_workers,
+                          chunk_queue=chunk_queue)
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def run_ingest_job(job, db_string, init_options):
+    """
+    Entry point of a queue_Util job process, loads one collection/model/year
+    :param job: dict with feature_collection_name, model_name, year, data_file_path
+    :param init_options: extra database_Util arguments, e.g. copy_format
+    """
+    engine = create_engine(db_string, connect_args={'options': '-csearch_path={}'.format(SCHEMA + ',public')})
+    Session = session_module.sessionmaker()
+    Session.configure(bind=engine)
+    session = Session()
+    data_file_path = job["data_file_path"]
+    if data_file_path.startswith(("http://", "https://")):
+        download_method = "from_bucket"
+    else:
+        download_method = "local"
+    try:
+        DU = database_Util(
+            job["model_name"], job["year"], config.statics["models"][job["model_name"]]["variables"], engine, 0,
+            job["feature_collection_name"], data_file_path, download_method,
+            features_change_by_year=job["feature_collection_name"] in config.statics.get(
+                "feature_collections_changing_by_year", []),
+            **init_options
+        )
+        DU.add_data_to_db(session)
+    finally:
+        session.close()
+        engine.dispose()
+
+
+class sequence_Util(object):
+    """
+    Hands out primary keys from the postgres sequence of a serial column
+    in reserved blocks, so that several loaders can write to the same table
+    without key collisions
+    """
+    def __init__(self, session, table_name, id_column, block_size):
+        self.session = session
+        self.table_name = SCHEMA + "." + table_name
+        self.id_column = id_column
+        self.block_size = block_size
+        self.ids = deque()
+        sql = sqa.text("SELECT pg_get_serial_sequence(:table_name, :id_column)")
+        self.sequence_name = session.execute(
+            sql, {"table_name": self.table_name, "id_column": id_column}).scalar()
+
+    def sync_with_table(self):
+        """
+        Move the sequence past the largest id in the table
+        Ids used to be assigned client side (max id + counter) without advancing the sequence
+        """
+        sql = sqa.text("""
+            SELECT setval('%s', t.max_id)
+            FROM (SELECT MAX(%s) AS max_id FROM %s) AS t
+            WHERE t.max_id >= (SELECT last_value FROM %s)
+        """ % (self.sequence_name, self.id_column, self.table_name, self.sequence_name))
+        self.session.execute(sql)
+
+    def reserve_block(self):
+        sql = sqa.text("SELECT nextval('%s') FROM generate_series(1, %s)" % (self.sequence_name, self.block_size))
+        self.ids.extend(sorted(row[0] for row in self.session.execute(sql)))
+
+    def next_id(self):
+        if not self.ids:
+            self.reserve_block()
+        return self.ids.popleft()
+
+
+class chunk_Util(object):
+    """
+    Adapts the ingest chunk size to the host:
+    after each chunk the growth of the resident memory (RSS) and the throughput (features/s)
+    are measured, the chunk size shrinks when the memory a chunk needs on top of the RSS
+    at the start of the ingest gets close to config.statics["ingest_max_rss_mb"]
+    and grows while larger chunks are faster and fit into memory
+    Note: the interpreter keeps memory it has freed, the absolute RSS stays high after
+          a spike and says little about the next chunk
+    Limits: config.statics["ingest_chunk_size_min"], config.statics["ingest_chunk_size_max"]
+    """
+    grow_factor = 1.5
+    shrink_factor = 0.5
+
+    def __init__(self, chunk_size):
+        self.min_size = int(config.statics.get("ingest_chunk_size_min", 100))
+        self.max_size = int(config.statics.get("ingest_chunk_size_max", 20000))
+        self.max_rss = int(config.statics.get("ingest_max_rss_mb", 2048)) * 1024 * 1024
+        self.chunk_size = min(max(int(chunk_size), self.min_size), self.max_size)
+        self.start_time = None
+        self.start_rss = None
+        self.base_rss = self.get_rss()
+        # RSS growth per feature, raised at once and lowered slowly
+        self.bytes_per_feature = None
+        # Throughput and chunk size before the last change
+        self.last_rate = None
+        self.last_size = None
+
+    def get_rss(self):
+        """
+        Current resident set size in bytes, 0 if it can't be read (not on linux)
+        """
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (IOError, OSError, ValueError, IndexError):
+            return 0
+
+    def start_chunk(self):
+        self.start_time = time.time()
+        self.start_rss = self.get_rss()
+
+    def end_chunk(self, num_features):
+        """
+        Set the size of the next chunk
+        :param num_features: number of features in the chunk just committed
+        :return: new chunk size
+        """
+        secs = max(time.time() - self.start_time, 1e-6)
+        rate = num_features / secs
+        rss = self.get_rss()
+        # Memory the chunk needed on top of what was held before
+        per_feature = max(rss - self.start_rss, 0) / float(max(num_features, 1))
+        if self.bytes_per_feature is None or per_feature > self.bytes_per_feature:
+            self.bytes_per_feature = per_feature
+        else:
+            self.bytes_per_feature = (self.bytes_per_feature + per_feature) / 2
+        chunk_bytes = self.chunk_size * self.bytes_per_feature
+        budget = max(self.max_rss - self.base_rss, 0)
+        new_size = self.chunk_size
+        if chunk_bytes > budget:
+            new_size = int(self.chunk_size * self.shrink_factor)
+        elif self.last_rate is not None and self.last_size < self.chunk_size and rate < self.last_rate:
+            # The last increase made the ingest slower, stay below it
+            new_size = self.last_size
+            self.max_size = new_size
+        elif chunk_bytes * self.grow_factor < 0.75 * budget:
+            new_size = int(self.chunk_size * self.grow_factor)
+        new_size = min(max(new_size, self.min_size), self.max_size)
+        if new_size != self.chunk_size:
+            print("Chunk size " + str(self.chunk_size) + " -> " + str(new_size) + " (" +
+                  str(int(rate)) + " features/s, " + str(int(self.bytes_per_feature)) + " bytes/feature, RSS " +
+                  str(rss / (1024 * 1024)) + " MB)")
+            self.last_rate = rate
+            self.last_size = self.chunk_size
+            self.chunk_size = new_size
+        return self.chunk_size
+
+
+class metrics_Util(object):
+    """
+    Timings and row counts of the ingest stages
+    (parse, lookup, geometry_conversion, geometry_insert, encode, copy per table, commit)
+    Stages are timed back to back with lap(): each lap is the time since the previous one
+    One JSON record per chunk plus a total record is appended to metrics_file (JSON lines)
+    and a one line summary per chunk is printed
+    """
+    def __init__(self, metrics_file=None, **labels):
+        """
+        :param metrics_file: path of the JSON lines file, if None records are only printed
+        :param labels: added to every record, e.g. feature_collection_name, model_name, year
+        """
+        self.metrics_file = metrics_file
+        self.labels = labels
+        self.mark = time.time()
+        self.chunk = None
+        self.totals = {"num_chunks": 0, "num_features": 0, "secs": 0.0, "stages": OrderedDict()}
+
+    def add_stage(self, stages, name, secs, rows):
+        stage = stages.setdefault(name, {"secs": 0.0, "rows": 0})
+        stage["secs"] += secs
+        stage["rows"] += rows
+
+    def start_chunk(self, chunk, num_features):
+        self.chunk = {"chunk": chunk, "num_features": num_features, "stages": OrderedDict()}
+        self.lap("parse", num_features)
+
+    def lap(self, name, rows=0):
+        """
+        Book the time since the last lap to stage name
+        :param name: stage name
+        :param rows: number of rows (or features) handled in the stage
+        """
+        now = time.time()
+        self.add_stage(self.chunk["stages"], name, now - self.mark, rows)
+        self.mark = now
+
+    def set_rates(self, record):
+        for stage in record["stages"].values():
+            stage["secs"] = round(stage["secs"], 4)
+            stage["rows_per_sec"] = round(stage["rows"] / stage["secs"], 1) if stage["secs"] > 0 else None
+        record["secs"] = round(sum(stage["secs"] for stage in record["stages"].values()), 4)
+        record["features_per_sec"] = round(record["num_features"] / record["secs"], 1) if record["secs"] > 0 else None
+
+    def write_record(self, record):
+        record.update(self.labels)
+        record["time"] = dt.datetime.today().isoformat()
+        if self.metrics_file is None:
+            return
+        with open(self.metrics_file, "a") as metrics_file:
+            metrics_file.write(json.dumps(record) + "\n")
+
+    def end_chunk(self):
+        record = self.chunk
+        self.set_rates(record)
+        self.totals["num_chunks"] += 1
+        self.totals["num_features"] += record["num_features"]
+        for name, stage in record["stages"].items():
+            self.add_stage(self.totals["stages"], name, stage["secs"], stage["rows"])
+        print("Chunk " + str(record["chunk"]) + ": " + str(record["num_features"]) + " features in " +
+              str(record["secs"]) + " s (" + str(record["features_per_sec"]) + " features/s) " +
+              ", ".join(name + " " + str(stage["secs"]) + " s" for name, stage in record["stages"].items()))
+        self.write_record(record)
+        self.chunk = None
+
+    def end_ingest(self):
+        record = self.totals
+        record["chunk"] = "total"
+        self.set_rates(record)
+        print("Ingest: " + str(record["num_features"]) + " features in " + str(record["secs"]) + " s (" +
+              str(record["features_per_sec"]) + " features/s)")
+        self.write_record(record)
+
+
+class bucket_Util(object):
+    """
+    Downloads bucket files into a local content addressed cache:
+    files are stored under their md5 (cache_dir/<md5>), a repeated ingest of
+    an unchanged file finds it by the md5 the bucket reports and skips the download
+    The cache is only kept if a cache directory is configured, without one the file
+    goes to a temporary directory that cleanup() deletes once the file has been read
+    Large files are fetched with parallel ranged requests, failed parts are retried,
+    the md5 of the download is checked against the one reported by the bucket
+    (x-goog-hash or Content-MD5 header, or a plain md5 ETag)
+    Works with any http server, servers without range support are read in one request
+    """
+    def __init__(self, cache_dir=None, num_connections=None, part_size=None, max_retries=5, timeout=60):
+        """
+        :param cache_dir: cache directory, default: config.statics["bucket_cache_dir"],
+               if neither is set nothing is cached, see cleanup
+        :param num_connections: parallel requests per file, default: config.statics["bucket_num_connections"] or 4
+        :param part_size: bytes per ranged request, default: config.statics["bucket_part_size_mb"] or 32 MB
+        :param max_retries: attempts per request
+        :param timeout: socket timeout in seconds
+        """
+        if cache_dir is None:
+            cache_dir = config.statics.get("bucket_cache_dir")
+        self.keep_files = cache_dir is not None
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix="openet_bucket_")
+        self.cache_dir = cache_dir
+        if num_connections is None:
+            num_connections = config.statics.get("bucket_num_connections", 4)
+        self.num_connections = int(num_connections)
+        if part_size is None:
+            part_size = config.statics.get("bucket_part_size_mb", 32) * 1024 * 1024
+        self.part_size = int(part_size)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Made by a concurrent loader
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+
+    def cleanup(self):
+        """
+        Delete the downloaded files if they are not cached
+        """
+        if not self.keep_files:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def retry(self, func, description):
+        """
+        Call func with retries and exponential backoff
+        :param description: logged with each failed attempt
+        """
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                return func()
+            except urllib2.HTTPError as e:
+                # Client errors won't go away
+                if e.code < 500 or attempt == self.max_retries:
+                    raise
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+            logging.warning(description + " failed, attempt " + str(attempt))
+            time.sleep(min(2 ** attempt, 60))
+
+    def urlopen(self, request):
+        """
+        urllib2.urlopen with retries and exponential backoff
+        """
+        return self.retry(
+            lambda: urllib2.urlopen(request, timeout=self.timeout), "Request to " + request.get_full_url())
+
+    def get_file_info(self, url):
+        """
+        HEAD request
+        :return: dict with size (None if unknown), md5 (hex, None if unknown),
+                 etag and accept_ranges
+        """
+        request = urllib2.Request(url)
+        request.get_method = lambda: "HEAD"
+        response = self.urlopen(request)
+        headers = response.info()
+        response.close()
+        md5 = None
+        for part in (headers.getheader("x-goog-hash") or "").split(","):
+            part = part.strip()
+            if part.startswith("md5="):
+                md5 = base64.b64decode(part[4:]).encode("hex")
+        if md5 is None and headers.getheader("Content-MD5"):
+            md5 = base64.b64decode(headers.getheader("Content-MD5")).encode("hex")
+        etag = (headers.getheader("ETag") or "").strip('"')
+        if md5 is None and re.match(r"^[0-9a-f]{32}$", etag):
+            md5 = etag
+        size = headers.getheader("Content-Length")
+        return {
+            "size": int(size) if size is not None else None,
+            "md5": md5,
+            "etag": etag,
+            "accept_ranges": (headers.getheader("Accept-Ranges") or "").lower() == "bytes"
+        }
+
+    def read_index(self):
+        """
+        :return: dict {url: {"etag", "size", "md5"}} of the files downloaded before
+        """
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except (IOError, ValueError):
+            return {}
+
+    def write_index(self, url, info):
+        index = self.read_index()
+        index[url] = {"etag": info["etag"], "size": info["size"], "md5": info["md5"]}
+        tmp_path = self.index_path + "." + str(os.getpid())
+        with open(tmp_path, "w") as index_file:
+            json.dump(index, index_file)
+        os.rename(tmp_path, self.index_path)
+
+    def get_cached_path(self, url, info):
+        """
+        :return: path of the cached copy of url, None if not in cache
+        """
+        md5 = info["md5"]
+        if md5 is None:
+            # Bucket doesn't report an md5, trust an earlier download with the same etag and size
+            cached = self.read_index().get(url)
+            if cached and info["etag"] and cached["etag"] == info["etag"] and cached["size"] == info["size"]:
+                md5 = cached["md5"]
+        if md5 is None:
+            return None
+        path = os.path.join(self.cache_dir, md5)
+        if os.path.isfile(path) and (info["size"] is None or os.path.getsize(path) == info["size"]):
+            return path
+        return None
+
+    def download_part(self, url, path, start, end):
+        """
+        Write bytes start to end (inclusive) of url into path at offset start
+        The request and the read are retried together
+        """
+        self.retry(lambda: self.read_part(url, path, start, end), "Part " + str(start) + "-" + str(end))
+
+    def read_part(self, url, path, start, end):
+        """
+        One attempt of download_part
+        """
+        request = urllib2.Request(url, headers={"Range": "bytes=%s-%s" % (start, end)})
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            if response.getcode() != 206:
+                raise Exception("Range request not supported by server")
+            with open(path, "r+b") as f:
+                f.seek(start)
+                shutil.copyfileobj(response, f, 1024 * 1024)
+                if f.tell() != end + 1:
+                    raise Exception("Incomplete part " + str(start) + "-" + str(end))
+        finally:
+            response.close()
+
+    def download_parallel(self, url, path, size):
+        """
+        Download url with num_connections threads, each fetching parts of part_size bytes
+        """
+        with open(path, "wb") as f:
+            f.truncate(size)
+        parts = Queue.Queue()
+        for start in range(0, size, self.part_size):
+            parts.put((start, min(start + self.part_size, size) - 1))
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    start, end = parts.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.download_part(url, path, start, end)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(self.num_connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def download(self, url, path):
+        response = self.urlopen(urllib2.Request(url))
+        try:
+            with open(path, "wb") as f:
+                shutil.copyfileobj(response, f, 1024 * 1024)
+        finally:
+            response.close()
+
+    def get_md5(self, path):
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), ""):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def fetch(self, url):
+        """
+        Local copy of url, downloaded if it is not in the cache
+        :param url: http(s) url of the bucket file
+        :return: path of the cached file
+        """
+        info = self.get_file_info(url)
+        path = self.get_cached_path(url, info)
+        if path is not None:
+            print("Using cached copy of " + url + ": " + path)
+            return path
+
+        start_time = time.time()
+        tmp_path = os.path.join(self.cache_dir, "download_" + str(os.getpid()) + "_" + str(threading.current_thread().ident))
+        try:
+            if info["accept_ranges"] and info["size"] and info["size"] > self.part_size and self.num_connections > 1:
+                self.download_parallel(url, tmp_path, info["size"])
+            else:
+                self.download(url, tmp_path)
+            md5 = self.get_md5(tmp_path)
+            if info["md5"] is not None and md5 != info["md5"]:
+                raise Exception("Checksum mismatch for " + url + ": expected " + info["md5"] + ", got " + md5)
+            if info["size"] is not None and os.path.getsize(tmp_path) != info["size"]:
+                raise Exception("Size mismatch for " + url)
+            path = os.path.join(self.cache_dir, md5)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        info["md5"] = md5
+        self.write_index(url, info)
+        print("Downloaded " + url + " in " + str(round(time.time() - start_time, 1)) + " s")
+        return path
+
+
+class load_Util(object):
+    """
+    Database pressure readings used by queue_Util to hold back new ingest jobs:
+    sessions waiting on locks, replication lag of the standbys and requested checkpoints per minute
+    (checkpoints forced by WAL volume rather than by checkpoint_timeout)
+    Limits: config.statics["ingest_max_lock_waits"], config.statics["ingest_max_replication_lag_secs"],
+    config.statics["ingest_max_checkpoints_per_min"]
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.max_lock_waits = int(config.statics.get("ingest_max_lock_waits", 5))
+        self.max_replication_lag = float(config.statics.get("ingest_max_replication_lag_secs", 60))
+        self.max_checkpoints_per_min = float(config.statics.get("ingest_max_checkpoints_per_min", 2))
+        # (time, number of requested checkpoints) of the last reading
+        self.last_checkpoints = None
 
+    def get_num_lock_waits(self, conn):
+        sql = sqa.text("SELECT COUNT(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock'")
+        return conn.execute(sql).scalar()
 
-                # Check if feature is in db
-                feature_id = self.check_if_feature_in_db(self.feature_collection_name, feature_id_from_user, feature_year, session)
+    def get_replication_lag(self, conn):
+        """
+        Largest replay lag of the standbys in seconds, 0 without standbys
+        Note: needs the pg_monitor role, the lag of other users' connections reads as NULL otherwise
+        """
+        sql = sqa.text("SELECT COALESCE(MAX(EXTRACT(EPOCH FROM replay_lag)), 0) FROM pg_stat_replication")
+        return float(conn.execute(sql).scalar())
+
+    def get_num_requested_checkpoints(self, conn):
+        # Postgres 17 moved the checkpoint counters to pg_stat_checkpointer
+        if conn.execute(sqa.text("SELECT to_regclass('pg_catalog.pg_stat_checkpointer')")).scalar():
+            sql = sqa.text("SELECT num_requested FROM pg_stat_checkpointer")
+        else:
+            sql = sqa.text("SELECT checkpoints_req FROM pg_stat_bgwriter")
+        return conn.execute(sql).scalar()
 
-                # Check if  data is in db
-                data_in_db = self.check_if_data_in_db(feature_id, session)
+    def get_checkpoints_per_min(self, conn):
+        """
+        Requested checkpoints per minute since the last reading, 0 on the first reading
+        """
+        now = time.time()
+        num_checkpoints = self.get_num_requested_checkpoints(conn)
+        rate = 0.0
+        if self.last_checkpoints is not None:
+            last_time, last_num_checkpoints = self.last_checkpoints
+            if now > last_time:
+                rate = (num_checkpoints - last_num_checkpoints) * 60.0 / (now - last_time)
+        self.last_checkpoints = (now, num_checkpoints)
+        return rate
+
+    def get_pressure(self):
+        """
+        :return: readings dict, list of the limits that are exceeded (empty if the database is not under pressure)
+        """
+        conn = self.engine.connect()
+        try:
+            readings = OrderedDict([
+                ("lock_waits", self.get_num_lock_waits(conn)),
+                ("replication_lag_secs", round(self.get_replication_lag(conn), 1)),
+                ("checkpoints_per_min", round(self.get_checkpoints_per_min(conn), 2))
+            ])
+        finally:
+            conn.close()
+        exceeded = []
+        if readings["lock_waits"] > self.max_lock_waits:
+            exceeded.append("lock waits " + str(readings["lock_waits"]) + " > " + str(self.max_lock_waits))
+        if readings["replication_lag_secs"] > self.max_replication_lag:
+            exceeded.append("replication lag " + str(readings["replication_lag_secs"]) + " s > " +
+                            str(self.max_replication_lag) + " s")
+        if readings["checkpoints_per_min"] > self.max_checkpoints_per_min:
+            exceeded.append("checkpoints " + str(readings["checkpoints_per_min"]) + "/min > " +
+                            str(self.max_checkpoints_per_min) + "/min")
+        return readings, exceeded
+
+
+class queue_Util(object):
+    """
+    Job queue for the collection/model/year ingests of the catalog in config.statics
+    The jobs are kept in the IngestJob table, each job runs add_data_to_db in its own process
+    At most max_concurrent_jobs run at a time and at most one job is started per poll,
+    no job is started while the database is under pressure (see load_Util), the wait
+    between polls then doubles up to config.statics["ingest_max_backoff_secs"]
+    Failed jobs are queued again until they used up max_attempts, they resume
+    from their committed chunks (see IngestCheckpoint)
+    Several queues (e.g. on different hosts) can work on the same IngestJob table
+    """
+    def __init__(self, engine, db_string, max_concurrent_jobs=None, max_attempts=None, poll_secs=None,
+                 **init_options):
+        """
+        :param engine: database engine
+        :param db_string: database url used by the job processes to create their own engine
+        :param max_concurrent_jobs: default: config.statics["ingest_max_concurrent_jobs"] or 2
+        :param max_attempts: attempts per job, default: config.statics["ingest_max_job_attempts"] or 3
+        :param poll_secs: seconds between polls, default: config.statics["ingest_poll_secs"] or 30
+        :param init_options: extra database_Util arguments of the jobs, e.g. copy_format
+        """
+        self.engine = engine
+        self.db_string = db_string
+        Session = session_module.sessionmaker(bind=engine)
+        self.session = Session()
+        if max_concurrent_jobs is None:
+            max_concurrent_jobs = config.statics.get("ingest_max_concurrent_jobs", 2)
+        self.max_concurrent_jobs = int(max_concurrent_jobs)
+        if max_attempts is None:
+            max_attempts = config.statics.get("ingest_max_job_attempts", 3)
+        self.max_attempts = int(max_attempts)
+        if poll_secs is None:
+            poll_secs = config.statics.get("ingest_poll_secs", 30)
+        self.poll_secs = float(poll_secs)
+        self.max_backoff_secs = float(config.statics.get("ingest_max_backoff_secs", 600))
+        self.init_options = init_options
+        self.load = load_Util(engine)
+        self.host = socket.gethostname()
+        # ingest_job_id: multiprocessing.Process
+        self.running = {}
+
+    def commit(self):
+        try:
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
 
-                if feature_id and data_in_db:
-                    print("Data for feature_id/year " + str(feature_id) + "/" + str(feature_year) +
-                          " found in db. Skipping...")
+    def get_catalog_jobs(self, feature_collection_names=None, models=None, years=None):
+        """
+        Jobs for the collections and models in config.statics
+        :param feature_collection_names: default: all collections
+        :param models: default: all models
+        :param years: default: valid_year_range of each model
+        :return: list of job dicts
+        """
+        template = config.statics.get("ingest_data_file_path", "{data_file_name}_{model}_{year}.geojson")
+        jobs = []
+        for feature_collection_name in sorted(config.statics["feature_collections"]):
+            if feature_collection_names and feature_collection_name not in feature_collection_names:
+                continue
+            data_file_name = config.statics["feature_collections"][feature_collection_name]["data_file_name"]
+            for model in sorted(config.statics["models"]):
+                if models and model not in models:
                     continue
+                model_years = years
+                if not model_years:
+                    first_year, last_year = config.statics["models"][model]["valid_year_range"]
+                    model_years = range(int(first_year), int(last_year) + 1)
+                for year in model_years:
+                    jobs.append({
+                        "feature_collection_name": feature_collection_name,
+                        "model_name": model,
+                        "year": int(year),
+                        "data_file_path": template.format(data_file_name=data_file_name, model=model, year=year)
+                    })
+        return jobs
+
+    def add_jobs(self, jobs, refresh=False):
+        """
+        Queue the jobs, jobs that are already in the table are left alone
+        :param refresh: True if done and failed jobs are queued again (a full catalog refresh)
+        :return: number of jobs queued
+        """
+        if not jobs:
+            return 0
+        now = dt.datetime.today()
+        job_rows = []
+        for job in jobs:
+            job_row = dict(job)
+            job_row.update({"status": "queued", "attempts": 0, "queued": now})
+            job_rows.append(job_row)
+        stmt = postgresql.insert(IngestJob.__table__).values(job_rows)
+        index_elements = ["feature_collection_name", "model_name", "year"]
+        if refresh:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={
+                    "status": "queued", "attempts": 0, "error": None, "queued": now,
+                    "data_file_path": stmt.excluded.data_file_path
+                },
+                where=IngestJob.__table__.c.status.in_(["done", "failed"])
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+        num_queued = self.session.execute(stmt).rowcount
+        self.commit()
+        return num_queued
 
-                uid_feat_pairs = []
-                if not feature_id:
-                    print("Adding Feature " + str(f_idx + 1))
-                    # Convert the geojson geometry to postgis geometry using shapely
-                    # Note: we convert polygons to multi polygon
-                    # Convert to shapely shape
-                    shapely_geom = asShape(g_data["geometry"])
-                    postgis_geom = self.set_postgis_geometry(shapely_geom)
-                    if postgis_geom is None:
-                        raise Exception("Not a valid geometry, must be polygon or multi polygon!")
-                    # Add the feature table entry for this feature and obtain the feature_id
-                    feature = self.set_feature_entity(feature_id_from_user, shapely_geom.geom_type, postgis_geom, feature_year)
-                    # Submit the feature table to obtain the primary key feature_id
-                    self.add_entity_to_db(session, feature)
-                    # Get the feature primary key from db
-                    feature_id = feature.feature_id
-                    logging.info("Added Feature Table")
-                    # Add the many-to-many relationship between user and feature
-                    # (user_id, feature_id pairs)
-                    for user_id in user_ids_for_featColl:
-                        uid_feat_pairs.append((user_id, feature_id))
+    def recover_jobs(self):
+        """
+        Queue the running jobs of this host again whose process is gone (the previous queue died)
+        """
+        q = self.session.query(IngestJob).filter(
+            IngestJob.status == "running",
+            IngestJob.worker.like(self.host + ":%")
+        )
+        for job in q:
+            pid = int(job.worker.rsplit(":", 1)[1])
+            try:
+                os.kill(pid, 0)
+                continue
+            except OSError:
+                pass
+            print("Job " + str(job.ingest_job_id) + " was left running by process " + str(pid) + ". Queueing...")
+            job.status = "queued"
+            job.worker = None
+        self.commit()
+
+    def claim_job(self):
+        """
+        Mark the next queued job as running, jobs claimed by other queues are skipped
+        Jobs of a collection that is being loaded wait: the jobs of one collection
+        share its features (year 9999) and would insert them at the same time
+        Claims of all queues are serialized with a transaction level advisory lock: the claim
+        statement runs after the lock is granted, so under READ COMMITTED it sees the jobs
+        another queue has just marked as running (SKIP LOCKED only keeps queues off the same row)
+        :return: job dict or None
+        """
+        self.session.execute(sqa.text("SELECT pg_advisory_xact_lock(hashtext('ingest_job_claim'))"))
+        sql = sqa.text("""
+            UPDATE %s.ingest_job SET status = 'running', attempts = attempts + 1, started = :now
+            WHERE ingest_job_id = (
+                SELECT ingest_job_id FROM %s.ingest_job
+                WHERE status = 'queued'
+                AND feature_collection_name NOT IN (
+                    SELECT feature_collection_name FROM %s.ingest_job WHERE status = 'running'
+                )
+                ORDER BY attempts, queued, ingest_job_id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING ingest_job_id, feature_collection_name, model_name, year, data_file_path, attempts
+        """ % (SCHEMA, SCHEMA, SCHEMA))
+        row = self.session.execute(sql, {"now": dt.datetime.today()}).first()
+        self.commit()
+        if row is None:
+            return None
+        return dict(row.items())
+
+    def start_job(self, job):
+        process = multiprocessing.Process(target=run_ingest_job, args=(job, self.db_string, self.init_options))
+        process.start()
+        self.session.query(IngestJob).filter(IngestJob.ingest_job_id == job["ingest_job_id"]).update(
+            {"worker": self.host + ":" + str(process.pid)}, synchronize_session=False)
+        self.commit()
+        self.running[job["ingest_job_id"]] = process
+        print("Started job " + str(job["ingest_job_id"]) + ": " + job["feature_collection_name"] + "/" +
+              job["model_name"] + "/" + str(job["year"]) + " (attempt " + str(job["attempts"]) + ")")
+
+    def reap_jobs(self):
+        """
+        Record the jobs whose process finished, failed jobs are queued again
+        until they used up max_attempts
+        """
+        for ingest_job_id, process in self.running.items():
+            if process.is_alive():
+                continue
+            process.join()
+            del self.running[ingest_job_id]
+            job = self.session.query(IngestJob).get(ingest_job_id)
+            job.finished = dt.datetime.today()
+            job.worker = None
+            if process.exitcode == 0:
+                job.status = "done"
+                job.error = None
+            else:
+                job.error = "exit code " + str(process.exitcode)
+                if job.attempts < self.max_attempts:
+                    job.status = "queued"
                 else:
-                    logging.info("Feature found in db")
-                    print("Feature found in db")
+                    job.status = "failed"
+            print("Job " + str(ingest_job_id) + " " + job.status + (" (" + job.error + ")" if job.error else ""))
+            self.commit()
 
-                f_data = geojson_data["features"][f_idx]
-                # Set the feature metadata and data tables for bulk ingest
-                for key in config.statics["feature_collections"][self.feature_collection_name]["metadata"]:
-                    try:
-                        value = str(g_data["properties"][key])
-                    except:
-                        try:
-                           value = str(f_data["properties"][key])
-                        except:
-                            value = "Not Found"
-                    # Remove commas, causes issues when copy_from
-                    value = " ".join(value.replace(", ", ",").split(","))
-                    csv_meta_writer.writerow([feature_id, key, value])
-
-                # Variable loop
-                for var in config.statics["models"][self.model]["variables"]:
-                    for t_res in config.statics["temporal_resolution"].keys():
-                        for data_var in config.statics["temporal_resolution"][t_res]["data_vars"]:
-                            timeseries_id+=1
-                            # Set date
-                            DU = date_Util()
-                            start_date_dt, end_date_dt = DU.get_dbtable_start_end_dates(self.year, t_res, data_var)
-                            # Set data value
-                            try:
-                                data_value = float(f_data["properties"][var + "_" + data_var])
-                            except:
-                                data_value = -9999
-
-                            row = [timeseries_id, start_date_dt, end_date_dt, data_value]
-                            csv_ts_writer.writerow(row)
-                            row = [feature_id, user_id, timeseries_id, self.model, var, t_res,
-                                   permission, last_timeseries_update]
-                            csv_data_writer.writerow(row)
-
-                if uid_feat_pairs:
-                    session.execute(FeatureUserLink.insert().values(uid_feat_pairs))
-                    print("Added FeatureUserLink Table")
-
-            csv_metadata.close()
-            csv_timeseries.close()
-            csv_data.close()
-
-
-            # Commit the feature metadata and data for all features
-            with open("timeseries.csv", "r") as f:
-                if os.stat("timeseries.csv").st_size != 0:
-                    cols = ("timeseries_id", "start_date", "end_date", "data_value")
-                    cursor.copy_from(f, "timeseries", sep=",", columns=cols)
-                    print("Added timeseries table rows for features")
-
-            with open("data.csv", "r") as f:
-                if os.stat("data.csv").st_size != 0:
-                    cols = ("feature_id", "user_id", "timeseries_id",
-                            "model_name", "variable_name", "temporal_resolution",
-                            "permission", "last_timeseries_update")
-                    cursor.copy_from(f, "data", sep=",", columns=cols)
-                    print("Added Data tables for features")
-
-            with open("metadata.csv", "r") as f:
-                if os.stat("metadata.csv").st_size != 0:
-                    cols = ("feature_id", "feature_metadata_name", "feature_metadata_properties")
-                    cursor.copy_from(f, "feature_metadata", sep=",", columns=cols)
-                    print("Added FeatureMetadata table rows for features")
+    def get_num_queued_jobs(self):
+        return self.session.query(IngestJob).filter(IngestJob.status == "queued").count()
 
+    def run(self):
+        """
+        Run jobs until the queue is empty
+        :return: dict status: number of jobs
+        """
+        self.recover_jobs()
+        backoff_secs = self.poll_secs
+        while True:
+            self.reap_jobs()
+            if not self.running and not self.get_num_queued_jobs():
+                break
+            if len(self.running) < self.max_concurrent_jobs:
+                readings, exceeded = self.load.get_pressure()
+                if exceeded:
+                    backoff_secs = min(backoff_secs * 2, self.max_backoff_secs)
+                    print("Database under pressure (" + ", ".join(exceeded) + "). Waiting " +
+                          str(backoff_secs) + " s...")
+                    time.sleep(backoff_secs)
+                    continue
+                backoff_secs = self.poll_secs
+                job = self.claim_job()
+                if job is not None:
+                    self.start_job(job)
+            time.sleep(self.poll_secs)
+        counts = self.session.query(IngestJob.status, db.func.count(IngestJob.ingest_job_id)).group_by(
+            IngestJob.status).all()
+        return dict(counts)
 
 
-            try:
-                session.commit()
-            except:
-                session.rollback()
-                raise
+class pgcopy_Util(object):
+    """
+    Encodes rows in the PostgreSQL binary COPY format (PGCOPY)
+    Dates and floats are packed as binary values, so neither python nor
+    the server has to format or parse them as text
+    Usage:
+        writer = pgcopy_Util(TIMESERIES_COPY_TYPES)
+        writer.writerow([timeseries_id, model_name, year, period_id, data_value])
+        writer.copy_to_table(cursor, "timeseries", TIMESERIES_COPY_COLUMNS)
+    """
+    header = "PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+    trailer = struct.pack("!h", -1)
+    # postgres timestamps are microseconds since 2000-01-01
+    pg_epoch = dt.datetime(2000, 1, 1)
 
-            # Delete the csv files
-            os.remove("metadata.csv")
-            os.remove("data.csv")
-            os.remove("timeseries.csv")
-            chunk += 1
-        # Close the connection
-        conn.close()
+    def __init__(self, col_types, buf=None):
+        """
+        :param col_types: list of column types: int4, int8, float4, float8, timestamp or text
+        :param buf: optional StringIO buffer the rows are written to
+        """
+        self.col_types = col_types
+        if buf is None:
+            buf = StringIO()
+        self.buf = buf
+        self.num_rows = 0
+        self.row_header = struct.pack("!h", len(col_types))
+        self.encoders = [getattr(self, "encode_" + col_type) for col_type in col_types]
+        self.buf.write(self.header)
+
+    def encode_int4(self, value):
+        return struct.pack("!ii", 4, int(value))
+
+    def encode_int8(self, value):
+        return struct.pack("!iq", 8, int(value))
+
+    def encode_float4(self, value):
+        return struct.pack("!if", 4, float(value))
+
+    def encode_float8(self, value):
+        return struct.pack("!id", 8, float(value))
+
+    def encode_timestamp(self, value):
+        delta = value - self.pg_epoch
+        usecs = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        return struct.pack("!iq", 8, usecs)
+
+    def encode_text(self, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf8")
+        else:
+            value = str(value)
+        return struct.pack("!i", len(value)) + value
+
+    def writerow(self, row):
+        """
+        Encode a single row, None values are written as NULL
+        :param row: list of values in the order of self.col_types
+        :return:
+        """
+        fields = [self.row_header]
+        for encode, value in zip(self.encoders, row):
+            if value is None:
+                fields.append(struct.pack("!i", -1))
+            else:
+                fields.append(encode(value))
+        self.buf.write("".join(fields))
+        self.num_rows += 1
+
+    def copy_to_table(self, cursor, table_name, cols):
+        """
+        Bulk copy the encoded rows into a table
+        :param cursor: DBAPI cursor
+        :param table_name:
+        :param cols: table columns in the order of self.col_types
+        :return: True if rows were copied, False if no rows were written
+        """
+        if self.num_rows == 0:
+            return False
+        self.buf.write(self.trailer)
+        self.buf.seek(0)
+        sql = "COPY " + table_name + " (" + ", ".join(cols) + ") FROM STDIN WITH (FORMAT binary)"
+        cursor.copy_expert(sql, self.buf)
+        return True
 
 
 class date_Util(object):
@@ -906,7 +4227,13 @@ class query_Util(object):
     Class to support API queries
     """
 
-    def __init__(self, model, variable, user_id, temporal_resolution, engine, schema):
+    def __init__(self, model, variable, user_id, temporal_resolution, engine, schema, storage_layout='rows',
+                 simplified_geometry=False):
+        """
+        :param storage_layout: 'rows' (Data/Timeseries tables) or 'arrays' (TimeseriesArray table)
+        :param simplified_geometry: True if selection geometries are tested against the simplified
+               feature geometries (faster, approximate along the feature boundaries)
+        """
         self.model = model
         self.variable = variable
         self.user_id = user_id
@@ -918,6 +4245,9 @@ class query_Util(object):
         Session.configure(bind=self.engine)
         self.session = Session()
         self.session.execute("SET search_path TO " + schema + ', public')
+        self.storage_layout = storage_layout
+        self.timeseries_source = self.set_timeseries_source(storage_layout)
+        self.simplified_geometry = simplified_geometry
         self.json_data =  {
             "properties": {
                 "user_id": user_id,
@@ -928,6 +4258,99 @@ class query_Util(object):
             }
         }
 
+    def set_timeseries_source(self, storage_layout):
+        """
+        FROM clause providing the data.* and timeseries.* columns used by the api queries
+        For the array layout each TimeseriesArray row is unnested into its periods
+        so the queries read one row per feature/variable/year instead of one per period
+        """
+        if storage_layout == 'arrays':
+            mon_len = 'ARRAY[' + ','.join(str(d) for d in config.statics['mon_len']) + ']'
+            return """
+            timeseries_array AS data
+            CROSS JOIN LATERAL (
+                SELECT
+                make_timestamp(data.year, p.month, 1, 0, 0, 0) AS start_date,
+                make_timestamp(data.year, p.month, (%s)[p.month], 0, 0, 0) AS end_date,
+                v.data_value
+                FROM unnest(data.data_values) WITH ORDINALITY AS v(data_value, period_idx)
+                CROSS JOIN LATERAL (
+                    SELECT CASE data.temporal_resolution
+                    WHEN 'monthly' THEN v.period_idx::integer
+                    WHEN 'seasonal' THEN 10
+                    ELSE 12 END AS month
+                ) AS p
+            ) AS timeseries
+            """ % mon_len
+        return """
+            (
+                SELECT
+                timeseries.timeseries_id,
+                timeseries.model_name,
+                timeseries.year,
+                period.start_date,
+                period.end_date,
+                timeseries.data_value
+                FROM timeseries
+                JOIN period ON period.period_id = timeseries.period_id
+            ) AS timeseries
+            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
+            """
+
+    def set_year_filter(self, start_date, end_date):
+        """
+        Restrict a query to the years between start_date and end_date
+        so that postgres only scans the matching year partitions
+        Note: only used if data.year is set, i.e. for partitioned tables and the array layout
+        """
+        if not PARTITION_TABLES and self.storage_layout != 'arrays':
+            return ''
+        start_date_dt, end_date_dt = datetimes_from_dates(start_date, end_date)
+        year_filter = 'AND data.year BETWEEN %s AND %s' % (start_date_dt.year, end_date_dt.year)
+        if self.storage_layout == 'rows':
+            year_filter += ' AND timeseries.year BETWEEN %s AND %s' % (start_date_dt.year, end_date_dt.year)
+        return year_filter
+
+    def set_collection_filter(self, feature_collection_name):
+        """
+        Features of the collection's active generation
+        The generation is looked up in the same statement, a query sees either
+        the old or the new features of a collection that is reloaded, see database_Util.reload_collection
+        """
+        return """feature.feature_collection_name = '%s'
+            AND feature.generation = (
+                SELECT generation FROM feature_collection WHERE feature_collection_name = '%s'
+            )""" % (feature_collection_name, feature_collection_name)
+
+    def set_selection_filter(self, selection_geometry):
+        """
+        Features contained in the selection geometry
+        The bbox index finds the candidates, features whose bbox is contained
+        are accepted without testing the full resolution geometry
+        """
+        sg = "ST_GeomFromText('%s')" % selection_geometry
+        if self.simplified_geometry:
+            geom = 'feature.geometry_simplified'
+        else:
+            geom = 'COALESCE(feature.geometry, feature_geometry.geometry)'
+        return 'feature.bbox @ %s AND (ST_CONTAINS(%s, feature.bbox) OR ST_CONTAINS(%s, %s))' % (sg, sg, sg, geom)
+
+    def set_metadata_filter(self, feature_metadata_name, feature_metadata_properties):
+        """
+        Features whose metadata feature_metadata_name has one of the feature_metadata_properties
+        Containment tests on feature.feature_properties, answered by its GIN index
+        :param feature_metadata_properties: single value or list/tuple of values
+        """
+        if isinstance(feature_metadata_properties, basestring):
+            feature_metadata_properties = [feature_metadata_properties]
+        docs = [
+            "'" + json.dumps({feature_metadata_name: str(fmp)}).replace("'", "''") + "'"
+            for fmp in feature_metadata_properties
+        ]
+        if len(docs) == 1:
+            return 'feature.feature_properties @> %s::jsonb' % docs[0]
+        return 'feature.feature_properties @> ANY(ARRAY[%s]::jsonb[])' % ','.join(docs)
+
     def set_temporal_summary_column(self, temporal_summary):
         if temporal_summary == 'raw':
             return 'Timeseries.data_value'
@@ -995,8 +4418,7 @@ class query_Util(object):
             timeseries.end_date AS ed,
             timeseries.data_value AS dv
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
+            %s
 
             WHERE
             data.feature_id = '%s'
@@ -1006,7 +4428,8 @@ class query_Util(object):
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
-        """ %(fid, sd, ed, self.model, self.variable, self.temporal_resolution))
+            %s
+        """ %(self.timeseries_source, fid, sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
@@ -1047,8 +4470,7 @@ class query_Util(object):
             data.feature_id as feat_id,
             %s
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
+            %s
 
             WHERE
             data.feature_id = '%s'
@@ -1058,8 +4480,9 @@ class query_Util(object):
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
+            %s
             GROUP BY data.feature_id
-        """ % (data_col, fid, sd, ed, self.model, self.variable, self.temporal_resolution))
+        """ % (data_col, self.timeseries_source, fid, sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
@@ -1099,20 +4522,20 @@ class query_Util(object):
             timeseries.end_date AS ed,
             timeseries.data_value AS dv
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
 
             WHERE
-            feature.feature_collection_name = '%s'
+            %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
+            %s
             ORDER BY feature.feature_id
-        """ %(fc, sd, ed, self.model, self.variable, self.temporal_resolution))
+        """ %(self.timeseries_source, self.set_collection_filter(fc), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
@@ -1150,20 +4573,20 @@ class query_Util(object):
             feature.feature_id as feat_id,
             %s
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
 
             WHERE
-            feature.feature_collection_name = '%s'
+            %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
+            %s
             GROUP BY feature.feature_id
-        """ %(data_col, fc, sd, ed, self.model, self.variable, self.temporal_resolution))
+        """ %(data_col, self.timeseries_source, self.set_collection_filter(fc), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
@@ -1204,22 +4627,20 @@ class query_Util(object):
             timeseries.end_date,
             timeseries.data_value
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
-            LEFT JOIN feature_metadata ON feature_metadata.feature_id = data.feature_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
 
             WHERE
-            feature.feature_collection_name = '%s'
-            AND feature_metadata.feature_metadata_name = '%s'
-            AND feature_metadata.feature_metadata_properties = '%s'
+            %s
+            AND %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
-        """ % (fc, fmn, fmp, sd, ed, self.model, self.variable, self.temporal_resolution))
+            %s
+        """ % (self.timeseries_source, self.set_collection_filter(fc), self.set_metadata_filter(fmn, fmp), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
@@ -1259,23 +4680,21 @@ class query_Util(object):
             feature.feature_id as feat_id,
             %s
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
-            LEFT JOIN feature_metadata ON feature_metadata.feature_id = data.feature_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
 
             WHERE
-            feature.feature_collection_name = '%s'
-            AND feature_metadata.feature_metadata_name = '%s'
-            AND feature_metadata.feature_metadata_properties = '%s'
+            %s
+            AND %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
+            %s
             GROUP BY feature.feature_id
-        """ % (data_col, fc, fmn, fmp, sd, ed, self.model, self.variable, self.temporal_resolution))
+        """ % (data_col, self.timeseries_source, self.set_collection_filter(fc), self.set_metadata_filter(fmn, fmp), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
@@ -1288,6 +4707,9 @@ class query_Util(object):
         '''
         Request monthly time series for a single field from a featureCollection
         that is selected by feature_property (feature_id)/feature_value
+        Note: the feature areas are geodesic, in square meters (feature.area), earlier versions
+              used the planar ST_Area of the lon/lat geometry (square degrees), which weighted
+              features far from the equator more than their size on the ground
         :return:
         '''
         # Sanity ccheck on params
@@ -1308,25 +4730,25 @@ class query_Util(object):
         sql = sqa.text("""
             SELECT
             feature.feature_id AS feat_id,
-            ST_AREA(feature.geometry) AS geom,
+            feature.area AS geom,
             timeseries.start_date AS sd,
             timeseries.end_date AS ed,
             timeseries.data_value AS dv
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
 
             WHERE
-            feature.feature_collection_name = '%s'
+            %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
+            %s
             ORDER BY feature.feature_id
-        """ % (fc, sd, ed, self.model, self.variable, self.temporal_resolution))
+        """ % (self.timeseries_source, self.set_collection_filter(fc), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         # Get the area average
         featsdata = {}
@@ -1357,6 +4779,9 @@ class query_Util(object):
         '''
         Request monthly time series for a single field from a featureCollection
         that is selected by feature_property (feature_id)/feature_value
+        Note: the feature areas are geodesic, in square meters (feature.area), earlier versions
+              used the planar ST_Area of the lon/lat geometry (square degrees), which weighted
+              features far from the equator more than their size on the ground
         :return:
         '''
         # Sanity ccheck on params
@@ -1380,23 +4805,23 @@ class query_Util(object):
         ed = params['end_date']
         sql = sqa.text("""
             SELECT
-            ST_AREA(feature.geometry),
+            feature.area,
             %s
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
 
             WHERE
-            feature.feature_collection_name = '%s'
+            %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
-            GROUP BY feature.geometry
-        """ % (data_col, fc, sd, ed, self.model, self.variable, self.temporal_resolution))
+            %s
+            GROUP BY feature.feature_id, feature.area
+        """ % (data_col, self.timeseries_source, self.set_collection_filter(fc), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         # Get the area average
         summ = 0
@@ -1448,23 +4873,21 @@ class query_Util(object):
             timeseries.end_date AS ed,
             timeseries.data_value AS dv
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
-            LEFT JOIN feature_metadata ON feature_metadata.feature_id = data.feature_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
 
             WHERE
-            feature.feature_collection_name = '%s'
-            AND feature_metadata.feature_metadata_name = '%s'
-            AND feature_metadata.feature_metadata_properties IN %s
+            %s
+            AND %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
+            %s
             ORDER BY feature.feature_id
-        """ % (fc, fmn, fmp, sd, ed, self.model, self.variable, self.temporal_resolution))
+        """ % (self.timeseries_source, self.set_collection_filter(fc), self.set_metadata_filter(fmn, fmp), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
@@ -1504,23 +4927,21 @@ class query_Util(object):
             feature.feature_id as feat_id,
             %s
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
-            LEFT JOIN feature_metadata ON feature_metadata.feature_id = data.feature_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
 
             WHERE
-            feature.feature_collection_name = '%s'
-            AND feature_metadata.feature_metadata_name = '%s'
-            AND feature_metadata.feature_metadata_properties IN %s
+            %s
+            AND %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
+            %s
             GROUP BY feature.feature_id
-        """ % (data_col, fc, fmn, fmp, sd, ed, self.model, self.variable, self.temporal_resolution))
+        """ % (data_col, self.timeseries_source, self.set_collection_filter(fc), self.set_metadata_filter(fmn, fmp), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
@@ -1563,21 +4984,22 @@ class query_Util(object):
             timeseries.end_date AS ed,
             timeseries.data_value AS dv
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
+            LEFT JOIN feature_geometry ON feature_geometry.geometry_id = feature.geometry_id
 
             WHERE
-            feature.feature_collection_name = '%s'
-            AND ST_CONTAINS(ST_GeomFromText('%s'), feature.geometry)
+            %s
+            AND %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
+            %s
             ORDER BY feature.feature_id
-        """ %(fc, sg, sd, ed, self.model, self.variable, self.temporal_resolution))
+        """ %(self.timeseries_source, self.set_collection_filter(fc), self.set_selection_filter(sg), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
@@ -1620,22 +5042,23 @@ class query_Util(object):
             feature.feature_id as feat_id,
             %s
             FROM
-            timeseries
-            LEFT JOIN data ON data.timeseries_id = timeseries.timeseries_id
+            %s
             LEFT JOIN feature ON feature.feature_id = data.feature_id
+            LEFT JOIN feature_geometry ON feature_geometry.geometry_id = feature.geometry_id
 
             WHERE
-            feature.feature_collection_name = '%s'
-            AND ST_CONTAINS(ST_GeomFromText('%s'), feature.geometry)
+            %s
+            AND %s
             AND timeseries.start_date >= '%s'::timestamp
             AND timeseries.end_date <= '%s'::timestamp
             AND data.user_id = 0
             AND data.model_name = '%s'
             AND data.variable_name = '%s'
             AND data.temporal_resolution = '%s'
+            %s
             GROUP BY feature.feature_id
             ORDER BY feature.feature_id
-        """ %(data_col, fc, sg, sd, ed, self.model, self.variable, self.temporal_resolution))
+        """ %(data_col, self.timeseries_source, self.set_collection_filter(fc), self.set_selection_filter(sg), sd, ed, self.model, self.variable, self.temporal_resolution, self.set_year_filter(sd, ed)))
         query_data = self.conn.execute(sql)
         data = [list(qd) for qd in query_data]
         j_data = copy.deepcopy(self.json_data)
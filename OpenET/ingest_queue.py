@@ -0,0 +1,53 @@
+import argparse
+from sqlalchemy import create_engine
+
+import config
+from db_methods import Base, queue_Util
+
+'''
+Loads the feature collection catalog in config.statics:
+one ingest job per collection/model/year, run by queue_Util with a
+concurrency limit, new jobs are held back while the database is under pressure
+
+Examples:
+    python ingest_queue.py
+    python ingest_queue.py --models ssebop --years 2017 2018 --max-concurrent-jobs 4
+    python ingest_queue.py --refresh
+'''
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest job queue for the feature collection catalog")
+    parser.add_argument("--collections", nargs="*", help="default: all collections in statics")
+    parser.add_argument("--models", nargs="*", help="default: all models in statics")
+    parser.add_argument("--years", type=int, nargs="*", help="default: valid_year_range of each model")
+    parser.add_argument("--max-concurrent-jobs", type=int)
+    parser.add_argument("--max-attempts", type=int)
+    parser.add_argument("--poll-secs", type=float)
+    parser.add_argument("--refresh", action="store_true", help="queue done and failed jobs again")
+    parser.add_argument("--copy-format", default="csv", choices=["csv", "binary"])
+    parser.add_argument("--stream-features", action="store_true")
+    parser.add_argument("--adaptive-chunks", action="store_true")
+    parser.add_argument("--metrics-file")
+    args = parser.parse_args()
+
+    DB_USER = config.OPENET_DB_USER
+    DB_PASSWORD = config.OPENET_DB_PASSWORD
+    DB_PORT = config.OPENET_DB_PORT
+    DB_HOST = config.OPENET_DB_HOST
+    DB_NAME = config.OPENET_DB_NAME
+
+    db_string = "postgresql+psycopg2://" + DB_USER + ":" + DB_PASSWORD
+    db_string += "@" + DB_HOST + ":" + str(DB_PORT) + '/' + DB_NAME
+    engine = create_engine(db_string)
+    Base.metadata.create_all(engine)
+
+    queue = queue_Util(
+        engine, db_string, max_concurrent_jobs=args.max_concurrent_jobs, max_attempts=args.max_attempts,
+        poll_secs=args.poll_secs, copy_format=args.copy_format, stream_features=args.stream_features,
+        adaptive_chunks=args.adaptive_chunks, metrics_file=args.metrics_file
+    )
+    jobs = queue.get_catalog_jobs(args.collections, args.models, args.years)
+    num_queued = queue.add_jobs(jobs, refresh=args.refresh)
+    print("Queued " + str(num_queued) + " of " + str(len(jobs)) + " jobs")
+    counts = queue.run()
+    print("Jobs: " + ", ".join(status + " " + str(num_jobs) for status, num_jobs in sorted(counts.items())))
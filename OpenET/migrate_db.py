@@ -0,0 +1,73 @@
+import sys
+import argparse
+from sqlalchemy import create_engine
+from sqlalchemy.orm import session as session_module
+
+import config
+from db_methods import Base, database_Util
+
+'''
+Schema migrations that drop constraints or delete rows, never run by the ingest
+(the ingest itself only adds and fills missing columns, see database_Util.migrate_schema)
+
+--unique-constraints adds the unique constraints the ingest needs (ON CONFLICT targets)
+and drops older, narrower ones; rows that violate them are reported and the
+table is left unchanged unless --delete-duplicates confirms that they are deleted
+(duplicate features are deleted with all their data)
+
+--drop-timeseries-dates drops timeseries.start_date/end_date, replaced by timeseries.period_id,
+once every timeseries row has its period; readers of the date columns must join the period table
+
+Examples:
+    python migrate_db.py --unique-constraints
+    python migrate_db.py --unique-constraints --delete-duplicates
+    python migrate_db.py --drop-timeseries-dates
+'''
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Explicit schema migrations of the OpenET database")
+    parser.add_argument("--unique-constraints", action="store_true",
+                        help="add the unique constraints of the models, drop the ones they don't declare")
+    parser.add_argument("--delete-duplicates", action="store_true",
+                        help="delete the rows that violate the unique constraints")
+    parser.add_argument("--drop-timeseries-dates", action="store_true",
+                        help="drop timeseries.start_date and timeseries.end_date, can't be undone")
+    args = parser.parse_args()
+    if not args.unique_constraints and not args.drop_timeseries_dates:
+        parser.error("no migration given")
+
+    DB_USER = config.OPENET_DB_USER
+    DB_PASSWORD = config.OPENET_DB_PASSWORD
+    DB_PORT = config.OPENET_DB_PORT
+    DB_HOST = config.OPENET_DB_HOST
+    DB_NAME = config.OPENET_DB_NAME
+
+    db_string = "postgresql+psycopg2://" + DB_USER + ":" + DB_PASSWORD
+    db_string += "@" + DB_HOST + ":" + str(DB_PORT) + '/' + DB_NAME
+    engine = create_engine(db_string)
+    Base.metadata.create_all(engine)
+    Session = session_module.sessionmaker(bind=engine)
+    session = Session()
+
+    # The migrations are not tied to a collection, model or year
+    DU = database_Util(None, 9999, [], engine, 0, None, None, None)
+    exit_code = 0
+    try:
+        # Columns the constraints are made of
+        DU.migrate_schema(session, check_constraints=False)
+        if args.unique_constraints:
+            duplicates_left = DU.migrate_unique_constraints(session, delete_duplicates=args.delete_duplicates)
+            if duplicates_left:
+                print("Duplicate rows left: " + ", ".join(
+                    table_name + " " + str(num_rows) for table_name, num_rows in sorted(duplicates_left.items())) +
+                    ", run again with --delete-duplicates to delete them")
+                exit_code = 1
+        if args.drop_timeseries_dates and DU.drop_timeseries_dates(session):
+            exit_code = 1
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    sys.exit(exit_code)
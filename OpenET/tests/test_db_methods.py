@@ -0,0 +1,611 @@
+import os, sys
+import datetime as dt
+import hashlib
+import json
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+from cStringIO import StringIO
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shapely import wkb as shapely_wkb
+from shapely.geometry import shape
+import db_methods
+from db_methods import bucket_Util, chunk_Util, metrics_Util, pgcopy_Util, query_Util, queue_Util
+from db_methods import geojson_to_multipolygon_wkb
+
+'''
+Unit tests of the ingest helpers that don't need a database
+Run from the OpenET directory (config.py must be importable):
+    python -m unittest discover -s tests
+'''
+
+
+class RangeRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serves server.files {path: content} like a bucket: md5 ETag, Accept-Ranges,
+    ranged GETs are answered with 206, the ranges in server.failures {range: count} fail count times
+    """
+    def do_HEAD(self):
+        self.send_file(False)
+
+    def do_GET(self):
+        self.send_file(True)
+
+    def send_file(self, send_body):
+        self.server.requests.append((self.command, self.headers.getheader("Range")))
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        range_header = self.headers.getheader("Range")
+        if self.server.failures.get(range_header):
+            self.server.failures[range_header] -= 1
+            self.send_error(503)
+            return
+        md5 = self.server.md5s.get(self.path, hashlib.md5(content).hexdigest())
+        status = 200
+        start, end = 0, len(content) - 1
+        if send_body and range_header:
+            start, end = [int(v) for v in range_header.split("=")[1].split("-")]
+            status = 206
+        body = content[start:end + 1]
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"' + md5 + '"')
+        if status == 206:
+            self.send_header("Content-Range", "bytes %s-%s/%s" % (start, end, len(content)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeEngine(object):
+    def connect(self):
+        return None
+
+
+class BucketUtilTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        self.server.files = {"/data.geojson": os.urandom(1000)}
+        self.server.md5s = {}
+        self.server.requests = []
+        self.server.failures = {}
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url = "http://127.0.0.1:" + str(self.server.server_address[1]) + "/data.geojson"
+        self.cache_dir = tempfile.mkdtemp()
+        self.statics = dict(db_methods.config.statics)
+        self.time = db_methods.time
+        db_methods.time = FakeClock(100.0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+        db_methods.config.statics.clear()
+        db_methods.config.statics.update(self.statics)
+        db_methods.time = self.time
+
+    def get_bucket(self, cache_dir=None, max_retries=1):
+        return bucket_Util(cache_dir or self.cache_dir, num_connections=3, part_size=256, max_retries=max_retries,
+                           timeout=5)
+
+    def test_ranged_parts(self):
+        path = self.get_bucket().fetch(self.url)
+        content = self.server.files["/data.geojson"]
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.path.basename(path), hashlib.md5(content).hexdigest())
+        ranges = sorted(r for command, r in self.server.requests if command == "GET")
+        self.assertEqual(ranges, ["bytes=0-255", "bytes=256-511", "bytes=512-767", "bytes=768-999"])
+
+    def test_md5_mismatch(self):
+        self.server.md5s["/data.geojson"] = "0" * 32
+        with self.assertRaises(Exception):
+            self.get_bucket().fetch(self.url)
+        # Neither the download nor an index entry is left behind
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_cache_hit(self):
+        path = self.get_bucket().fetch(self.url)
+        self.server.requests[:] = []
+        self.assertEqual(self.get_bucket().fetch(self.url), path)
+        self.assertEqual([command for command, r in self.server.requests], ["HEAD"])
+
+    def test_no_cache(self):
+        db_methods.config.statics.pop("bucket_cache_dir", None)
+        bucket = bucket_Util(num_connections=3, part_size=256, max_retries=1, timeout=5)
+        path = bucket.fetch(self.url)
+        self.assertTrue(os.path.isfile(path))
+        self.assertNotEqual(os.path.dirname(path), self.cache_dir)
+        bucket.cleanup()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(bucket.cache_dir))
+        # A configured cache is kept
+        bucket = self.get_bucket()
+        path = bucket.fetch(self.url)
+        bucket.cleanup()
+        self.assertTrue(os.path.isfile(path))
+
+    def test_part_retries(self):
+        self.server.failures = {"bytes=256-511": 2}
+        path = self.get_bucket(max_retries=3).fetch(self.url)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.server.files["/data.geojson"])
+        self.assertEqual(self.server.requests.count(("GET", "bytes=256-511")), 3)
+
+    def test_part_retries_exhausted(self):
+        self.server.failures = {"bytes=256-511": 5}
+        with self.assertRaises(Exception):
+            self.get_bucket(max_retries=2).fetch(self.url)
+        # One retry layer: max_retries requests, not max_retries ** 2
+        self.assertEqual(self.server.requests.count(("GET", "bytes=256-511")), 2)
+
+
+class PgcopyUtilTest(unittest.TestCase):
+    def test_writerow(self):
+        writer = pgcopy_Util(("int4", "text", "float8", "timestamp"))
+        writer.writerow([1, "ssebop", None, dt.datetime(2000, 1, 2)])
+        expected = pgcopy_Util.header + struct.pack("!h", 4)
+        expected += struct.pack("!ii", 4, 1)
+        expected += struct.pack("!i", 6) + "ssebop"
+        expected += struct.pack("!i", -1)
+        expected += struct.pack("!iq", 8, 86400 * 1000000)
+        self.assertEqual(writer.buf.getvalue(), expected)
+        self.assertEqual(writer.num_rows, 1)
+
+    def test_encode_unicode(self):
+        writer = pgcopy_Util(("text",))
+        self.assertEqual(writer.encode_text(u"\xe9t"), struct.pack("!i", 3) + "\xc3\xa9t")
+
+    def test_copy_to_table(self):
+        class Cursor(object):
+            def copy_expert(self, sql, buf):
+                self.sql = sql
+                self.data = buf.read()
+
+        cursor = Cursor()
+        writer = pgcopy_Util(db_methods.TIMESERIES_COPY_TYPES, StringIO())
+        self.assertFalse(writer.copy_to_table(cursor, "timeseries", db_methods.TIMESERIES_COPY_COLUMNS))
+        writer.writerow([1, "ssebop", 2017, 3, 0.5])
+        self.assertTrue(writer.copy_to_table(cursor, "timeseries", db_methods.TIMESERIES_COPY_COLUMNS))
+        self.assertEqual(
+            cursor.sql,
+            "COPY timeseries (timeseries_id, model_name, year, period_id, data_value) FROM STDIN WITH (FORMAT binary)"
+        )
+        self.assertTrue(cursor.data.startswith(pgcopy_Util.header))
+        self.assertTrue(cursor.data.endswith(pgcopy_Util.trailer))
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.DU = db_methods.database_Util(
+            "ssebop", 2017, ["et"], FakeEngine(), 0, "test_collection", "test.geojson", "local")
+
+    def test_get_num_committed_features(self):
+        self.assertEqual(self.DU.get_num_committed_features([]), 0)
+        self.assertEqual(self.DU.get_num_committed_features([(0, 100), (100, 150)]), 150)
+        # Overlapping chunks of runs with other chunk sizes are counted once
+        self.assertEqual(self.DU.get_num_committed_features([(50, 200), (0, 100), (60, 80)]), 200)
+        self.assertEqual(self.DU.get_num_committed_features([(0, 10), (20, 30)]), 20)
+
+    def test_chunk_is_committed(self):
+        committed_chunks = [(0, 100), (200, 300)]
+        self.assertTrue(self.DU.chunk_is_committed((0, 100), committed_chunks))
+        self.assertTrue(self.DU.chunk_is_committed((220, 250), committed_chunks))
+        self.assertFalse(self.DU.chunk_is_committed((50, 150), committed_chunks))
+        self.assertFalse(self.DU.chunk_is_committed((100, 200), committed_chunks))
+        self.assertFalse(self.DU.chunk_is_committed((0, 100), []))
+
+
+class GeojsonToMultipolygonWkbTest(unittest.TestCase):
+    def test_polygon_with_hole(self):
+        exterior = [[0.0, 0.0], [4.0, 0.0], [4.0, 4.0], [0.0, 0.0]]
+        hole = [[1.0, 1.0], [2.0, 1.0], [2.0, 2.0], [1.0, 1.0]]
+        wkb = geojson_to_multipolygon_wkb([{"type": "Polygon", "coordinates": [exterior, hole]}])[0]
+        expected = db_methods.WKB_MULTIPOLYGON + struct.pack("<I", 1)
+        expected += db_methods.WKB_POLYGON + struct.pack("<I", 2)
+        for ring in [exterior, hole]:
+            expected += struct.pack("<I", len(ring))
+            expected += "".join(struct.pack("<dd", x, y) for x, y in ring)
+        self.assertEqual(wkb, expected)
+
+    def test_batch(self):
+        square = [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]
+        wkbs = geojson_to_multipolygon_wkb([
+            {"type": "MultiPolygon", "coordinates": [square, square]},
+            {"type": "Point", "coordinates": [0, 0]},
+            {"type": "Polygon", "coordinates": square}
+        ])
+        self.assertEqual(len(wkbs), 3)
+        self.assertEqual(wkbs[0][:9], db_methods.WKB_MULTIPOLYGON + struct.pack("<I", 2))
+        self.assertIsNone(wkbs[1])
+        self.assertEqual(wkbs[2][:9], db_methods.WKB_MULTIPOLYGON + struct.pack("<I", 1))
+        self.assertEqual(len(wkbs[2]), 9 + 9 + 4 + 5 * 16)
+
+    def assertRoundTrip(self, geometry, expected_geometry=None):
+        if expected_geometry is None:
+            expected_geometry = geometry
+        wkb = geojson_to_multipolygon_wkb([geometry])[0]
+        loaded = shapely_wkb.loads(wkb)
+        self.assertEqual(loaded.geom_type, "MultiPolygon")
+        self.assertFalse(loaded.has_z)
+        self.assertTrue(loaded.equals(shape(expected_geometry)))
+        self.assertEqual(loaded.area, shape(expected_geometry).area)
+
+    def test_round_trip(self):
+        exterior = [[0.0, 0.0], [4.0, 0.0], [4.0, 4.0], [0.0, 4.0], [0.0, 0.0]]
+        hole = [[1.0, 1.0], [1.0, 2.0], [2.0, 2.0], [2.0, 1.0], [1.0, 1.0]]
+        other = [[10.5, 10.25], [11.0, 10.25], [11.0, 11.0], [10.5, 10.25]]
+        self.assertRoundTrip({"type": "Polygon", "coordinates": [exterior]})
+        self.assertRoundTrip({"type": "Polygon", "coordinates": [exterior, hole]})
+        self.assertRoundTrip({"type": "MultiPolygon", "coordinates": [[exterior, hole], [other]]})
+
+    def test_round_trip_3d(self):
+        exterior = [[0.0, 0.0], [4.0, 0.0], [4.0, 4.0], [0.0, 4.0], [0.0, 0.0]]
+        hole = [[1.0, 1.0], [1.0, 2.0], [2.0, 2.0], [2.0, 1.0], [1.0, 1.0]]
+        other = [[10.5, 10.25], [11.0, 10.25], [11.0, 11.0], [10.5, 10.25]]
+        # z on all points, and on some points of a ring only
+        exterior_3d = [pt + [100.0] for pt in exterior]
+        hole_mixed = [hole[0]] + [pt + [5.0] for pt in hole[1:]]
+        other_mixed = [pt + [5.0] for pt in other[:2]] + other[2:]
+        self.assertRoundTrip(
+            {"type": "Polygon", "coordinates": [exterior_3d, hole_mixed]},
+            {"type": "Polygon", "coordinates": [exterior, hole]}
+        )
+        self.assertRoundTrip(
+            {"type": "MultiPolygon", "coordinates": [[exterior_3d, hole_mixed], [other_mixed]]},
+            {"type": "MultiPolygon", "coordinates": [[exterior, hole], [other]]}
+        )
+
+    def test_wkb_passed_through(self):
+        wkb = geojson_to_multipolygon_wkb([{"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]]]}])[0]
+        self.assertEqual(geojson_to_multipolygon_wkb([{"type": "Polygon", "wkb": wkb}]), [wkb])
+
+
+class GeometryHashTest(unittest.TestCase):
+    def setUp(self):
+        self.DU = db_methods.database_Util(
+            "ssebop", 2017, ["et"], FakeEngine(), 0, "test_collection", "test.geojson", "local")
+        self.exterior = [[0.0, 0.0], [4.0, 0.0], [4.0, 4.0], [0.0, 4.0], [0.0, 0.0]]
+        self.hole = [[1.0, 1.0], [1.0, 2.0], [2.0, 2.0], [2.0, 1.0], [1.0, 1.0]]
+
+    def test_normalize_rings(self):
+        # Clockwise exterior starting at another point, counterclockwise hole
+        exterior = [[4.0, 4.0], [4.0, 0.0], [0.0, 0.0], [0.0, 4.0], [4.0, 4.0]]
+        hole = [[2.0, 2.0], [1.0, 2.0], [1.0, 1.0], [2.0, 1.0], [2.0, 2.0]]
+        normalized = db_methods.normalize_polygon_geometry({"type": "Polygon", "coordinates": [exterior, hole]})
+        self.assertEqual(normalized["type"], "MultiPolygon")
+        self.assertEqual(normalized["coordinates"], [[self.exterior, self.hole]])
+
+    def test_normalize_z_and_precision(self):
+        exterior = [[x + 1e-12, y, 7.0] for x, y in self.exterior]
+        normalized = db_methods.normalize_polygon_geometry({"type": "Polygon", "coordinates": [exterior]})
+        self.assertEqual(normalized["coordinates"], [[self.exterior]])
+
+    def test_normalize_polygon_order(self):
+        other = [[10.0, 10.0], [11.0, 10.0], [11.0, 11.0], [10.0, 10.0]]
+        first = db_methods.normalize_polygon_geometry(
+            {"type": "MultiPolygon", "coordinates": [[self.exterior], [other]]})
+        second = db_methods.normalize_polygon_geometry(
+            {"type": "MultiPolygon", "coordinates": [[other], [self.exterior]]})
+        self.assertEqual(first, second)
+
+    def test_normalize_other_types(self):
+        point = {"type": "Point", "coordinates": [0.0, 0.0]}
+        self.assertIs(db_methods.normalize_polygon_geometry(point), point)
+
+    def test_hashes_equal(self):
+        shifted = self.exterior[2:-1] + self.exterior[:3]
+        reversed_hole = list(reversed(self.hole))
+        wkb = geojson_to_multipolygon_wkb([{"type": "Polygon", "coordinates": [self.exterior, self.hole]}])[0]
+        hashes = self.DU.get_geometry_hashes([
+            {"type": "Polygon", "coordinates": [self.exterior, self.hole]},
+            {"type": "MultiPolygon", "coordinates": [[shifted, reversed_hole]]},
+            {"type": "Polygon", "wkb": wkb}
+        ])
+        self.assertEqual(len(set(hashes)), 1)
+
+    def test_hashes_differ(self):
+        moved = [[x + 0.5, y] for x, y in self.exterior]
+        hashes = self.DU.get_geometry_hashes([
+            {"type": "Polygon", "coordinates": [self.exterior]},
+            {"type": "Polygon", "coordinates": [self.exterior, self.hole]},
+            {"type": "Polygon", "coordinates": [moved]},
+            {"type": "Point", "coordinates": [0.0, 0.0]},
+            {"type": "Point", "coordinates": [1.0, 0.0]}
+        ])
+        self.assertEqual(len(set(hashes)), 5)
+
+
+class FakeRssChunkUtil(chunk_Util):
+    """
+    chunk_Util with the RSS set by the test
+    """
+    rss = 0
+
+    def get_rss(self):
+        return self.rss
+
+
+class ChunkUtilTest(unittest.TestCase):
+    def setUp(self):
+        self.statics = dict(db_methods.config.statics)
+        db_methods.config.statics.update({
+            "ingest_chunk_size_min": 100, "ingest_chunk_size_max": 1000, "ingest_max_rss_mb": 100
+        })
+
+    def tearDown(self):
+        db_methods.config.statics.clear()
+        db_methods.config.statics.update(self.statics)
+
+    def run_chunk(self, sizer, num_features, rss_growth, secs):
+        sizer.start_chunk()
+        sizer.start_time = time.time() - secs
+        sizer.rss += rss_growth
+        return sizer.end_chunk(num_features)
+
+    def test_bounds(self):
+        self.assertEqual(FakeRssChunkUtil(50).chunk_size, 100)
+        self.assertEqual(FakeRssChunkUtil(5000).chunk_size, 1000)
+        sizer = FakeRssChunkUtil(800)
+        self.assertEqual(self.run_chunk(sizer, 800, 800, 1.0), 1000)
+        self.assertEqual(self.run_chunk(sizer, 1000, 1000, 1.0), 1000)
+
+    def test_grow(self):
+        sizer = FakeRssChunkUtil(200)
+        self.assertEqual(self.run_chunk(sizer, 200, 200, 1.0), 300)
+        self.assertEqual(self.run_chunk(sizer, 300, 300, 1.0), 450)
+
+    def test_shrink(self):
+        sizer = FakeRssChunkUtil(400)
+        # 0.5 MB per feature, 200 MB for the chunk, the budget is 100 MB
+        self.assertEqual(self.run_chunk(sizer, 400, 200 * 1024 * 1024, 1.0), 200)
+        self.assertEqual(self.run_chunk(sizer, 200, 150 * 1024 * 1024, 1.0), 100)
+        self.assertEqual(self.run_chunk(sizer, 100, 150 * 1024 * 1024, 1.0), 100)
+
+    def test_slower_after_growth(self):
+        sizer = FakeRssChunkUtil(200)
+        self.assertEqual(self.run_chunk(sizer, 200, 200, 1.0), 300)
+        # Larger chunks are slower: back to the last size, which becomes the maximum
+        self.assertEqual(self.run_chunk(sizer, 300, 300, 3.0), 200)
+        self.assertEqual(sizer.max_size, 200)
+        self.assertEqual(self.run_chunk(sizer, 200, 200, 1.0), 200)
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module, the test sets the time
+    """
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+class MetricsUtilTest(unittest.TestCase):
+    def setUp(self):
+        self.time = db_methods.time
+        self.clock = FakeClock(100.0)
+        db_methods.time = self.clock
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.metrics_file = os.path.join(self.tmp_dir, "metrics.jsonl")
+
+    def tearDown(self):
+        db_methods.time = self.time
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmp_dir)
+
+    def run_ingest(self, metrics):
+        self.clock.now = 101.0
+        metrics.start_chunk(1, 10)
+        self.clock.now = 103.0
+        metrics.lap("lookup", 10)
+        self.clock.now = 104.0
+        metrics.lap("copy_data", 40)
+        metrics.end_chunk()
+        self.clock.now = 106.0
+        metrics.start_chunk(2, 20)
+        self.clock.now = 110.0
+        metrics.lap("lookup", 20)
+        metrics.end_chunk()
+        metrics.end_ingest()
+
+    def test_records(self):
+        self.run_ingest(metrics_Util(self.metrics_file, model_name="ssebop", worker_idx=0))
+        with open(self.metrics_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record["chunk"] for record in records], [1, 2, "total"])
+        for record in records:
+            self.assertEqual(record["model_name"], "ssebop")
+            self.assertEqual(record["worker_idx"], 0)
+            self.assertIn("time", record)
+        self.assertEqual(records[0]["num_features"], 10)
+        self.assertEqual(records[0]["secs"], 4.0)
+        self.assertEqual(records[0]["features_per_sec"], 2.5)
+        self.assertEqual(records[0]["stages"]["lookup"], {"secs": 2.0, "rows": 10, "rows_per_sec": 5.0})
+        self.assertEqual(records[0]["stages"]["copy_data"], {"secs": 1.0, "rows": 40, "rows_per_sec": 40.0})
+        self.assertEqual(records[1]["secs"], 6.0)
+        self.assertEqual(records[1]["features_per_sec"], 3.3)
+
+    def test_totals(self):
+        self.run_ingest(metrics_Util(self.metrics_file))
+        with open(self.metrics_file) as f:
+            total = json.loads(f.readlines()[-1])
+        self.assertEqual(total["num_chunks"], 2)
+        self.assertEqual(total["num_features"], 30)
+        self.assertEqual(total["secs"], 10.0)
+        self.assertEqual(total["features_per_sec"], 3.0)
+        self.assertEqual(total["stages"]["parse"], {"secs": 3.0, "rows": 30, "rows_per_sec": 10.0})
+        self.assertEqual(total["stages"]["lookup"], {"secs": 6.0, "rows": 30, "rows_per_sec": 5.0})
+        self.assertEqual(total["stages"]["copy_data"], {"secs": 1.0, "rows": 40, "rows_per_sec": 40.0})
+
+    def test_summary(self):
+        self.run_ingest(metrics_Util())
+        lines = sys.stdout.getvalue().splitlines()
+        self.assertEqual(lines, [
+            "Chunk 1: 10 features in 4.0 s (2.5 features/s) parse 1.0 s, lookup 2.0 s, copy_data 1.0 s",
+            "Chunk 2: 20 features in 6.0 s (3.3 features/s) parse 2.0 s, lookup 4.0 s",
+            "Ingest: 30 features in 10.0 s (3.0 features/s)"
+        ])
+        # No file without metrics_file
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+class FakeFieldDefn(object):
+    def __init__(self, name):
+        self.name = name
+
+    def GetName(self):
+        return self.name
+
+
+class FakeLayerDefn(object):
+    """
+    ogr layer definition with the given field names
+    """
+    def __init__(self, field_names):
+        self.field_names = field_names
+
+    def GetFieldCount(self):
+        return len(self.field_names)
+
+    def GetFieldDefn(self, i):
+        return FakeFieldDefn(self.field_names[i])
+
+
+class OgrFieldMapTest(unittest.TestCase):
+    field_names = ["OBJECTID", "et_2016_01", "et_2017_01", "et_2017_12", "et_2017", "ndvi_2017_06", "crop_type"]
+
+    def get_field_map(self, years):
+        DU = db_methods.database_Util(
+            "ssebop", years[0], ["et"], FakeEngine(), 0, "test_collection", "test.shp", "local", years=years)
+        return DU.get_ogr_field_map(FakeLayerDefn(self.field_names))
+
+    def test_single_year(self):
+        self.assertEqual(self.get_field_map([2017]), [
+            (0, "OBJECTID"), (2, "et_m01"), (3, "et_m12"), (4, "et_annual"), (5, "ndvi_m06"), (6, "crop_type")
+        ])
+
+    def test_multiple_years(self):
+        self.assertEqual(self.get_field_map([2016, 2017]), list(enumerate(self.field_names)))
+
+    def test_other_years(self):
+        self.assertEqual(self.get_field_map([2018]), [(0, "OBJECTID"), (6, "crop_type")])
+
+
+class MetadataFilterTest(unittest.TestCase):
+    def setUp(self):
+        # The filter is plain SQL text, no database session needed
+        self.QU = query_Util.__new__(query_Util)
+
+    def test_single_value(self):
+        self.assertEqual(
+            self.QU.set_metadata_filter("crop", "corn"),
+            "feature.feature_properties @> '{\"crop\": \"corn\"}'::jsonb"
+        )
+        self.assertEqual(
+            self.QU.set_metadata_filter("field_id", [1]),
+            "feature.feature_properties @> '{\"field_id\": \"1\"}'::jsonb"
+        )
+
+    def test_several_values(self):
+        self.assertEqual(
+            self.QU.set_metadata_filter("crop", ["corn", "wheat"]),
+            "feature.feature_properties @> ANY(ARRAY['{\"crop\": \"corn\"}','{\"crop\": \"wheat\"}']::jsonb[])"
+        )
+
+    def test_quotes(self):
+        self.assertEqual(
+            self.QU.set_metadata_filter("owner", "o'brien"),
+            "feature.feature_properties @> '{\"owner\": \"o''brien\"}'::jsonb"
+        )
+
+
+class CatalogJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.statics = dict(db_methods.config.statics)
+        db_methods.config.statics.pop("ingest_data_file_path", None)
+        db_methods.config.statics.update({
+            "feature_collections": {
+                "fields_b": {"data_file_name": "b"},
+                "fields_a": {"data_file_name": "a"}
+            },
+            "models": {
+                "ssebop": {"valid_year_range": ["2016", "2017"]},
+                "eemetric": {"valid_year_range": ["2017", "2017"]}
+            }
+        })
+        # The catalog comes from config.statics, no database session needed
+        self.QU = queue_Util.__new__(queue_Util)
+
+    def tearDown(self):
+        db_methods.config.statics.clear()
+        db_methods.config.statics.update(self.statics)
+
+    def get_job_keys(self, jobs):
+        return [(job["feature_collection_name"], job["model_name"], job["year"]) for job in jobs]
+
+    def test_all_jobs(self):
+        jobs = self.QU.get_catalog_jobs()
+        self.assertEqual(self.get_job_keys(jobs), [
+            ("fields_a", "eemetric", 2017), ("fields_a", "ssebop", 2016), ("fields_a", "ssebop", 2017),
+            ("fields_b", "eemetric", 2017), ("fields_b", "ssebop", 2016), ("fields_b", "ssebop", 2017)
+        ])
+        self.assertEqual(jobs[1]["data_file_path"], "a_ssebop_2016.geojson")
+
+    def test_selection(self):
+        jobs = self.QU.get_catalog_jobs(feature_collection_names=["fields_b"], models=["ssebop"], years=[2020])
+        self.assertEqual(self.get_job_keys(jobs), [("fields_b", "ssebop", 2020)])
+
+    def test_data_file_path_template(self):
+        db_methods.config.statics["ingest_data_file_path"] = "gs://bucket/{model}/{year}/{data_file_name}.geojson"
+        jobs = self.QU.get_catalog_jobs(feature_collection_names=["fields_a"], models=["eemetric"])
+        self.assertEqual([job["data_file_path"] for job in jobs], ["gs://bucket/eemetric/2017/a.geojson"])
+
+
+class DecimalsToFloatsTest(unittest.TestCase):
+    def test_nested(self):
+        value = {
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[Decimal("-120.5"), Decimal("38.25")]]]},
+            "properties": {"et_annual": Decimal("812.3"), "count": 3, "name": u"field", "tags": None}
+        }
+        converted = db_methods.decimals_to_floats(value)
+        self.assertEqual(converted, {
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[-120.5, 38.25]]]},
+            "properties": {"et_annual": 812.3, "count": 3, "name": u"field", "tags": None}
+        })
+        self.assertIsInstance(converted["properties"]["et_annual"], float)
+        self.assertIsInstance(converted["properties"]["count"], int)
+        # The parsed value is left unchanged
+        self.assertIsInstance(value["properties"]["et_annual"], Decimal)
+
+
+if __name__ == "__main__":
+    unittest.main()